@@ -0,0 +1,410 @@
+##    MIT License
+##
+##    Copyright (c) 2018-2026 Fredrik Mellbin
+##
+##    Permission is hereby granted, free of charge, to any person obtaining a copy
+##    of this software and associated documentation files (the "Software"), to deal
+##    in the Software without restriction, including without limitation the rights
+##    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+##    copies of the Software, and to permit persons to whom the Software is
+##    furnished to do so, subject to the following conditions:
+##
+##    The above copyright notice and this permission notice shall be included in all
+##    copies or substantial portions of the Software.
+##
+##    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+##    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+##    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+##    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+##    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+##    SOFTWARE.
+
+# End-to-end timings of the client against a synthetic package repository.
+#
+# A catalog with the requested number of packages and releases is generated together with real zip, 7z, script and
+# wheel downloads for the packages that get installed, and served from a local HTTP server. Every operation runs in a
+# fresh interpreter with its own definitions, cache and install dirs, cold (no snapshot, installed state or download
+# cache) and warm (everything left from the previous run), and its wall time and peak memory are recorded. Stub generation
+# is skipped since the generated plugins can't be loaded.
+#
+#     python benchmarks/bench_client.py --packages 2000 --output before.json
+#     python benchmarks/bench_client.py --packages 2000 --compare before.json
+#     python benchmarks/bench_client.py --ref HEAD~1 -o install upgrade-all
+
+import argparse
+import functools
+import hashlib
+import http.server
+import io
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from typing import Dict, List, MutableMapping, NamedTuple, Optional, Sequence, Tuple
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+operations = ['update', 'available', 'installed', 'install', 'upgrade-all', 'uninstall']
+other_targets = ['win64', 'win32', 'linux-glibc-aarch64', 'darwin-x86_64', 'darwin-aarch64']
+# the generated plugins are never loaded so the same target works on every platform
+bench_target = 'linux-glibc-x86_64'
+
+# the peak memory use of this process, measured from inside since the rusage of a child also counts what its parent used
+# before the exec
+def get_peak_memory() -> Optional[int]:
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB everywhere except macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+# Runs vsrepo the way the command line does but with the dist-info dir inside the benchmark dir instead of the real
+# site-packages and writes the peak memory use to peak_file, the harness starts itself with --client for this
+def run_client(site_dir: str, peak_file: str, argv: Sequence[str]) -> int:
+    from vsrepo import vsrepo
+    init = vsrepo.init
+
+    def bench_init(*args, **kwargs) -> None:
+        init(*args, **kwargs)
+        vsrepo.site_package_dir = site_dir
+
+    vsrepo.init = bench_init
+    vsrepo.update_genstubs = lambda: None
+    result = vsrepo.main(argv)
+    with open(peak_file, 'w') as f:
+        f.write(str(get_peak_memory()))
+    return result
+
+class Download(NamedTuple):
+    url: str
+    members: Dict[str, Tuple[str, str]] # install_fn -> (member, sha256)
+    sha256: Optional[str] # of the download itself for scripts and wheels
+
+def make_content(rng: random.Random, size: int) -> bytes:
+    # random bytes mixed with repeated runs so archives compress about as well as plugin binaries
+    pool = rng.randbytes(64 * 1024)
+    chunks: List[bytes] = []
+    total = 0
+    while total < size:
+        chunk = rng.randbytes(4096) if rng.random() < 0.5 else pool[rng.randrange(0, len(pool) - 4096):][:4096]
+        chunks.append(chunk)
+        total += len(chunk)
+    return b''.join(chunks)[:size]
+
+def write_archive(path: str, members: Dict[str, bytes]) -> None:
+    if path.endswith('.7z'):
+        import py7zr
+        with py7zr.SevenZipFile(path, 'w', filters=[{'id': py7zr.FILTER_LZMA2, 'preset': 1}]) as zf:
+            for name, data in members.items():
+                zf.writestr(data, name)
+    else:
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            for name, data in members.items():
+                zf.writestr(name, data)
+
+def make_wheel(path: str, name: str, version: str, module: bytes) -> None:
+    distinfo = '{}-{}.dist-info'.format(name, version)
+    files = {
+        name + '/__init__.py': module,
+        distinfo + '/WHEEL': b'Wheel-Version: 1.0\nGenerator: bench_client\nRoot-Is-Purelib: true\nTag: py3-none-any\n',
+        distinfo + '/METADATA': 'Metadata-Version: 2.1\nName: {}\nVersion: {}\n'.format(name, version).encode(),
+    }
+    record = ''.join('{},sha256={},{}\n'.format(fn, hashlib.sha256(data).hexdigest(), len(data)) for fn, data in files.items())
+    files[distinfo + '/RECORD'] = (record + distinfo + '/RECORD,,\n').encode()
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for fn, data in files.items():
+            zf.writestr(fn, data)
+
+# writes the downloads of one release of an installable package to srv_dir
+def make_download(rng: random.Random, srv_dir: str, base_url: str, p: MutableMapping, version: str, size: int) -> Download:
+    key = p['identifier'].rsplit('.', 1)[-1]
+    if p['type'] == 'PyWheel':
+        fname = '{}-{}-py3-none-any.whl'.format(key, version)
+        make_wheel(os.path.join(srv_dir, fname), key, version, make_content(rng, size))
+        with open(os.path.join(srv_dir, fname), 'rb') as f:
+            sha256 = hashlib.file_digest(f, 'sha256').hexdigest()
+        return Download(base_url + fname, {}, sha256)
+    if p['type'] == 'PyScript':
+        fname = '{}-{}.py'.format(key, version)
+        data = b'# ' + version.encode() + b'\n' + make_content(rng, size).hex().encode()[:size]
+        with open(os.path.join(srv_dir, fname), 'wb') as f:
+            f.write(data)
+        sha256 = hashlib.sha256(data).hexdigest()
+        return Download(base_url + fname, {key + '.py': (fname, sha256)}, sha256)
+    fname = '{}-{}.{}'.format(key, version, '7z' if rng.random() < 0.25 or size >= 16 * 1024 * 1024 else 'zip')
+    contents: Dict[str, bytes] = {}
+    members: Dict[str, Tuple[str, str]] = {}
+    for i in range(rng.randrange(1, 4)):
+        install_fn = '{}{}.so'.format(key, i if i > 0 else '')
+        data = make_content(rng, size if i == 0 else size // 8)
+        contents[key + '-' + version + '/' + install_fn] = data
+        members[install_fn] = (key + '-' + version + '/' + install_fn, hashlib.sha256(data).hexdigest())
+    write_archive(os.path.join(srv_dir, fname), contents)
+    return Download(base_url + fname, members, None)
+
+def make_release(rng: random.Random, p: MutableMapping, version: str, index: int, bin_names: Sequence[str], download: Optional[Download]) -> MutableMapping:
+    rel: MutableMapping = {'version': version, 'published': '20{:02d}-01-01T00:00:00Z'.format(10 + index % 15)}
+    for bin_name in bin_names:
+        if download is not None and bin_name in (bench_target, 'script', 'wheel'):
+            bin_rel: MutableMapping = {'url': download.url}
+            if download.members:
+                bin_rel['files'] = {fn: [member, sha256] for fn, (member, sha256) in download.members.items()}
+            if p['type'] == 'PyWheel':
+                bin_rel['hash'] = download.sha256
+        else:
+            # releases that are never downloaded only need plausible entries for the file hash index
+            name = p['identifier'].rsplit('.', 1)[-1]
+            bin_rel = {'url': 'https://example.com/{}/{}-{}.zip'.format(name, bin_name, version)}
+            if p['type'] == 'PyWheel':
+                bin_rel['hash'] = rng.randbytes(32).hex()
+            else:
+                bin_rel['files'] = {name + ('.py' if p['type'] == 'PyScript' else '.so'): [name + '/' + bin_name + '/' + name, rng.randbytes(32).hex()]}
+        rel[bin_name] = bin_rel
+    return rel
+
+class Repository(NamedTuple):
+    old: bytes # definitions without the newest release of the installed packages
+    new: bytes
+    install: List[str] # identifiers of the packages that get installed
+
+# packages are plugins, scripts and wheels in the proportions of the real repository, the ones that get installed have
+# downloads for their two newest releases and depend on each other in short chains
+def make_repository(srv_dir: str, base_url: str, packages: int, releases: int, installs: int, large: int, archive_size: int) -> Repository:
+    rng = random.Random(0)
+    new: List[MutableMapping] = []
+    old: List[MutableMapping] = []
+    install: List[str] = []
+    for i in range(packages):
+        ptype = 'VSPlugin' if i % 20 < 15 else ('PyScript' if i % 20 < 19 else 'PyWheel')
+        name = 'bench{:05d}'.format(i)
+        p: MutableMapping = {'name': name, 'type': ptype, 'category': 'Benchmark', 'description': 'Synthetic package ' + name,
+                             'identifier': 'com.bench.' + name}
+        if ptype == 'VSPlugin':
+            p['namespace'] = name
+        else:
+            p['modulename'] = name
+        if ptype == 'PyWheel':
+            p['wheelname'] = name
+        bin_names = [bench_target] + rng.sample(other_targets, 3) if ptype == 'VSPlugin' else ['script' if ptype == 'PyScript' else 'wheel']
+
+        installed = i < installs
+        if installed and i % 5 > 0:
+            p['dependencies'] = ['com.bench.bench{:05d}'.format(i - 1 - j) for j in range(min(i % 5, 2))]
+        elif i >= installs and i % 7 == 0 and i > 0:
+            p['dependencies'] = ['com.bench.bench{:05d}'.format(rng.randrange(installs, i)) if i > installs else 'com.bench.bench00000']
+
+        p['releases'] = []
+        for r in range(releases, 0, -1):
+            download: Optional[Download] = None
+            if installed and r > releases - 2:
+                size = archive_size * 1024 * 1024 if i < large else 256 * 1024
+                download = make_download(rng, srv_dir, base_url, p, 'r{}'.format(r), size)
+            p['releases'].append(make_release(rng, p, 'r{}'.format(r), r, bin_names, download))
+        new.append(p)
+        old.append(dict(p, releases=p['releases'][1:]) if installed else p)
+        if installed:
+            install.append(p['identifier'])
+
+    def dump(pkgs: List[MutableMapping]) -> bytes:
+        return json.dumps({'file-format': 3, 'packages': pkgs}, indent=2).encode()
+
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('vspackages3.json', dump(new))
+    with open(os.path.join(srv_dir, 'vspackages3.zip'), 'wb') as f:
+        f.write(data.getvalue())
+    return Repository(dump(old), dump(new), install)
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        pass
+
+def start_server(srv_dir: str) -> http.server.ThreadingHTTPServer:
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=srv_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class Client:
+    def __init__(self, python: str, src: str, work_dir: str, base_url: str, jobs: int):
+        self.python = python
+        self.src = src
+        self.home = os.path.join(work_dir, 'home')
+        self.config = os.path.join(self.home, '.config', 'vsrepo') if platform.system() != 'Windows' else os.path.join(self.home, 'vsrepo')
+        self.dirs = [os.path.join(work_dir, name) for name in ('plugins', 'scripts', 'site')]
+        self.base_url = base_url
+        self.jobs = jobs
+        os.makedirs(self.config, exist_ok=True)
+
+    # removes the definitions when data is None
+    def write_definitions(self, data: Optional[bytes]) -> None:
+        path = os.path.join(self.config, 'vspackages3.json')
+        if data is not None:
+            with open(path, 'wb') as f:
+                f.write(data)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def clear_installed(self) -> None:
+        for path in self.dirs:
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+
+    def clear_state(self) -> None:
+        for fname in ('vspackages3.snapshot', 'vspackages3.update.json', 'installed.json'):
+            if os.path.exists(os.path.join(self.config, fname)):
+                os.remove(os.path.join(self.config, fname))
+
+    def clear_cache(self) -> None:
+        shutil.rmtree(os.path.join(self.config, 'cache'), ignore_errors=True)
+
+    # returns the wall time and the peak memory of the process in bytes, None where it can't be measured
+    def run(self, args: Sequence[str]) -> Tuple[float, Optional[int]]:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = self.src
+        env['PYTHONDONTWRITEBYTECODE'] = '1'
+        env['HOME'] = self.home
+        env['APPDATA'] = self.home
+        peak_file = os.path.join(self.home, 'peak')
+        cmd = [self.python, os.path.abspath(__file__), '--client', self.dirs[2], peak_file, '-t', bench_target, '-b', self.dirs[0], '-s', self.dirs[1],
+               '-j', str(self.jobs), '--url', self.base_url + 'vspackages3.zip'] + list(args)
+        start = time.perf_counter()
+        subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        with open(peak_file, 'r') as f:
+            peak = f.read()
+        return (elapsed, int(peak) if peak != 'None' else None)
+
+# Cold runs start without the snapshot, installed state and download cache and warm runs with whatever the previous run
+# left behind, a warm operation gets one untimed run first. The untimed setup of a run puts the client in the state the
+# timed command starts from.
+def time_operation(client: Client, repo: Repository, operation: str, mode: str, runs: int) -> List[Tuple[float, Optional[int]]]:
+    cold = mode == 'cold'
+    results: List[Tuple[float, Optional[int]]] = []
+    client.clear_installed()
+    client.write_definitions(repo.new)
+    if operation in ('available', 'installed'):
+        client.run(['install'] + repo.install)
+    for i in range(runs if cold else runs + 1):
+        if cold:
+            client.clear_state()
+            client.clear_cache()
+        if operation == 'update':
+            if cold:
+                client.write_definitions(None)
+            result = client.run(['update'])
+        elif operation in ('available', 'installed'):
+            result = client.run([operation])
+        elif operation == 'install':
+            client.clear_installed()
+            result = client.run(['install'] + repo.install)
+        elif operation == 'upgrade-all':
+            client.clear_installed()
+            client.write_definitions(repo.old)
+            client.run(['install'] + repo.install)
+            client.write_definitions(repo.new)
+            if cold:
+                client.clear_state()
+                client.clear_cache()
+            result = client.run(['upgrade-all'])
+        else:
+            client.clear_installed()
+            client.run(['install'] + repo.install)
+            if cold:
+                client.clear_state()
+            result = client.run(['uninstall'] + repo.install)
+        if cold or i > 0:
+            results.append(result)
+    return results
+
+def extract_ref(ref: str, dest: str) -> str:
+    from bench_startup import extract_ref
+    return extract_ref(ref, dest)
+
+def format_peak(peak: Optional[int]) -> str:
+    return '{:.1f}'.format(peak / (1024 * 1024)) if peak is not None else '-'
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) > 2 and argv[0] == '--client':
+        return run_client(argv[1], argv[2], argv[3:])
+
+    parser = argparse.ArgumentParser(description='End-to-end benchmark for the vsrepo client')
+    parser.add_argument('-o', '--operations', nargs='+', choices=operations, default=operations, help='operations to time, defaults to all of them')
+    parser.add_argument('--packages', type=int, default=1000, help='number of packages in the generated catalog')
+    parser.add_argument('--releases', type=int, default=40, help='number of releases of every package')
+    parser.add_argument('--install', type=int, default=40, help='number of packages that get installed')
+    parser.add_argument('--large', type=int, default=1, help='number of installed packages with large archives')
+    parser.add_argument('--archive-size', type=int, default=64, help='size of the large archives in MiB')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='number of parallel jobs passed to vsrepo')
+    parser.add_argument('-n', type=int, default=3, dest='runs', help='number of timed runs per operation and mode')
+    parser.add_argument('--python', default=sys.executable, help='interpreter with vapoursynth installed')
+    parser.add_argument('--ref', help='git revision to benchmark instead of the working tree')
+    parser.add_argument('--output', help='file to write the results to as json')
+    parser.add_argument('--compare', help='results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    baseline: MutableMapping = {}
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = {(r['operation'], r['mode']): r for r in json.load(f)['results']}
+
+    results: List[MutableMapping] = []
+    with tempfile.TemporaryDirectory(prefix='vsrbench') as tmpdir:
+        src = extract_ref(args.ref, tmpdir) if args.ref is not None else os.path.join(repo_dir, 'src')
+        srv_dir = os.path.join(tmpdir, 'srv')
+        os.makedirs(srv_dir)
+        server = start_server(srv_dir)
+        base_url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+        start = time.perf_counter()
+        repo = make_repository(srv_dir, base_url, args.packages, args.releases, args.install, args.large, args.archive_size)
+        print('Generated {} packages with {} releases each, {} installable, in {:.1f}s'.format(args.packages, args.releases, len(repo.install), time.perf_counter() - start))
+
+        client = Client(args.python, src, os.path.join(tmpdir, 'work'), base_url, args.jobs)
+        print('{:12s} {:5s} {:>9s} {:>11s} {:>10s} {:>8s}'.format('Operation', 'Mode', 'Min (s)', 'Median (s)', 'Peak (MiB)', 'Change'))
+        try:
+            for operation in args.operations:
+                for mode in ('cold', 'warm'):
+                    try:
+                        runs = time_operation(client, repo, operation, mode, args.runs)
+                    except subprocess.CalledProcessError:
+                        print('{:12s} {:5s} {:>9s}'.format(operation, mode, 'failed'))
+                        continue
+                    timings = [run[0] for run in runs]
+                    peaks = [run[1] for run in runs if run[1] is not None]
+                    result = {'operation': operation, 'mode': mode, 'timings': timings, 'min': min(timings), 'median': statistics.median(timings),
+                              'peak_rss': max(peaks) if peaks else None}
+                    results.append(result)
+                    change = ''
+                    if (operation, mode) in baseline:
+                        change = '{:+.0f}%'.format((result['median'] / baseline[(operation, mode)]['median'] - 1) * 100)
+                    print('{:12s} {:5s} {:9.3f} {:11.3f} {:>10s} {:>8s}'.format(operation, mode, result['min'], result['median'], format_peak(result['peak_rss']), change))
+        finally:
+            server.shutdown()
+
+    if args.output is not None:
+        meta = {'ref': args.ref, 'python': platform.python_version(), 'platform': platform.platform(), 'packages': args.packages, 'releases': args.releases,
+                'install': args.install, 'large': args.large, 'archive_size': args.archive_size, 'jobs': args.jobs, 'runs': args.runs}
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+##    MIT License
+##
+##    Copyright (c) 2018-2026 Fredrik Mellbin
+##
+##    Permission is hereby granted, free of charge, to any person obtaining a copy
+##    of this software and associated documentation files (the "Software"), to deal
+##    in the Software without restriction, including without limitation the rights
+##    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+##    copies of the Software, and to permit persons to whom the Software is
+##    furnished to do so, subject to the following conditions:
+##
+##    The above copyright notice and this permission notice shall be included in all
+##    copies or substantial portions of the Software.
+##
+##    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+##    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+##    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+##    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+##    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+##    SOFTWARE.
+
+# Compares the archive extraction backends on a large 7z archive.
+#
+# By default a solid archive is generated with members that compress about as well as model weights do, pass --archive
+# to use a real one such as a vs-mlrt model package instead. The per member `7z e -so` loop vsrepo used to fall back to
+# is timed as well for reference.
+#
+#     python benchmarks/bench_extract.py --size 1024 --members 16
+#     python benchmarks/bench_extract.py --archive models.7z
+
+import argparse
+import os
+import os.path
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional, Sequence
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from vsrepo import archive
+
+def make_member(rng: random.Random, size: int) -> bytes:
+    # random bytes mixed with repeated runs, roughly 50% compression with lzma
+    chunks: List[bytes] = []
+    pool = rng.randbytes(1024 * 1024)
+    total = 0
+    while total < size:
+        chunk = rng.randbytes(4096) if rng.random() < 0.5 else pool[rng.randrange(0, len(pool) - 4096):][:4096]
+        chunks.append(chunk)
+        total += len(chunk)
+    return b''.join(chunks)[:size]
+
+def make_archive(path: str, cmd7zip_path: Optional[str], size: int, members: int) -> None:
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory(prefix='vsrbench') as srcdir:
+        names: List[str] = []
+        for i in range(members):
+            name = 'models/model{:03d}.onnx'.format(i)
+            os.makedirs(os.path.join(srcdir, 'models'), exist_ok=True)
+            with open(os.path.join(srcdir, name), 'wb') as f:
+                f.write(make_member(rng, size // members))
+            names.append(name)
+        if cmd7zip_path is not None:
+            subprocess.run([cmd7zip_path, 'a', '-t7z', '-mx=5', '-mmt=on', path] + names, cwd=srcdir, stdout=subprocess.DEVNULL, check=True)
+        else:
+            import py7zr
+            with py7zr.SevenZipFile(path, 'w') as zf:
+                for name in names:
+                    zf.write(os.path.join(srcdir, name), name)
+
+def list_members(path: str) -> List[str]:
+    import py7zr
+    with py7zr.SevenZipFile(path, 'r') as zf:
+        return [info.filename for info in zf.list() if not info.is_directory]
+
+def extract_per_member(cmd7zip_path: str, path: str, names: Sequence[str], staging_dir: str) -> archive.StagedFiles:
+    staged: archive.StagedFiles = {}
+    for name in names:
+        member_path = os.path.join(staging_dir, str(len(staged)))
+        with open(member_path, 'wb') as f:
+            subprocess.run([cmd7zip_path, 'e', '-so', path, name], stdout=f, stderr=subprocess.DEVNULL, check=True)
+        staged[name] = (member_path, '', os.path.getsize(member_path))
+    return staged
+
+def time_backend(backend: archive.ExtractionBackend, path: str, names: Sequence[str], runs: int, tmpdir: str) -> List[float]:
+    timings: List[float] = []
+    for _ in range(runs):
+        staging_dir = tempfile.mkdtemp(prefix='staging', dir=tmpdir)
+        start = time.perf_counter()
+        backend(path, names, staging_dir)
+        timings.append(time.perf_counter() - start)
+        shutil.rmtree(staging_dir)
+    return timings
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Extraction backend benchmark for vsrepo')
+    parser.add_argument('--archive', help='7z archive to extract instead of a generated one')
+    parser.add_argument('--size', type=int, default=256, help='total size of the generated archive members in MiB')
+    parser.add_argument('--members', type=int, default=8, help='number of members in the generated archive')
+    parser.add_argument('--7z', default='7z', dest='cmd7zip_path', help='7-Zip binary to use')
+    parser.add_argument('-n', type=int, default=3, dest='runs', help='number of timed runs per backend')
+    args = parser.parse_args(argv)
+
+    cmd7zip_path: Optional[str] = args.cmd7zip_path if shutil.which(args.cmd7zip_path) is not None else None
+    if cmd7zip_path is None:
+        print('No 7z binary found, only py7zr will be timed')
+
+    with tempfile.TemporaryDirectory(prefix='vsrbench') as tmpdir:
+        path = args.archive
+        if path is None:
+            path = os.path.join(tmpdir, 'bench.7z')
+            make_archive(path, cmd7zip_path, args.size * 1024 * 1024, args.members)
+        names = list_members(path)
+        print('{}: {} members, {:.1f} MiB compressed'.format(os.path.basename(path), len(names), os.path.getsize(path) / (1024 * 1024)))
+
+        backends = [(name, backend) for name, backend in archive.get_extraction_backends('7z', cmd7zip_path)]
+        if cmd7zip_path is not None:
+            backends.append(('7z e -so per member', lambda path, names, staging_dir: extract_per_member(cmd7zip_path, path, names, staging_dir)))
+
+        print('{:22s} {:>10s} {:>12s}'.format('Backend', 'Min (s)', 'Median (s)'))
+        for name, backend in backends:
+            timings = time_backend(backend, path, names, args.runs, tmpdir)
+            print('{:22s} {:10.2f} {:12.2f}'.format(name, min(timings), statistics.median(timings)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+##    MIT License
+##
+##    Copyright (c) 2018-2026 Fredrik Mellbin
+##
+##    Permission is hereby granted, free of charge, to any person obtaining a copy
+##    of this software and associated documentation files (the "Software"), to deal
+##    in the Software without restriction, including without limitation the rights
+##    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+##    copies of the Software, and to permit persons to whom the Software is
+##    furnished to do so, subject to the following conditions:
+##
+##    The above copyright notice and this permission notice shall be included in all
+##    copies or substantial portions of the Software.
+##
+##    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+##    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+##    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+##    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+##    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+##    SOFTWARE.
+
+# Measures how long short vsrepo invocations take from process start to exit.
+#
+# Every operation runs in a fresh interpreter so import and definition loading costs are included. Pass --ref to
+# run the same operations against the sources of another git revision for comparison, for example:
+#
+#     python benchmarks/bench_startup.py --ref HEAD~1
+
+import argparse
+import os
+import os.path
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from typing import List, Optional
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def extract_ref(ref: str, dest: str) -> str:
+    archive = subprocess.run(['git', '-C', repo_dir, 'archive', '--format=tar', ref, 'src'], stdout=subprocess.PIPE, check=True).stdout
+    tarpath = os.path.join(dest, 'src.tar')
+    with open(tarpath, 'wb') as f:
+        f.write(archive)
+    with tarfile.open(tarpath) as tf:
+        tf.extractall(dest, filter='data')
+    return os.path.join(dest, 'src')
+
+def time_operation(python: str, src: str, operation: List[str], runs: int) -> List[float]:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = src
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    # one untimed run so the bytecode of the standard library is cached
+    subprocess.run([python, '-m', 'vsrepo.vsrepo'] + operation, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    timings: List[float] = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([python, '-m', 'vsrepo.vsrepo'] + operation, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Startup time benchmark for vsrepo')
+    parser.add_argument('operations', nargs='*', default=['paths', 'installed'], help='operations to time, defaults to paths and installed')
+    parser.add_argument('-n', type=int, default=10, dest='runs', help='number of timed runs per operation')
+    parser.add_argument('--python', default=sys.executable, help='interpreter with vapoursynth installed')
+    parser.add_argument('--ref', help='git revision to compare the working tree against')
+    args = parser.parse_args(argv)
+
+    sources = [('working tree', os.path.join(repo_dir, 'src'))]
+    with tempfile.TemporaryDirectory(prefix='vsrbench') as tmpdir:
+        if args.ref is not None:
+            sources.insert(0, (args.ref, extract_ref(args.ref, tmpdir)))
+
+        print('{:20s} {:12s} {:>10s} {:>10s}'.format('Source', 'Operation', 'Min (ms)', 'Median (ms)'))
+        for label, src in sources:
+            for operation in args.operations:
+                try:
+                    timings = time_operation(args.python, src, operation.split(), args.runs)
+                except subprocess.CalledProcessError:
+                    print('{:20s} {:12s} {:>10s} {:>10s}'.format(label, operation, 'failed', ''))
+                    continue
+                print('{:20s} {:12s} {:10.1f} {:10.1f}'.format(label, operation, min(timings) * 1000, statistics.median(timings) * 1000))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
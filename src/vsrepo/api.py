@@ -0,0 +1,105 @@
+##    MIT License
+##
+##    Copyright (c) 2018-2026 Fredrik Mellbin
+##
+##    Permission is hereby granted, free of charge, to any person obtaining a copy
+##    of this software and associated documentation files (the "Software"), to deal
+##    in the Software without restriction, including without limitation the rights
+##    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+##    copies of the Software, and to permit persons to whom the Software is
+##    furnished to do so, subject to the following conditions:
+##
+##    The above copyright notice and this permission notice shall be included in all
+##    copies or substantial portions of the Software.
+##
+##    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+##    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+##    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+##    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+##    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+##    SOFTWARE.
+
+# Library interface for using vsrepo from other python code. The functions mirror the command line operations but return
+# their results instead of only printing them. Call init() first to use anything other than the default target and paths.
+#
+#     from vsrepo import api
+#     result = api.install(['ffms2', 'havsfunc'])
+#     print(result.installed, result.failed)
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from vsrepo import vsrepo
+from vsrepo.vsrepo import InstallPlan, InstallResult, MirrorResult, PackageStatus, Paths, PlanEntry, SyncResult, VerifyResult, VSRepoError
+
+__all__ = ['InstallPlan', 'InstallResult', 'MirrorResult', 'PackageStatus', 'Paths', 'PlanEntry', 'SyncResult', 'VerifyResult', 'VSRepoError', 'init', 'paths', 'installed',
+           'available', 'plan_install', 'plan_upgrade', 'install', 'upgrade', 'upgrade_all', 'uninstall', 'update', 'verify', 'mirror', 'freeze', 'plan_sync', 'sync']
+
+def init(target: Optional[str] = None, binary_path: Optional[str] = None, script_path: Optional[str] = None, definitions_path: Optional[str] = None,
+         skip_deps: bool = False, jobs: int = 1, cache_size: int = 4096, timeout: float = 60.0, retries: int = 3,
+         url: Optional[str] = None, link_mode: str = 'auto', mirror: Optional[str] = None, compile_bytecode: bool = False) -> None:
+    vsrepo.init(target=target, binary_path=binary_path, script_path=script_path, definitions_path=definitions_path, skip_deps=skip_deps, jobs=jobs, cache_size=cache_size,
+                timeout=timeout, retries=retries, url=url, link_mode=link_mode, mirror=mirror, compile_bytecode=compile_bytecode)
+
+def paths() -> Paths:
+    return vsrepo.get_paths()
+
+# identifier -> installed version, the version is 'Unknown' for files that don't match any known release
+def installed() -> Dict[str, str]:
+    vsrepo.load_package_list()
+    vsrepo.detect_installed_packages()
+    return dict(vsrepo.installed_packages)
+
+def available() -> List[PackageStatus]:
+    vsrepo.load_package_list()
+    vsrepo.detect_installed_packages()
+    return [vsrepo.get_package_status(p) for p in vsrepo.package_list or []]
+
+# plan.entries maps identifier -> PlanEntry in install order, the list holds the packages that can't be installed
+def plan_install(packages: Sequence[str]) -> Tuple[InstallPlan, List[str]]:
+    return vsrepo.plan_install(packages)
+
+# upgrades all installed packages when packages is None
+def plan_upgrade(packages: Optional[Sequence[str]], force: bool = False) -> Tuple[InstallPlan, List[str]]:
+    return vsrepo.plan_upgrade(packages, force)
+
+def install(packages: Sequence[str]) -> InstallResult:
+    return vsrepo.install_packages(packages)
+
+def upgrade(packages: Sequence[str], force: bool = False) -> InstallResult:
+    return vsrepo.upgrade_packages(packages, force)
+
+def upgrade_all(force: bool = False) -> InstallResult:
+    return vsrepo.upgrade_packages(None, force)
+
+# returns (identifier, version) for every package that was removed
+def uninstall(packages: Sequence[str]) -> List[Tuple[str, str]]:
+    return vsrepo.uninstall_packages(packages)
+
+# returns True if new definitions were downloaded
+def update() -> bool:
+    vsrepo.ensure_init()
+    return vsrepo.update_package_definition(vsrepo.definitions_url)
+
+# hashes every installed file again and reports the ones that are missing, modified or not part of any installed package
+def verify() -> VerifyResult:
+    return vsrepo.verify_packages()
+
+# downloads every release the packages and their dependencies could install on the targets into the mirror dir, all
+# packages are mirrored when packages is empty and 'all' as a target stands for every target in the definitions
+def mirror(packages: Sequence[str], targets: Sequence[str], path: str) -> MirrorResult:
+    vsrepo.ensure_init()
+    return vsrepo.mirror_packages(packages, targets, path)
+
+# writes the installed packages with their versions and hashes to a lockfile, returns the identifiers of the packages
+# that were left out because their version is unknown
+def freeze(path: str) -> List[str]:
+    return vsrepo.freeze_packages(path)
+
+# the plan installing the locked versions, the identifiers of the installed packages missing from the lockfile and the
+# packages that can't be synced
+def plan_sync(path: str) -> Tuple[InstallPlan, List[str], List[str]]:
+    return vsrepo.plan_sync(path)
+
+def sync(path: str) -> SyncResult:
+    return vsrepo.sync_packages(path)
@@ -0,0 +1,162 @@
+##    MIT License
+##
+##    Copyright (c) 2018-2026 Fredrik Mellbin
+##
+##    Permission is hereby granted, free of charge, to any person obtaining a copy
+##    of this software and associated documentation files (the "Software"), to deal
+##    in the Software without restriction, including without limitation the rights
+##    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+##    copies of the Software, and to permit persons to whom the Software is
+##    furnished to do so, subject to the following conditions:
+##
+##    The above copyright notice and this permission notice shall be included in all
+##    copies or substantial portions of the Software.
+##
+##    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+##    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+##    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+##    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+##    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+##    SOFTWARE.
+
+# Kept separate from vsrepo.py so py7zr is only imported when an archive actually has to be extracted
+
+import functools
+import hashlib
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+import zipfile
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union, override
+
+import py7zr
+
+
+# Members are written to files in a staging directory while they're hashed so memory use doesn't depend on their size.
+# Every backend returns name -> (staged path, sha256, size) for the requested members.
+StagedFiles = Dict[str, Tuple[str, str, int]]
+
+class StagingIO(py7zr.Py7zIO):
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._hasher = hashlib.sha256()
+        self._size = 0
+
+    @override
+    def write(self, s: Union[bytes, bytearray]) -> int:
+        self._file.write(s)
+        self._hasher.update(s)
+        self._size += len(s)
+        return len(s)
+
+    @override
+    def read(self, size: Optional[int] = None) -> bytes:
+        return b''
+
+    @override
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._size
+
+    @override
+    def flush(self) -> None:
+        self._file.flush()
+
+    @override
+    def size(self) -> int:
+        return self._size
+
+    def close(self) -> Tuple[str, str, int]:
+        self._file.close()
+        return (self.path, self._hasher.hexdigest(), self._size)
+
+class StagingFactory(py7zr.WriterFactory):
+    def __init__(self, staging_dir: str):
+        self.staging_dir = staging_dir
+        self.products: Dict[str, StagingIO] = {}
+
+    @override
+    def create(self, filename: str) -> py7zr.Py7zIO:
+        product = StagingIO(os.path.join(self.staging_dir, str(len(self.products))))
+        self.products[filename] = product
+        return product
+
+# An extraction backend takes the path of an archive, the member names to extract and the staging directory to put them
+# in. Every backend extracts everything in a single pass over the archive and raises if any member can't be extracted so
+# the next backend for the archive type can be tried.
+ExtractionBackend = Callable[[str, Sequence[str], str], StagedFiles]
+
+# uses the multithreaded decoder of a 7-Zip command line binary, members are extracted directly into the staging directory
+def extract_native_7z(cmd7zip_path: str, path: str, names: Sequence[str], staging_dir: str) -> StagedFiles:
+    outdir = tempfile.mkdtemp(prefix='7z', dir=staging_dir)
+    listfile = os.path.join(staging_dir, 'files.txt')
+    with open(listfile, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(names) + '\n')
+    # -spd so member names are never treated as wildcards
+    result = subprocess.run([cmd7zip_path, 'x', '-y', '-spd', '-mmt=on', '-scsUTF-8', '-o' + outdir, path, '@' + listfile],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    os.remove(listfile)
+    if result.returncode != 0:
+        shutil.rmtree(outdir, ignore_errors=True)
+        raise Exception(cmd7zip_path + ' exited with code ' + str(result.returncode) + ': ' + ' '.join(result.stderr.decode('utf-8', 'replace').split()))
+    staged: StagedFiles = {}
+    for name in names:
+        member_path = os.path.join(outdir, name)
+        with open(member_path, 'rb') as f:
+            staged[name] = (member_path, hashlib.file_digest(f, 'sha256').hexdigest(), os.fstat(f.fileno()).st_size)
+    return staged
+
+def extract_py7zr(path: str, names: Sequence[str], staging_dir: str) -> StagedFiles:
+    factory = StagingFactory(staging_dir)
+    try:
+        with py7zr.SevenZipFile(path, 'r') as archive:
+            archive.extract(targets=list(names), factory=factory)
+    finally:
+        staged = {name: product.close() for name, product in factory.products.items()}
+    for name in names:
+        if name not in staged:
+            raise Exception(name + ' not found in archive')
+    return staged
+
+def extract_zip(path: str, names: Sequence[str], staging_dir: str) -> StagedFiles:
+    staged: StagedFiles = {}
+    buffer = memoryview(bytearray(1024 * 1024))
+    with zipfile.ZipFile(path, 'r') as archive:
+        for name in names:
+            product = StagingIO(os.path.join(staging_dir, str(len(staged))))
+            try:
+                with archive.open(name) as f:
+                    while True:
+                        blocksize = f.readinto(buffer)
+                        if not blocksize:
+                            break
+                        product.write(buffer[:blocksize])
+            finally:
+                staged[name] = product.close()
+    return staged
+
+# the backends to try in order for an archive type, a native 7z binary is preferred over py7zr when it can be found
+def get_extraction_backends(archive_type: str, cmd7zip_path: Optional[str] = None) -> List[Tuple[str, ExtractionBackend]]:
+    if archive_type == '7z':
+        backends: List[Tuple[str, ExtractionBackend]] = []
+        if cmd7zip_path is not None and shutil.which(cmd7zip_path) is not None:
+            backends.append(('7z', functools.partial(extract_native_7z, cmd7zip_path)))
+        backends.append(('py7zr', extract_py7zr))
+        return backends
+    elif archive_type == 'zip':
+        return [('zipfile', extract_zip)]
+    else:
+        raise ValueError('Unknown archive type ' + archive_type)
+
+# the staging directory should be on the same filesystem as the install path so staged files can be moved into place
+def extract_members(path: str, names: Sequence[str], archive_type: str, staging_dir: str, cmd7zip_path: Optional[str] = None) -> StagedFiles:
+    errors: List[str] = []
+    for backend_name, backend in get_extraction_backends(archive_type, cmd7zip_path):
+        try:
+            return backend(path, names, staging_dir)
+        except Exception as e:
+            errors.append(backend_name + ': ' + str(e))
+    raise Exception('Extraction failed (' + '; '.join(errors) + ')')
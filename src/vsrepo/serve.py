@@ -0,0 +1,212 @@
+##    MIT License
+##
+##    Copyright (c) 2018-2026 Fredrik Mellbin
+##
+##    Permission is hereby granted, free of charge, to any person obtaining a copy
+##    of this software and associated documentation files (the "Software"), to deal
+##    in the Software without restriction, including without limitation the rights
+##    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+##    copies of the Software, and to permit persons to whom the Software is
+##    furnished to do so, subject to the following conditions:
+##
+##    The above copyright notice and this permission notice shall be included in all
+##    copies or substantial portions of the Software.
+##
+##    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+##    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+##    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+##    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+##    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+##    SOFTWARE.
+
+
+# A long running vsrepo that keeps the package definitions, the indexes and the installed state in memory and answers
+# requests on a unix socket. Every request and response is a single line of json:
+#
+#     {"op": "installed"}
+#     {"op": "available"}
+#     {"op": "install", "packages": ["ffms2", "havsfunc"]}
+#     {"op": "upgrade", "packages": ["ffms2"], "force": false}   (all installed packages when packages is left out)
+#     {"op": "uninstall", "packages": ["ffms2"]}
+#
+# answered with {"result": ...} or {"error": "..."}. Adding "refresh": true to a request reloads everything first.
+#
+# Instead of detecting the installed packages for every request the stat data of the definitions, the install state and
+# the install directories is compared with what it was when they were last loaded. Anything that adds, removes or
+# replaces a file in the directories changes their modification time, files overwritten in place aren't noticed until a
+# refresh. Installs, upgrades and uninstalls are planned from the packages already detected and keep them up to date,
+# so the directories they write to are only detected again when something else changes them or a request fails
+# halfway. Requests are handled one at a time since all of the state is module globals in vsrepo.
+
+import json
+import os
+import os.path
+import signal
+import socket
+import socketserver
+import threading
+import traceback
+from typing import MutableMapping, Optional, Tuple
+
+from vsrepo import vsrepo
+from vsrepo.vsrepo import VSRepoError
+
+request_lock = threading.Lock()
+definitions_signature: Optional[Tuple] = None
+install_signature: Optional[Tuple] = None
+state_signature: Optional[Tuple] = None
+
+def get_default_socket_path() -> str:
+    vsrepo.ensure_init()
+    return os.path.join(os.path.dirname(vsrepo.package_json_path), 'vsrepo.sock')
+
+def get_stat_signature(path: Optional[str]) -> Optional[Tuple[int, int, int]]:
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def get_install_signature() -> Tuple:
+    return tuple(get_stat_signature(path) for path in (vsrepo.plugin_path, vsrepo.py_script_path, vsrepo.site_package_dir))
+
+# brings the in memory state up to date with whatever changed on disk since the last request
+def refresh_state(full: bool = False) -> None:
+    global definitions_signature, install_signature, state_signature
+    signature = get_stat_signature(vsrepo.package_json_path)
+    if full or vsrepo.package_list is None or signature != definitions_signature:
+        vsrepo.package_list = None
+        vsrepo.package_index = None
+        vsrepo.load_package_list()
+        definitions_signature = signature
+        install_signature = None
+
+    # another vsrepo may have written the install state in the meantime
+    if full or get_stat_signature(vsrepo.installed_state_path) != state_signature:
+        vsrepo.installed_state = None
+        vsrepo.installed_state_dirty = False
+        install_signature = None
+
+    signature = get_install_signature()
+    if signature != install_signature:
+        vsrepo.detect_installed_packages()
+        install_signature = signature
+    state_signature = get_stat_signature(vsrepo.installed_state_path)
+
+def handle_request(request: MutableMapping) -> object:
+    global install_signature, state_signature
+    op = request.get('op')
+    packages = request.get('packages')
+    if op not in ('installed', 'available', 'install', 'upgrade', 'uninstall'):
+        raise ValueError(f'Unknown operation {op}')
+    if packages is not None and (not isinstance(packages, list) or not all(isinstance(name, str) for name in packages)):
+        raise ValueError('packages must be a list of names')
+    if op in ('install', 'uninstall') and not packages:
+        raise ValueError(f'The {op} request requires packages')
+
+    refresh_state(bool(request.get('refresh', False)))
+
+    if op == 'installed':
+        return dict(vsrepo.installed_packages)
+    elif op == 'available':
+        return [vsrepo.get_package_status(p)._asdict() for p in vsrepo.package_list or []]
+
+    for name in packages or []:
+        vsrepo.get_package_from_name(name)
+    install_signature = None
+    result: object
+    if op == 'install':
+        result = vsrepo.install_packages(packages, detect=False)._asdict()
+    elif op == 'upgrade':
+        result = vsrepo.upgrade_packages(packages, bool(request.get('force', False)), detect=False)._asdict()
+    else:
+        result = vsrepo.uninstall_packages(packages, detect=False)
+    install_signature = get_install_signature()
+    state_signature = get_stat_signature(vsrepo.installed_state_path)
+    return result
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for line in self.rfile:
+            if len(line.strip()) == 0:
+                continue
+            response: MutableMapping
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('Requests must be json objects')
+                with request_lock:
+                    response = {'result': handle_request(request)}
+            except (VSRepoError, ValueError) as e:
+                response = {'error': str(e)}
+            except Exception as e:
+                traceback.print_exc()
+                response = {'error': '{}: {}'.format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# a socket file that nothing accepts connections on is left over from a daemon that didn't exit cleanly
+def remove_stale_socket(path: str) -> None:
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(path)
+            return
+    raise VSRepoError(f'Another vsrepo is already serving on {path}')
+
+def serve(path: Optional[str] = None) -> None:
+    if not hasattr(socket, 'AF_UNIX'):
+        raise VSRepoError('Serving requires unix socket support')
+    if path is None:
+        path = get_default_socket_path()
+    # without definitions every request fails until they've been downloaded
+    try:
+        refresh_state()
+    except VSRepoError as e:
+        print(e)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    remove_stale_socket(path)
+    # only the user running the daemon may install packages through it
+    umask = os.umask(0o177)
+    try:
+        server = Server(path, RequestHandler)
+    finally:
+        os.umask(umask)
+
+    def stop(signum, frame) -> None:
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+
+    print(f'Serving on {path}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        with request_lock:
+            vsrepo.save_installed_state()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# sends one request to a running daemon and returns the decoded response
+def send_request(request: MutableMapping, path: Optional[str] = None) -> MutableMapping:
+    if path is None:
+        path = get_default_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with s.makefile('rb') as f:
+            return json.loads(f.readline())
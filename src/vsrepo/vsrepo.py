@@ -21,29 +21,36 @@
 ##    SOFTWARE.
 
 import argparse
+import atexit
 import base64
 import binascii
+import contextlib
 import csv
 import email.utils
 import glob
 import hashlib
+import http.client
 import importlib.util as imputil
 import io
 import json
+import marshal
 import os
 import os.path
 import platform
 import re
-import subprocess
+import shutil
+import stat
 import sys
 import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
 import zipfile
-import py7zr
-import vapoursynth
 import site
-import tqdm
-from typing import Iterator, List, MutableMapping, Optional, Tuple, override
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from typing import BinaryIO, Iterator, List, MutableMapping, NamedTuple, Optional, Sequence, Tuple
 from pathlib import Path
 
 try:
@@ -82,92 +89,1031 @@ def detect_target() -> Optional[str]:
             return 'darwin-aarch64'
     return None
 
-parser = argparse.ArgumentParser(description='A simple VapourSynth package manager')
-parser.add_argument('operation', choices=['install', 'update', 'upgrade', 'upgrade-all', 'uninstall', 'installed', 'available', 'paths', "genstubs", "gendistinfo"])
-parser.add_argument('package', nargs='*', help='identifier, namespace or module to install, upgrade or uninstall')
-parser.add_argument('-f', action='store_true', dest='force', help='force upgrade for packages where the current version is unknown')
-parser.add_argument('-d', action='store_true', dest='skip_deps', help='skip installing dependencies')
-parser.add_argument('-t', default=detect_target(), dest='target', help='binaries to install, defaults to python\'s architecture')
-args = parser.parse_args()
+class VSRepoError(Exception):
+    pass
 
-if args.target == None:
-    print('Target not supported or auto-detect failed (use -t parameter)')
-    sys.exit(1)
+# Everything below is set up by init() instead of at import time so the module can be used as a library and
+# operations only pay for the imports and files they actually need.
+options = argparse.Namespace(target=None, skip_deps=False, jobs=1, cache_size=4096, timeout=60.0, retries=3, link_mode='auto', compile_bytecode=False)
+definitions_url = 'https://www.vapoursynth.com/vsrepo/vspackages3.zip'
+link_modes = ('auto', 'reflink', 'hardlink', 'copy')
+initialized = False
+
+vs_target: Optional[str] = None
+plugin_path: str = ''
+py_script_path: str = ''
+site_package_dir: Optional[str] = None
+package_json_path: str = ''
+cache_path: str = ''
+installed_state_path: str = ''
+cmd7zip_path: str = '7z'
+mirror_location: Optional[str] = None
+
+def get_default_package_json_path() -> str:
+    if is_portable():
+        return os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(file_dirname))), 'vspackages3.json')
+    elif is_windows:
+        return os.path.join(str(os.getenv("APPDATA")), 'vsrepo', 'vspackages3.json')
+    else:
+        return os.path.join(str(os.getenv("HOME")), '.config', 'vsrepo', 'vspackages3.json')
 
-vs_target = args.target
+def get_cmd7zip_path() -> str:
+    if is_windows:
+        path = os.path.join(file_dirname, '7z.exe')
+        if not os.path.isfile(path):
+            try:
+                with winreg.OpenKeyEx(winreg.HKEY_LOCAL_MACHINE, 'SOFTWARE\\7-Zip', reserved=0, access=winreg.KEY_READ) as regkey:
+                    path = os.path.join(winreg.QueryValueEx(regkey, 'Path')[0], '7z.exe')
+            except:
+                path = '7z.exe'
+        return path
+    else:
+        return '7z'
+
+def init(target: Optional[str] = None, binary_path: Optional[str] = None, script_path: Optional[str] = None, definitions_path: Optional[str] = None,
+         skip_deps: bool = False, jobs: int = 1, cache_size: int = 4096, timeout: float = 60.0, retries: int = 3, url: Optional[str] = None,
+         link_mode: str = 'auto', mirror: Optional[str] = None, compile_bytecode: bool = False) -> None:
+    global initialized, definitions_url, vs_target, plugin_path, py_script_path, site_package_dir, package_json_path, cache_path, installed_state_path, cmd7zip_path
+    global package_list, package_index, installed_state, mirror_location, mirror_manifest, cache_access
+    save_cache_access()
+    if target is None:
+        target = detect_target()
+    if target is None:
+        raise VSRepoError('Target not supported or auto-detect failed (use -t parameter)')
+    if jobs < 1:
+        raise VSRepoError('The number of jobs must be at least 1')
+    if link_mode not in link_modes:
+        raise VSRepoError('The link mode must be one of ' + ', '.join(link_modes))
+    if timeout <= 0 or retries < 0:
+        raise VSRepoError('The timeout must be positive and the number of retries can\'t be negative')
+
+    import vapoursynth
+
+    options.target = target
+    options.skip_deps = skip_deps
+    options.jobs = jobs
+    options.cache_size = cache_size
+    options.timeout = timeout
+    options.retries = retries
+    options.link_mode = link_mode
+    options.compile_bytecode = compile_bytecode
+    mirror_location = get_location_url(mirror, True) if mirror is not None else None
+    mirror_manifest = None
+    if url is not None:
+        definitions_url = get_location_url(url)
+    elif mirror_location is not None:
+        definitions_url = urllib.parse.urljoin(mirror_location, 'vspackages3.zip')
+    vs_target = target
+
+    plugin_path = binary_path if binary_path is not None else os.path.join(vapoursynth.get_plugin_dir(), 'vsrepo')
+    site_package_dir = os.path.dirname(os.path.dirname(vapoursynth.__file__)) if is_venv() or is_portable() else site.getusersitepackages()
+    py_script_path = script_path if script_path is not None else site_package_dir
+
+    package_json_path = definitions_path if definitions_path is not None else get_default_package_json_path()
+    cache_path = os.path.join(os.path.dirname(package_json_path), 'cache')
+    installed_state_path = os.path.join(os.path.dirname(package_json_path), 'installed.json')
+    cmd7zip_path = get_cmd7zip_path()
+
+    package_list = None
+    package_index = None
+    installed_state = None
+    cache_access = None
+    installed_packages.clear()
+    initialized = True
+
+def ensure_init() -> None:
+    if not initialized:
+        init()
+
+# Phases of a run are recorded as spans for --timings and --trace once enable_timings() has been called, until then
+# timed() does nothing. Spans belonging to a package carry its identifier so the summary can break the time down
+# per package, the trace is written in the Chrome trace event format that Perfetto and chrome://tracing open.
+timing_spans: Optional[List[Tuple[str, str, int, float, float, MutableMapping]]] = None # (name, category, thread, start, end, args)
+timing_threads: MutableMapping = {}
+timing_lock = threading.Lock()
+timing_start = 0.0
+
+def enable_timings() -> None:
+    global timing_spans, timing_start
+    timing_spans = []
+    timing_threads.clear()
+    timing_start = time.perf_counter()
+
+# also works as a decorator for functions that are one phase as a whole
+@contextlib.contextmanager
+def timed(name: str, category: str, **args) -> Iterator[None]:
+    if timing_spans is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        thread = threading.current_thread()
+        with timing_lock:
+            timing_spans.append((name, category, thread.ident or 0, start, end, args))
+            timing_threads[thread.ident or 0] = thread.name
+
+def print_timings() -> None:
+    if timing_spans is None:
+        return
+    categories: MutableMapping = {}
+    packages: MutableMapping = {}
+    for _, category, _, start, end, args in timing_spans:
+        count, total = categories.get(category, (0, 0.0))
+        categories[category] = (count + 1, total + end - start)
+        if 'package' in args:
+            package = packages.setdefault(args['package'], {})
+            package[category] = package.get(category, 0.0) + end - start
+    print('Timings, {:.2f}s in total (phases running in parallel can add up to more):'.format(time.perf_counter() - timing_start))
+    for category, (count, total) in categories.items():
+        print('{:20s} {:6d} {:10.3f}s'.format(category, count, total))
+    if len(packages) > 0:
+        package_print_string = '{:40s} {:>10s} {:>10s} {:>10s}'
+        print(package_print_string.format('Package', 'Download', 'Extract', 'Write'))
+        for identifier, package in packages.items():
+            print(package_print_string.format(identifier, *('{:.3f}s'.format(package[category]) if category in package else '-' for category in ('download', 'extract', 'write'))))
+
+def write_trace(path: str) -> None:
+    if timing_spans is None:
+        return
+    pid = os.getpid()
+    events: List[MutableMapping] = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}} for tid, name in timing_threads.items()]
+    for name, category, tid, start, end, args in timing_spans:
+        events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': (start - timing_start) * 1000000, 'dur': (end - start) * 1000000, 'pid': pid, 'tid': tid, 'args': args})
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
 
-plugin_path =  os.path.join(vapoursynth.get_plugin_dir(), 'vsrepo')
+installed_packages: MutableMapping = {}
+download_cache: MutableMapping = {}
+download_locks: MutableMapping = {}
+download_locks_lock = threading.Lock()
+
+class DownloadProgress:
+    # a single progress bar shared by all downloads running in parallel, the total grows as sizes become known
+    def __init__(self, desc: str):
+        import tqdm
+        self._lock = threading.Lock()
+        self._bar = tqdm.tqdm(total=0, unit='B', unit_scale=True, unit_divisor=1024, desc=desc)
+
+    def add_total(self, size: int) -> None:
+        with self._lock:
+            self._bar.total += size
+            self._bar.refresh()
+
+    def update(self, size: int) -> None:
+        with self._lock:
+            self._bar.update(size)
+
+    def close(self) -> None:
+        self._bar.close()
+
+# All downloads of a run share one HTTP transport. Connections are kept alive and reused per scheme, host, port and
+# proxy, redirects are remembered for the rest of the run so repeated requests for the same release url go straight to
+# the final location, and requests that fail to connect or get a 5xx or 429 response are retried with a growing delay.
+# Urls with other schemes such as file:// are passed on to urllib.
+class HTTPConnectionPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle: MutableMapping = {}
+
+    # returns the connection and whether it has been used before
+    def acquire(self, key: Tuple) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return (idle.pop(), True)
+        return (make_http_connection(*key), False)
+
+    def release(self, key: Tuple, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+http_pool = HTTPConnectionPool()
+redirect_cache: MutableMapping = {}
+redirect_cache_lock = threading.Lock()
+
+atexit.register(http_pool.close)
+
+def make_http_connection(scheme: str, host: str, port: int, proxy: Optional[Tuple[str, int, Optional[str]]]) -> http.client.HTTPConnection:
+    if scheme == 'https':
+        if proxy is None:
+            return http.client.HTTPSConnection(host, port, timeout=options.timeout)
+        conn = http.client.HTTPSConnection(proxy[0], proxy[1], timeout=options.timeout)
+        conn.set_tunnel(host, port, headers={'Proxy-Authorization': proxy[2]} if proxy[2] is not None else None)
+        return conn
+    elif proxy is None:
+        return http.client.HTTPConnection(host, port, timeout=options.timeout)
+    else:
+        return http.client.HTTPConnection(proxy[0], proxy[1], timeout=options.timeout)
 
-if (args.operation in ['install', 'upgrade', 'uninstall']) and ((args.package is None) or len(args.package) == 0):
-    print('Package argument required for install, upgrade and uninstall operations')
-    sys.exit(1)
+# the proxy from the environment to use for a url, same as urllib would, as host, port and the Proxy-Authorization
+# header for the credentials in the proxy url
+def get_http_proxy(scheme: str, host: str) -> Optional[Tuple[str, int, Optional[str]]]:
+    proxy = urllib.request.getproxies().get(scheme)
+    if proxy is None or urllib.request.proxy_bypass(host):
+        return None
+    parts = urllib.parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+    auth: Optional[str] = None
+    if parts.username is not None:
+        credentials = urllib.parse.unquote(parts.username) + ':' + urllib.parse.unquote(parts.password or '')
+        auth = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+    return (parts.hostname or '', parts.port or 80, auth)
+
+class PooledResponse:
+    def __init__(self, url: str, response: http.client.HTTPResponse, conn: http.client.HTTPConnection, key: Tuple):
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+        self._response = response
+        self._conn: Optional[http.client.HTTPConnection] = conn
+        self._key = key
+
+    def readinto(self, b) -> int:
+        return self._response.readinto(b)
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        return self._response.read(amt)
+
+    # the connection can only be reused when the whole body was read
+    def close(self) -> None:
+        if self._conn is None:
+            return
+        if self._response.isclosed():
+            http_pool.release(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+    def __enter__(self) -> 'PooledResponse':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+def get_retry_delay(attempt: int) -> float:
+    return min(0.5 * 2 ** attempt, 10.0)
+
+def http_request(url: str, headers: Optional[MutableMapping] = None, method: str = 'GET'):
+    request_headers = {'User-Agent': 'VSRepo'}
+    if headers is not None:
+        request_headers.update(headers)
+    if urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+        return urllib.request.urlopen(urllib.request.Request(url, headers=request_headers, method=method), timeout=options.timeout)
+
+    with redirect_cache_lock:
+        target = redirect_cache.get(url, url)
+    attempt = 0
+    redirects = 0
+    while True:
+        parts = urllib.parse.urlsplit(target)
+        proxy = get_http_proxy(parts.scheme, parts.hostname or '')
+        key = (parts.scheme, parts.hostname or '', parts.port or (443 if parts.scheme == 'https' else 80), proxy)
+        # plain http through a proxy asks for the absolute url
+        path = target if (proxy is not None and parts.scheme == 'http') else urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        conn, reused = http_pool.acquire(key)
+        try:
+            # https sends the proxy credentials with the CONNECT instead
+            if proxy is not None and proxy[2] is not None and parts.scheme == 'http':
+                conn.request(method, path, headers=dict(request_headers, **{'Proxy-Authorization': proxy[2]}))
+            else:
+                conn.request(method, path, headers=request_headers)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            # the server may have closed an idle connection in the meantime, that doesn't count as a failed attempt
+            if reused:
+                continue
+            if attempt >= options.retries:
+                raise
+            attempt += 1
+            time.sleep(get_retry_delay(attempt))
+            continue
 
-if is_portable:
-    package_json_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(file_dirname))), 'vspackages3.json')
-elif is_windows:
-    package_json_path = os.path.join(str(os.getenv("APPDATA")), 'vsrepo', 'vspackages3.json')
-else:
-    package_json_path = os.path.join(str(os.getenv("HOME")), '.config', 'vsrepo', 'vspackages3.json')
+        if response.status in (301, 302, 303, 307, 308) and response.headers['location'] is not None and redirects < 10:
+            response.read()
+            http_pool.release(key, conn)
+            target = urllib.parse.urljoin(target, response.headers['location'])
+            redirects += 1
+            continue
 
-site_package_dir = os.path.dirname(os.path.dirname(vapoursynth.__file__)) if is_venv() or is_portable() else site.getusersitepackages()
-py_script_path = site_package_dir
+        if response.status >= 300:
+            response.read()
+            http_pool.release(key, conn)
+            if (response.status >= 500 or response.status == 429) and attempt < options.retries:
+                attempt += 1
+                time.sleep(get_retry_delay(attempt))
+                continue
+            # a remembered redirect target may have expired, ask the original url once more before giving up
+            with redirect_cache_lock:
+                expired = (response.status >= 400) and (redirect_cache.pop(url, None) is not None)
+            if expired:
+                target = url
+                redirects = 0
+                continue
+            raise urllib.error.HTTPError(target, response.status, response.reason, response.headers, None)
+
+        if target != url:
+            with redirect_cache_lock:
+                redirect_cache[url] = target
+        return PooledResponse(target, response, conn, key)
+
+# streams the response into dest through a single reused buffer and returns the sha256 of the data
+def read_response(urlreq, url: str, dest: BinaryIO, desc: Optional[str] = None, progress: Optional[DownloadProgress] = None) -> str:
+    import tqdm
+    hasher = hashlib.sha256()
+    buffer = memoryview(bytearray(1024 * 1024))
+    size: Optional[int] = None
+    t: Optional[tqdm.tqdm] = None
+    if urlreq.headers['content-length'] is not None:
+        size = int(urlreq.headers['content-length'])
+        if progress is not None:
+            progress.add_total(size)
+        else:
+            t = tqdm.tqdm(total=size, unit='B', unit_scale=True, unit_divisor=1024, desc=desc)
+    elif progress is None:
+        print('Fetching: ' + url)
+    received = 0
+    try:
+        while True:
+            blocksize = urlreq.readinto(buffer)
+            if not blocksize:
+                break
+            hasher.update(buffer[:blocksize])
+            dest.write(buffer[:blocksize])
+            received += blocksize
+            if t is not None:
+                t.update(blocksize)
+            elif progress is not None:
+                progress.update(blocksize)
+    finally:
+        if t is not None:
+            t.close()
+    if (size is not None) and (received != size):
+        raise IOError('Incomplete download of ' + url + ', got {} of {} bytes'.format(received, size))
+    return hasher.hexdigest()
+
+def fetch_ur1(url: str, dest: BinaryIO, desc: Optional[str] = None, progress: Optional[DownloadProgress] = None) -> str:
+    with http_request(url) as urlreq:
+        return read_response(urlreq, url, dest, desc, progress)
+
+# Large downloads are split into chunks that are fetched with several concurrent range requests when the server supports
+# them. Chunks are written straight into a .part file next to where the cache entry will go and the finished chunks are
+# listed in a .part.json sidecar, so an interrupted download continues with the missing chunks on the next run as long as
+# the server still reports the same size and ETag or Last-Modified.
+range_download_threshold = 64 * 1024 * 1024
+range_download_chunk_size = 16 * 1024 * 1024
+range_download_connections = 4
+
+# the size of the file when the answer to a plain request shows it's large enough to be fetched in ranges, None otherwise
+def get_range_download_size(urlreq) -> Optional[int]:
+    if (getattr(urlreq, 'status', None) != 200) or (urlreq.headers.get('accept-ranges', '').lower() != 'bytes'):
+        return None
+    try:
+        size = int(urlreq.headers.get('content-length', ''))
+    except ValueError:
+        return None
+    return size if size >= range_download_threshold else None
+
+def load_range_download_state(part_path: str, url: str, size: int, validator: Optional[str]) -> MutableMapping:
+    try:
+        with open(part_path + '.json', 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if (state['url'] == url) and (state['size'] == size) and (state['validator'] == validator) and (state['chunk_size'] == range_download_chunk_size) and (os.path.getsize(part_path) == size):
+            state['done'] = set(state['done'])
+            return state
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    with open(part_path, 'wb') as f:
+        f.truncate(size)
+    return {'url': url, 'size': size, 'validator': validator, 'chunk_size': range_download_chunk_size, 'done': set()}
+
+def save_range_download_state(part_path: str, state: MutableMapping) -> None:
+    tffd, tfpath = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(part_path))
+    with open(tffd, 'w', encoding='utf-8') as tf:
+        json.dump(dict(state, done=sorted(state['done'])), tf)
+    os.replace(tfpath, part_path + '.json')
+
+def remove_range_download_state(part_path: str) -> None:
+    try:
+        os.remove(part_path + '.json')
+    except OSError:
+        pass
 
-if is_windows:
-    cmd7zip_path: str = os.path.join(file_dirname, '7z.exe')
-    if not os.path.isfile(cmd7zip_path):
+def fetch_range(url: str, part_path: str, start: int, end: int, validator: Optional[str], progress: DownloadProgress) -> None:
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    if validator is not None:
+        headers['If-Range'] = validator
+    buffer = memoryview(bytearray(1024 * 1024))
+    with timed('range {}-{}'.format(start, end), 'range', url=url), http_request(url, headers) as urlreq:
+        # a full response means the file changed since the download started or the server ignores ranges after all
+        if (urlreq.status != 206) or not urlreq.headers.get('content-range', '').startswith('bytes {}-{}/'.format(start, end)):
+            raise IOError('Server didn\'t return the requested range of ' + url)
+        received = 0
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            while True:
+                blocksize = urlreq.readinto(buffer)
+                if not blocksize:
+                    break
+                f.write(buffer[:blocksize])
+                received += blocksize
+                progress.update(blocksize)
+        if received != end - start + 1:
+            raise IOError('Incomplete download of ' + url + ', got {} of {} bytes'.format(received, end - start + 1))
+
+# fetches the missing chunks of part_path and returns the sha256 of the complete file
+def fetch_url_ranges(url: str, size: int, validator: Optional[str], part_path: str, desc: str, progress: Optional[DownloadProgress]) -> str:
+    state = load_range_download_state(part_path, url, size, validator)
+    chunks = [(i * range_download_chunk_size, min(size, (i + 1) * range_download_chunk_size) - 1) for i in range((size + range_download_chunk_size - 1) // range_download_chunk_size)]
+    pending = [i for i in range(len(chunks)) if i not in state['done']]
+
+    own_progress = progress is None
+    if progress is None:
+        progress = DownloadProgress(desc)
+    progress.add_total(size)
+    progress.update(size - sum(chunks[i][1] - chunks[i][0] + 1 for i in pending))
+    try:
+        with ThreadPoolExecutor(max_workers=range_download_connections) as executor:
+            futures = {executor.submit(fetch_range, url, part_path, chunks[i][0], chunks[i][1], validator, progress): i for i in pending}
+            # chunks that were already running when one failed are still kept for the next attempt
+            error: Optional[BaseException] = None
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                if future.exception() is not None:
+                    if error is None:
+                        error = future.exception()
+                        for f in futures:
+                            f.cancel()
+                    continue
+                state['done'].add(futures[future])
+                save_range_download_state(part_path, state)
+            if error is not None:
+                raise error
+    finally:
+        if own_progress:
+            progress.close()
+    remove_range_download_state(part_path)
+    return hash_file(part_path)
+
+# Downloads are kept on disk between runs. Files are stored under the sha256 the package definitions list for them,
+# which is only known for wheels and single file downloads. Archives are instead stored under the sha256 of their url,
+# release urls don't change and the extracted files get verified anyway.
+def get_cache_key(url: str, sha256: Optional[str]) -> str:
+    if sha256:
+        return sha256.lower()
+    return 'url-' + hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def get_cache_file(key: str) -> str:
+    return os.path.join(cache_path, key[-64:-62], key)
+
+# The last time every cache entry was used is kept in access.json in the cache dir for eviction, entries that were never
+# used again fall back to their modification time. The modification time itself can't be bumped since installed files
+# may be hardlinks to stored ones.
+cache_access: Optional[MutableMapping] = None
+cache_access_dirty = False
+cache_access_lock = threading.Lock()
+
+def get_cache_access_path() -> str:
+    return os.path.join(cache_path, 'access.json')
+
+def load_cache_access() -> MutableMapping:
+    global cache_access
+    if cache_access is None:
+        cache_access = {}
         try:
-            with winreg.OpenKeyEx(winreg.HKEY_LOCAL_MACHINE, 'SOFTWARE\\7-Zip', reserved=0, access=winreg.KEY_READ) as regkey:
-                cmd7zip_path = os.path.join(winreg.QueryValueEx(regkey, 'Path')[0], '7z.exe')
-        except:
-            cmd7zip_path = '7z.exe'
-else:
-    cmd7zip_path = '7z'
+            with open(get_cache_access_path(), 'r', encoding='utf-8') as f:
+                access = json.load(f)
+            if isinstance(access, dict):
+                cache_access = access
+        except (OSError, ValueError):
+            pass
+    return cache_access
+
+def record_cache_access(path: str) -> None:
+    global cache_access_dirty
+    with cache_access_lock:
+        load_cache_access()[os.path.basename(path)] = time.time()
+        cache_access_dirty = True
+
+def save_cache_access() -> None:
+    global cache_access_dirty
+    with cache_access_lock:
+        if cache_access is None or not cache_access_dirty:
+            return
+        try:
+            os.makedirs(cache_path, exist_ok=True)
+            tffd, tfpath = tempfile.mkstemp(prefix='.tmp', dir=cache_path)
+            with open(tffd, 'w', encoding='utf-8') as tf:
+                json.dump(cache_access, tf)
+            os.replace(tfpath, get_cache_access_path())
+            cache_access_dirty = False
+        except OSError:
+            pass
+
+atexit.register(save_cache_access)
+
+def read_download_cache(url: str, sha256: Optional[str]) -> Optional[str]:
+    if options.cache_size <= 0:
+        return None
+    path = get_cache_file(get_cache_key(url, sha256))
+    try:
+        if (sha256 is not None) and (get_file_hash(path) != sha256.lower()):
+            os.remove(path)
+            return None
+        if not os.path.isfile(path):
+            return None
+        record_cache_access(path)
+        if sha256 is not None:
+            remember_file_hash(path, sha256.lower())
+    except OSError:
+        return None
+    return path
 
-installed_packages: MutableMapping = {}
-download_cache: MutableMapping = {}
+# downloads that couldn't be put in the cache and staging dirs of extracted files, removed when vsrepo exits
+temporary_files: List[str] = []
+temporary_dirs: List[str] = []
+
+def remove_temporary_files() -> None:
+    for path in temporary_files:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    for path in temporary_dirs:
+        shutil.rmtree(path, ignore_errors=True)
+
+atexit.register(remove_temporary_files)
+
+# fetches source, which is url itself or its mirrored copy, into the cache entry of url
+def download_file_from(source: str, url: str, desc: str, progress: Optional[DownloadProgress], sha256: Optional[str]) -> Tuple[str, str]:
+    # downloads are written to the cache dir directly so a finished download only has to be renamed to become an entry
+    cache_file = get_cache_file(get_cache_key(url, sha256))
+    tfdir: Optional[str] = None
+    if options.cache_size > 0:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tfdir = os.path.dirname(cache_file)
+        except OSError:
+            pass
+
+    def read_to_file(urlreq) -> Tuple[str, str]:
+        tffd, tfpath = tempfile.mkstemp(prefix='.tmp' if tfdir is not None else 'vsm', dir=tfdir)
+        try:
+            with open(tffd, mode='wb') as tf:
+                return (tfpath, read_response(urlreq, source, tf, desc, progress))
+        except:
+            os.remove(tfpath)
+            raise
 
-def fetch_ur1(url: str, desc: Optional[str] = None) -> bytearray:
-    with urllib.request.urlopen(url) as urlreq:
-        if urlreq.headers['content-length'] is not None:
-            size = int(urlreq.headers['content-length'])
-            remaining = size
-            data = bytearray()
-            with tqdm.tqdm(total=size, unit='B', unit_scale=True, unit_divisor=1024, desc=desc) as t:
-                while remaining > 0:
-                    blocksize = min(remaining, 1024*128)
-                    data.extend(urlreq.read(blocksize))
-                    remaining = remaining - blocksize
-                    t.update(blocksize)
-            return data
+    # a single plain request is all small files take, the connection is only dropped for large files on servers that
+    # accept ranges
+    size: Optional[int] = None
+    validator: Optional[str] = None
+    tfpath: Optional[str] = None
+    with http_request(source) as urlreq:
+        size = get_range_download_size(urlreq)
+        if size is None:
+            tfpath, digest = read_to_file(urlreq)
         else:
-            print('Fetching: ' + url)
-            return urlreq.read()
+            validator = urlreq.headers.get('etag', urlreq.headers.get('last-modified'))
+    if tfpath is None:
+        assert size is not None
+        # partial downloads always go in the cache dir so they can be resumed even when the cache is disabled
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tfpath = cache_file + '.part'
+        digest = fetch_url_ranges(source, size, validator, tfpath, desc, progress)
+        if (sha256 is not None) and (digest != sha256.lower()):
+            # the partial data can't be trusted so the next attempt starts over
+            temporary_files.append(tfpath)
+            return (tfpath, digest)
+    if (tfdir is not None) and ((sha256 is None) or (digest == sha256.lower())) and (os.path.getsize(tfpath) <= options.cache_size * 1024 * 1024):
+        try:
+            os.replace(tfpath, cache_file)
+            record_cache_access(cache_file)
+            return (cache_file, digest)
+        except OSError as e:
+            print('Failed to store ' + url + ' in the download cache: ' + str(e))
+    temporary_files.append(tfpath)
+    return (tfpath, digest)
+
+def download_file(url: str, desc: str, progress: Optional[DownloadProgress], sha256: Optional[str]) -> Tuple[str, str]:
+    mirrored = get_mirrored_url(url)
+    if mirrored is not None:
+        try:
+            with timed('fetch ' + url.rsplit('/', 1)[-1], 'network', url=mirrored[0]):
+                path, digest = download_file_from(mirrored[0], url, desc, progress, sha256)
+            if digest == mirrored[1]:
+                return (path, digest)
+            os.remove(path)
+            print('Hash mismatch for the mirrored copy of ' + url + ', downloading the original instead')
+        except (OSError, http.client.HTTPException) as e:
+            print('Failed to download the mirrored copy of ' + url + ', downloading the original instead: ' + str(e))
+    with timed('fetch ' + url.rsplit('/', 1)[-1], 'network', url=url):
+        return download_file_from(url, url, desc, progress, sha256)
+
+# Only files named like a cache key in the shard dir their key belongs in are entries, partial downloads, their
+# sidecars, temporary files and the staging dirs of installs that may still be running are left alone
+cache_entry_regex = re.compile(r'(url-)?[0-9a-f]{64}')
+
+# (last access, size, path) of every cache entry
+def get_download_cache_entries() -> List[Tuple[float, int, str]]:
+    access = load_cache_access()
+    entries: List[Tuple[float, int, str]] = []
+    try:
+        shards = [shard for shard in os.listdir(cache_path) if re.fullmatch(r'[0-9a-f]{2}', shard)]
+    except OSError:
+        return entries
+    for shard in shards:
+        try:
+            fnames = os.listdir(os.path.join(cache_path, shard))
+        except OSError:
+            continue
+        for fname in fnames:
+            if not cache_entry_regex.fullmatch(fname) or fname[-64:-62] != shard:
+                continue
+            path = os.path.join(cache_path, shard, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            entries.append((max(access.get(fname, 0.0), st.st_mtime), st.st_size, path))
+    return entries
+
+def prune_download_cache(limit: int) -> Tuple[int, int]:
+    global cache_access_dirty
+    entries = sorted(get_download_cache_entries())
+    total = sum(entry[1] for entry in entries)
+    removed = (0, 0)
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        with cache_access_lock:
+            if load_cache_access().pop(os.path.basename(path), None) is not None:
+                cache_access_dirty = True
+        total -= size
+        removed = (removed[0] + 1, removed[1] + size)
+    save_cache_access()
+    return removed
+
+def format_size(size: int) -> str:
+    return '{:.1f} MiB'.format(size / (1024 * 1024))
+
+def manage_download_cache(action: str) -> None:
+    if action == 'stats':
+        entries = get_download_cache_entries()
+        print('Cache: ' + cache_path)
+        print('Entries: {}'.format(len(entries)))
+        print('Size: {} of {}'.format(format_size(sum(entry[1] for entry in entries)), format_size(options.cache_size * 1024 * 1024)))
+    elif action == 'prune':
+        removed = prune_download_cache(options.cache_size * 1024 * 1024)
+        print('Removed {} {} ({})'.format(removed[0], 'entry' if removed[0] == 1 else 'entries', format_size(removed[1])))
+    elif action == 'clear':
+        removed = prune_download_cache(0)
+        print('Removed {} {} ({})'.format(removed[0], 'entry' if removed[0] == 1 else 'entries', format_size(removed[1])))
+
+# returns the path of the downloaded file and its sha256, the hash is None for cached files stored under their url
+def fetch_url_cached(url: str, desc: str = "", progress: Optional[DownloadProgress] = None, sha256: Optional[str] = None) -> Tuple[str, Optional[str]]:
+    # several packages may share an archive so concurrent requests for the same url wait for the first one
+    with download_locks_lock:
+        url_lock = download_locks.setdefault(url, threading.Lock())
+    with url_lock:
+        result = download_cache.get(url, None)
+        if result is None:
+            path = read_download_cache(url, sha256)
+            if path is not None:
+                result = (path, sha256.lower() if sha256 is not None else None)
+        if result is None:
+            result = download_file(url, desc, progress, sha256)
+        download_cache[url] = result
+    return result
+
+# Files are stored in the download cache under their sha256 after extraction too, the same way single file downloads
+# already are, which makes it a content-addressed store shared by all packages and by every install using the same
+# definitions dir. Packages whose files are all stored are installed without downloading anything and installed files are
+# reflinks or hardlinks to the stored ones where the filesystem allows it. The installed state catches stored files that
+# were modified through a hardlink, they're dropped instead of being used.
+def find_stored_file(sha256: str) -> Optional[str]:
+    if options.cache_size <= 0:
+        return None
+    path = get_cache_file(sha256.lower())
+    try:
+        if get_file_hash(path) == sha256.lower():
+            record_cache_access(path)
+            return path
+        if os.path.exists(path):
+            os.remove(path)
+            forget_installed_file(path)
+    except OSError:
+        pass
+    return None
 
-def fetch_url_cached(url: str, desc: str = "") -> bytearray:
-    data = download_cache.get(url, None)
-    if data is None:
-        data = fetch_ur1(url, desc)
-        download_cache[url] = data
-    return data
+# returns install_fn -> (stored file, sha256, size) if every file of the release is stored
+def find_stored_release(bin_rel: MutableMapping) -> Optional[MutableMapping]:
+    files: MutableMapping = {}
+    for install_fn, fn_props in bin_rel['files'].items():
+        path = find_stored_file(fn_props[1])
+        if path is None:
+            return None
+        files[install_fn] = (path, fn_props[1], os.path.getsize(path))
+    return files
+
+def store_file(path: str, sha256: str) -> str:
+    stored_path = get_cache_file(sha256.lower())
+    os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+    os.replace(path, stored_path)
+    remember_file_hash(stored_path, sha256.lower())
+    record_cache_access(stored_path)
+    return stored_path
+
+# device pairs reflinks failed between, not tried again
+reflink_unsupported: set = set()
+
+def reflink_file(src: str, dst: str) -> None:
+    if sys.platform != 'linux':
+        raise OSError('Reflinks are only supported on Linux')
+    import fcntl
+    FICLONE = 0x40049409
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+    if devices in reflink_unsupported:
+        raise OSError('Reflinks not supported')
+    try:
+        with open(src, 'rb') as srcfile, open(dst, 'wb') as dstfile:
+            fcntl.ioctl(dstfile.fileno(), FICLONE, srcfile.fileno())
+    except OSError:
+        reflink_unsupported.add(devices)
+        os.remove(dst)
+        raise
+
+# places a copy of src at dst, as cheaply as the link mode and filesystem allow
+def link_file(src: str, dst: str) -> None:
+    try:
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+    if options.link_mode in ('auto', 'reflink'):
+        try:
+            reflink_file(src, dst)
+            return
+        except OSError:
+            pass
+    if options.link_mode in ('auto', 'hardlink'):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
 
 package_print_string = "{:25s} {:15s} {:11s} {:11s} {:s}"
 
-package_list: Optional[MutableMapping] = None
-try:
-    with open(package_json_path, 'r', encoding='utf-8') as pl:
-        package_list = json.load(pl)
-    if package_list is None:
-        raise ValueError()
-    if package_list['file-format'] != 3:
-        print('Package definition format is {} but only version 3 is supported'.format(package_list['file-format']))
-        raise ValueError()
-    package_list = package_list.get('packages')
-except (OSError, FileExistsError, ValueError):
-    pass
+# the packages of a definitions snapshot, each one is only unmarshalled the first time something looks at it
+class LazyPackageList(Sequence):
+    def __init__(self, blobs: List[bytes]):
+        self.blobs = blobs
+        self.packages: List[Optional[MutableMapping]] = [None] * len(blobs)
+
+    def __len__(self) -> int:
+        return len(self.blobs)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        p = self.packages[i]
+        if p is None:
+            p = marshal.loads(self.blobs[i])
+            self.packages[i] = p
+        return p
+
+# key -> position in the package list for every lookup table, the first package in the definitions wins when several share a key,
+# same as searching the list in order
+def make_index_tables(packages: Sequence[MutableMapping]) -> MutableMapping:
+    tables: MutableMapping = {'identifier': {}, 'namespace': {}, 'modulename': {}, 'name': {}}
+    for i, p in enumerate(packages):
+        tables['identifier'].setdefault(p['identifier'], i)
+        if 'namespace' in p:
+            tables['namespace'].setdefault(p['namespace'], i)
+        if 'modulename' in p:
+            tables['modulename'].setdefault(p['modulename'], i)
+        tables['name'].setdefault(p['name'].casefold(), i)
+    return tables
+
+# maps the sha256 of every file in the package definitions to the (identifier, version, target) tuples it appears in
+def make_file_hash_index(packages: Sequence[MutableMapping]) -> MutableMapping:
+    file_hashes: MutableMapping = {}
+    for p in packages:
+        for rel in p['releases']:
+            for bin_name, bin_rel in rel.items():
+                if isinstance(bin_rel, MutableMapping) and 'files' in bin_rel:
+                    for fn_props in bin_rel['files'].values():
+                        file_hashes.setdefault(fn_props[1], []).append((p['identifier'], rel['version'], bin_name))
+    return file_hashes
+
+# lookup tables for the package definitions, built once when they're loaded or read back from the snapshot
+class PackageIndex:
+    def __init__(self, packages: Sequence[MutableMapping], tables: Optional[MutableMapping] = None, file_hashes: Optional[bytes] = None):
+        self.packages = packages
+        if tables is None:
+            tables = make_index_tables(packages)
+        self.by_id: MutableMapping = tables['identifier']
+        self.by_namespace: MutableMapping = tables['namespace']
+        self.by_modulename: MutableMapping = tables['modulename']
+        self.by_name: MutableMapping = tables['name']
+        # (identifier, bin_name) -> (index, release) as returned by get_latest_installable_release_with_index
+        self.latest_installable: MutableMapping = {}
+        # sha256 -> list of (identifier, version, target) for every file in the definitions, the snapshot stores it marshalled
+        self.file_hashes: Optional[MutableMapping] = None
+        self.file_hashes_data = file_hashes
+
+    def lookup(self, table: MutableMapping, key: str) -> Optional[MutableMapping]:
+        i = table.get(key)
+        return None if i is None else self.packages[i]
+
+package_list: Optional[Sequence[MutableMapping]] = None
+package_index: Optional[PackageIndex] = None
+
+# the parsed definitions are kept next to vspackages3.json in marshal format so most runs never have to parse the json,
+# the snapshot is only used when it was made from a file with the same sha256. Hashing the json is still far cheaper
+# than parsing it and unlike size and mtime can't miss new definitions.
+package_snapshot_format = 2
+
+def get_package_snapshot_path() -> str:
+    return os.path.splitext(package_json_path)[0] + '.snapshot'
+
+def make_package_snapshot_key() -> Tuple:
+    return (package_snapshot_format, marshal.version, sys.version_info[:2])
+
+def load_package_snapshot(st: os.stat_result) -> bool:
+    global package_list, package_index
+    snapshot_path = get_package_snapshot_path()
+    try:
+        with open(snapshot_path, 'rb') as f:
+            snapshot = marshal.load(f)
+        if not isinstance(snapshot, dict) or snapshot.get('key') != make_package_snapshot_key():
+            return False
+        if snapshot['size'] != st.st_size or snapshot['sha256'] != hash_file(package_json_path):
+            return False
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        return False
+    package_list = LazyPackageList(snapshot['packages'])
+    package_index = PackageIndex(package_list, snapshot['tables'], snapshot['file_hashes'])
+    return True
 
-def check_hash(data: bytes, ref_hash: str) -> Tuple[bool, str, str]:
-    data_hash = hashlib.sha256(data).hexdigest()
-    return (data_hash == ref_hash, data_hash, ref_hash)
+def write_package_snapshot(snapshot: MutableMapping) -> None:
+    snapshot_path = get_package_snapshot_path()
+    # a snapshot is only an optimization so failing to write it is never an error
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(snapshot_path), prefix='.vspackages3.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(snapshot, f)
+            os.replace(tmp_path, snapshot_path)
+        except:
+            os.remove(tmp_path)
+            raise
+    except OSError:
+        pass
+
+def compile_package_snapshot(data: bytes, st: os.stat_result, packages: Sequence[MutableMapping]) -> None:
+    write_package_snapshot({
+        'key': make_package_snapshot_key(),
+        'size': st.st_size,
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'packages': [marshal.dumps(p) for p in packages],
+        'tables': make_index_tables(packages),
+        'file_hashes': marshal.dumps(make_file_hash_index(packages))
+    })
+
+@timed('load definitions', 'definitions')
+def load_package_list(required: bool = True) -> None:
+    global package_list, package_index
+    ensure_init()
+    if package_list is None:
+        try:
+            with open(package_json_path, 'rb') as pl:
+                st = os.fstat(pl.fileno())
+                if not load_package_snapshot(st):
+                    data = pl.read()
+                    package_list = json.loads(data)
+                    if package_list is None:
+                        raise ValueError()
+                    if package_list['file-format'] != 3:
+                        print('Package definition format is {} but only version 3 is supported'.format(package_list['file-format']))
+                        raise ValueError()
+                    package_list = package_list.get('packages')
+                    if package_list is not None:
+                        package_index = PackageIndex(package_list)
+                        compile_package_snapshot(data, st, package_list)
+        except (OSError, FileExistsError, ValueError):
+            package_list = None
+    if required and package_list is None:
+        raise VSRepoError('Failed to open vspackages3.json. Run update command.')
+
+def hash_file(path: str) -> str:
+    with timed('hash ' + os.path.basename(path), 'hash', path=path), open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+# The installed state remembers the hash of every file vsrepo has installed or looked at together with its stat data,
+# as long as size, mtime and inode are unchanged the stored hash is used instead of reading the file again.
+# Entries written at install time also carry the package and version the file belongs to.
+# The dist-info part maps the identifier of every script and plugin to the name of its dist-info dir and the signature
+# of the files it was last written from, see get_distinfo_signature.
+installed_state: Optional[MutableMapping] = None
+distinfo_state: MutableMapping = {}
+installed_state_dirty = False
+
+def load_installed_state() -> MutableMapping:
+    global installed_state, distinfo_state
+    if installed_state is None:
+        installed_state = {}
+        distinfo_state = {}
+        try:
+            with open(installed_state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('version') == 1:
+                installed_state = state['files']
+                distinfo_state = state.get('dist-info', {})
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+    return installed_state
+
+def load_distinfo_state() -> MutableMapping:
+    load_installed_state()
+    return distinfo_state
+
+@timed('save installed state', 'state')
+def save_installed_state() -> None:
+    global installed_state_dirty
+    if installed_state is None or not installed_state_dirty:
+        return
+    try:
+        os.makedirs(os.path.dirname(installed_state_path), exist_ok=True)
+        tffd, tfpath = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(installed_state_path))
+        with open(tffd, 'w', encoding='utf-8') as tf:
+            json.dump({'version': 1, 'files': installed_state, 'dist-info': distinfo_state}, tf)
+        os.replace(tfpath, installed_state_path)
+        installed_state_dirty = False
+    except OSError as e:
+        print('Failed to save installed state: ' + str(e))
+
+def make_state_entry(st: os.stat_result, sha256: str, package: Optional[str] = None, version: Optional[str] = None) -> MutableMapping:
+    entry = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'inode': st.st_ino, 'hash': sha256}
+    if package is not None:
+        entry['package'] = package
+        entry['version'] = version
+    return entry
+
+# returns None if the file doesn't exist
+def get_file_hash(path: str) -> Optional[str]:
+    global installed_state_dirty
+    state = load_installed_state()
+    path = os.path.abspath(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        if state.pop(path, None) is not None:
+            installed_state_dirty = True
+        return None
+    entry = state.get(path)
+    if (entry is not None) and (entry['size'] == st.st_size) and (entry['mtime'] == st.st_mtime_ns) and (entry['inode'] == st.st_ino):
+        return entry['hash']
+    sha256 = hash_file(path)
+    state[path] = make_state_entry(st, sha256)
+    installed_state_dirty = True
+    return sha256
+
+# for files whose hash is already known, like freshly verified downloads
+def remember_file_hash(path: str, sha256: str) -> None:
+    global installed_state_dirty
+    path = os.path.abspath(path)
+    load_installed_state()[path] = make_state_entry(os.stat(path), sha256)
+    installed_state_dirty = True
+
+def record_installed_file(path: str, sha256: str, package: str, version: str) -> None:
+    global installed_state_dirty
+    path = os.path.abspath(path)
+    load_installed_state()[path] = make_state_entry(os.stat(path), sha256, package, version)
+    installed_state_dirty = True
+
+def forget_installed_file(path: str) -> None:
+    global installed_state_dirty
+    if load_installed_state().pop(os.path.abspath(path), None) is not None:
+        installed_state_dirty = True
 
 def get_bin_name(p: MutableMapping):
     if p['type'] == 'PyScript':
@@ -188,46 +1134,36 @@ def get_install_path(p: MutableMapping) -> str:
         raise ValueError('Unknown install type')
 
 def get_package_from_id(id: str, required: bool = False) -> Optional[MutableMapping]:
-    if package_list is None:
+    if package_index is None:
         return None
-    for p in package_list:
-        if p['identifier'] == id:
-            return p
-    if required:
+    p = package_index.lookup(package_index.by_id, id)
+    if p is None and required:
         raise ValueError(f'No package with the identifier {id} found')
-    return None
+    return p
 
 def get_package_from_plugin_name(name: str, required: bool = False) -> Optional[MutableMapping]:
-    if package_list is None:
+    if package_index is None:
         return None
-    for p in package_list:
-        if p['name'].casefold() == name.casefold():
-            return p
-    if required:
+    p = package_index.lookup(package_index.by_name, name.casefold())
+    if p is None and required:
         raise ValueError(f'No package with the name {name} found')
-    return None
+    return p
 
 def get_package_from_namespace(namespace: str, required: bool = False) -> Optional[MutableMapping]:
-    if package_list is None:
+    if package_index is None:
         return None
-    for p in package_list:
-        if 'namespace' in p:
-            if p['namespace'] == namespace:
-                return p
-    if required:
+    p = package_index.lookup(package_index.by_namespace, namespace)
+    if p is None and required:
         raise ValueError(f'No package with the namespace {namespace} found')
-    return None
+    return p
 
 def get_package_from_modulename(modulename: str, required: bool = False) -> Optional[MutableMapping]:
-    if package_list is None:
+    if package_index is None:
         return None
-    for p in package_list:
-        if 'modulename' in p:
-            if p['modulename'] == modulename:
-                return p
-    if required:
+    p = package_index.lookup(package_index.by_modulename, modulename)
+    if p is None and required:
         raise ValueError(f'No package with the modulename {modulename} found')
-    return None
+    return p
 
 def get_package_from_name(name: str) -> MutableMapping:
     p = get_package_from_id(name)
@@ -274,8 +1210,23 @@ def find_dist_version(pkg: MutableMapping, path: Optional[str]) -> Optional[str]
     versions.sort(reverse=True)
     return versions[0] if len(versions) > 0 else None
 
+# unmarshals or builds the file hash index the first time package detection needs it
+def get_file_hash_index() -> MutableMapping:
+    if package_index is None:
+        return {}
+    if package_index.file_hashes is None:
+        if package_index.file_hashes_data is not None:
+            package_index.file_hashes = marshal.loads(package_index.file_hashes_data)
+            package_index.file_hashes_data = None
+        else:
+            package_index.file_hashes = make_file_hash_index(package_list or [])
+    return package_index.file_hashes
+
+@timed('detect installed packages', 'detect')
 def detect_installed_packages() -> None:
+    installed_packages.clear()
     if package_list is not None:
+        index = get_file_hash_index()
         for p in package_list:
             dest_path = get_install_path(p)
             if p['type'] == 'PyWheel':
@@ -283,36 +1234,53 @@ def detect_installed_packages() -> None:
                 if version is not None:
                     installed_packages[p['identifier']] = version
             else:
-                for v in p['releases']:
-                    matched = True
-                    exists = True
-                    bin_name = get_bin_name(p)
-                    if bin_name in v:
-                        for f in v[bin_name]['files']:
-                            try:
-                                with open(os.path.join(dest_path, f), 'rb') as fh:
-                                    if not check_hash(fh.read(), v[bin_name]['files'][f][1])[0]:
-                                        matched = False
-                            except FileNotFoundError:
-                                exists = False
-                                matched = False
-                        if matched:
-                            installed_packages[p['identifier']] = v['version']
-                            break
-                        elif exists:
-                            installed_packages[p['identifier']] = 'Unknown'
+                bin_name = get_bin_name(p)
+                releases = [v for v in p['releases'] if bin_name in v]
+                # every file name used by any release is hashed once, releases are then matched against the digests
+                digests: MutableMapping = {}
+                for v in releases:
+                    for f in v[bin_name]['files']:
+                        if f not in digests:
+                            digests[f] = get_file_hash(os.path.join(dest_path, f))
+                candidates = set()
+                for digest in digests.values():
+                    for identifier, version, target in index.get(digest, []):
+                        if identifier == p['identifier'] and target == bin_name:
+                            candidates.add(version)
+                for v in releases:
+                    files = v[bin_name]['files']
+                    if v['version'] in candidates and all(digests[f] == files[f][1] for f in files):
+                        installed_packages[p['identifier']] = v['version']
+                        break
+                    elif all(digests[f] is not None for f in files):
+                        installed_packages[p['identifier']] = 'Unknown'
+        save_installed_state()
     else:
-        print('No valid package definitions found. Run update command first!')
-        sys.exit(1)
+        raise VSRepoError('No valid package definitions found. Run update command first!')
+
+class PackageStatus(NamedTuple):
+    identifier: str
+    name: str
+    namespace: str # the modulename for python packages
+    installed: Optional[str]
+    latest: Optional[str]
+    upgradable: bool
+    upgradable_with_force: bool
+
+def get_package_status(p: MutableMapping) -> PackageStatus:
+    lastest_installable = get_latest_installable_release(p)
+    return PackageStatus(p['identifier'], p['name'], p['namespace'] if p['type'] == 'VSPlugin' else p['modulename'], installed_packages.get(p['identifier']),
+                         lastest_installable.get('version') if lastest_installable is not None else None,
+                         is_package_upgradable(p['identifier'], False), is_package_upgradable(p['identifier'], True))
 
 def print_package_status(p: MutableMapping) -> None:
-    lastest_installable = get_latest_installable_release(p)
-    name = p['name']
-    if is_package_upgradable(p['identifier'], False):
+    status = get_package_status(p)
+    name = status.name
+    if status.upgradable:
         name = '*' + name
-    elif is_package_upgradable(p['identifier'], True):
+    elif status.upgradable_with_force:
         name = '+' + name
-    print(package_print_string.format(name, p['namespace'] if p['type'] == 'VSPlugin' else p['modulename'], installed_packages.get(p['identifier'], ""), lastest_installable.get('version') if lastest_installable is not None else '', p['identifier']))
+    print(package_print_string.format(name, status.namespace, status.installed or '', status.latest or '', status.identifier))
 
 def list_installed_packages() -> None:
     print(package_print_string.format('Name', 'Namespace', 'Installed', 'Latest', 'Identifier'))
@@ -329,7 +1297,7 @@ def list_available_packages() -> None:
     for p in package_list:
         print_package_status(p)
 
-def get_latest_installable_release_with_index(p: MutableMapping) -> Tuple[int, Optional[MutableMapping]]:
+def find_latest_installable_release_with_index(p: MutableMapping) -> Tuple[int, Optional[MutableMapping]]:
     max_api = get_vapoursynth_api_version()
     package_api: int = 3
     if 'api' in p:
@@ -346,6 +1314,16 @@ def get_latest_installable_release_with_index(p: MutableMapping) -> Tuple[int, O
                 return (idx, rel)
     return (-1, None)
 
+def get_latest_installable_release_with_index(p: MutableMapping) -> Tuple[int, Optional[MutableMapping]]:
+    if package_index is None:
+        return find_latest_installable_release_with_index(p)
+    key = (p['identifier'], get_bin_name(p))
+    result = package_index.latest_installable.get(key)
+    if result is None:
+        result = find_latest_installable_release_with_index(p)
+        package_index.latest_installable[key] = result
+    return result
+
 def get_latest_installable_release(p: MutableMapping) -> Optional[MutableMapping]:
     return get_latest_installable_release_with_index(p)[1]
 
@@ -393,7 +1371,9 @@ def rmdir(path: str) -> None:
 
 # Annotated as Iterator due to https://docs.python.org/3/library/typing.html#typing.Generator
 # See the portion about only yielding values, it's an alternative to Generator[str, None, None]
-def find_dist_dirs(name: str, path: Optional[str] = site_package_dir) -> Iterator[str]:
+def find_dist_dirs(name: str, path: Optional[str] = None) -> Iterator[str]:
+    if path is None:
+        path = site_package_dir
     if path is None:
         return
 
@@ -413,262 +1393,509 @@ def remove_package_meta(pkg: MutableMapping) -> None:
         rmdir(dist_dir)
 
 
-def install_package_meta(files: List[Tuple[str, str, str]], pkg: MutableMapping, rel: MutableMapping, index: int) -> None:
-    if site_package_dir is None:
-        return
-
+# returns the dist-info dir of a package and the name and contents of every file in it
+def make_package_meta(files: List[Tuple[str, str, str]], pkg: MutableMapping, rel: MutableMapping, index: int) -> Tuple[str, List[Tuple[str, str]]]:
+    assert site_package_dir is not None
     name = get_python_package_name(pkg)
 
     version = make_pyversion(rel["version"], index)
     dist_dir = os.path.join(site_package_dir, f"{name}-{version}.dist-info")
 
-    remove_package_meta(pkg)
-
-    os.mkdir(dist_dir)
-    with open(os.path.join(dist_dir, "INSTALLER"), "w") as f:
-        files.append((os.path.join(dist_dir, "INSTALLER"), "" ,""))
-        f.write("vsrepo")
-    with open(os.path.join(dist_dir, "METADATA"), "w") as f:
-        files.append((os.path.join(dist_dir, "METADATA"), "" ,""))
-        f.write(f"""Metadata-Version: 2.1
+    metadata = f"""Metadata-Version: 2.1
 Name: {name}
 Version: {version}
 Summary: {pkg.get('description', name)}
-Platform: All""")
-
-    with open(os.path.join(dist_dir, "RECORD"), "w", newline="") as f:
-        files.append((os.path.join(dist_dir, "RECORD"), "", ""))
-        w = csv.writer(f)
-        for filename, sha256hex, length in files:
-            if sha256hex:
-                sha256hex = "sha256=" + base64.urlsafe_b64encode(binascii.unhexlify(sha256hex.encode("ascii"))).rstrip(b"=").decode("ascii")
-            try:
-                filename = os.path.relpath(filename, site_package_dir)
-            except ValueError:
-                pass
-            w.writerow([filename, sha256hex, length])
-
-class MyIO(py7zr.Py7zIO):
-    def __init__(self, limit):
-        self._limit = limit
-        self._buffer = bytearray()
+Platform: All"""
 
-    @override
-    def write(self, s: Union[bytes, bytearray]):
-        self._buffer.extend(s[:self._limit - len(self._buffer)])
+    record = io.StringIO()
+    w = csv.writer(record)
+    for filename, sha256hex, length in files + [(os.path.join(dist_dir, fname), "", "") for fname in ("INSTALLER", "METADATA", "RECORD")]:
+        if sha256hex:
+            sha256hex = "sha256=" + base64.urlsafe_b64encode(binascii.unhexlify(sha256hex.encode("ascii"))).rstrip(b"=").decode("ascii")
+        try:
+            filename = os.path.relpath(filename, site_package_dir)
+        except ValueError:
+            pass
+        w.writerow([filename, sha256hex, length])
 
-    @override
-    def read(self, size: Optional[int] = None) -> bytes:
-        size = self.size() if size is None else size
-        return self._buffer[:size]
+    return (dist_dir, [("INSTALLER", "vsrepo"), ("METADATA", metadata), ("RECORD", record.getvalue())])
 
-    @override
-    def seek(self, offset: int, whence: int = 0) -> int:
-        return 0
+def install_package_meta(files: List[Tuple[str, str, str]], pkg: MutableMapping, rel: MutableMapping, index: int) -> None:
+    if site_package_dir is None:
+        return
 
-    @override
-    def flush(self) -> None:
-        pass
+    dist_dir, contents = make_package_meta(files, pkg, rel, index)
 
-    @override
-    def size(self) -> int:
-        return len(self._buffer)
+    remove_package_meta(pkg)
 
-class MyFactory(py7zr.WriterFactory):
-    def __init__(self, size):
-        self.size = size
-        self.products = {}
+    os.mkdir(dist_dir)
+    for fname, data in contents:
+        with open(os.path.join(dist_dir, fname), "w", newline="") as f:
+            f.write(data)
 
-    @override
-    def create(self, filename: str) -> Py7zIO:
-        product = MyIO(self.size)
-        self.products[filename] = product
-        return product
+def is_package_meta_current(dist_dir: str, contents: List[Tuple[str, str]]) -> bool:
+    for fname, data in contents:
+        try:
+            with open(os.path.join(dist_dir, fname), "r", newline="") as f:
+                if f.read() != data:
+                    return False
+        except (OSError, UnicodeDecodeError):
+            return False
+    return True
+
+# the sha256 of the downloaded file itself when the definitions have it
+def get_download_hash(bin_rel: MutableMapping) -> Optional[str]:
+    if 'hash' in bin_rel:
+        return bin_rel['hash']
+    if len(bin_rel['files']) == 1:
+        for fn_props in bin_rel['files'].values():
+            if fn_props[0] == bin_rel['url'].rsplit('/', 2)[-1]:
+                return fn_props[1]
+    return None
 
-def install_files(p: MutableMapping) -> Tuple[int, int]:
-    err = (0, 1)
-    dest_path = get_install_path(p)
+class PreparedFiles(NamedTuple):
+    rel: MutableMapping
+    index: int
+    path: Optional[str] # the downloaded file, None when everything was already stored
+    files: MutableMapping # install_fn -> (source file, sha256, size), the source is None when the download is the file itself, wheel members are
+                          # keyed by their path in the wheel and hashed with the algorithm their RECORD uses
+    staging_dir: Optional[str] # set when the sources are staged in the install path and can simply be moved into place
+
+def get_wheel_basename(zf: zipfile.ZipFile) -> str:
+    basename: Optional[str] = None
+    for fn in zf.namelist():
+        if fn.endswith('.dist-info/WHEEL'):
+            basename = fn[:-len('.dist-info/WHEEL')]
+            break
+    if basename is None:
+        raise Exception('Wheel: failed to determine package base name')
+    for fn in zf.namelist():
+        if fn.startswith(basename + '.data'):
+            raise Exception('Wheel: .data dir mapping not supported')
+    wheelfile = zf.read(basename + '.dist-info/WHEEL').decode().splitlines()
+    wheeldict = {}
+    for line in wheelfile:
+        tmp = line.split(': ', 2)
+        if len(tmp) == 2:
+            wheeldict[tmp[0]] = tmp[1]
+    if wheeldict['Wheel-Version'] != '1.0':
+        raise Exception('Wheel: only version 1.0 supported')
+    if wheeldict['Root-Is-Purelib'] != 'true':
+        raise Exception('Wheel: only purelib root supported')
+    return basename
+
+# the algorithm and hex digest of a RECORD hash column or None if it's empty
+def decode_record_hash(value: str) -> Optional[Tuple[str, str]]:
+    algorithm, _, b64 = value.partition('=')
+    if not b64:
+        return None
+    return (algorithm, binascii.hexlify(base64.urlsafe_b64decode(b64 + '=' * (-len(b64) % 4))).decode('ascii'))
+
+# every member but the RECORD and its signatures needs a hash in the RECORD, computed with one of these algorithms
+wheel_record_algorithms = ('sha256', 'sha384', 'sha512')
+
+# members are spread over several workers that each open the wheel themselves, zlib releases the GIL while inflating
+wheel_extract_workers = 4
+
+# streams members of a wheel into numbered files in staging_dir and checks them against the hashes from its RECORD
+def extract_wheel_members(path: str, members: List[Tuple[int, str]], record: MutableMapping, staging_dir: str) -> MutableMapping:
+    staged: MutableMapping = {}
+    with zipfile.ZipFile(path, 'r') as zf:
+        for index, name in members:
+            expected = record.get(name)
+            hasher = hashlib.new(expected[0] if expected is not None else 'sha256')
+            staged_path = os.path.join(staging_dir, str(index))
+            size = 0
+            with zf.open(name) as src, open(staged_path, 'wb') as dst:
+                # ZipExtFile.readinto() only copies what read() returns so the chunks are used as they are
+                while True:
+                    data = src.read(1024 * 1024)
+                    if not data:
+                        break
+                    hasher.update(data)
+                    dst.write(data)
+                    size += len(data)
+            if (expected is not None) and (hasher.hexdigest() != expected[1]):
+                raise ValueError('Hash mismatch for ' + name + ' got ' + hasher.hexdigest() + ' but expected ' + expected[1])
+            staged[name] = (staged_path, hasher.hexdigest(), size)
+    return staged
+
+# returns member -> (staged file, digest, size) for every file in the wheel
+def extract_wheel(path: str, basename: str, staging_dir: str) -> MutableMapping:
+    with zipfile.ZipFile(path, 'r') as zf:
+        names = [info.filename for info in zf.infolist() if not info.is_dir()]
+        record: MutableMapping = {}
+        for row in csv.reader(io.StringIO(zf.read(basename + '.dist-info/RECORD').decode('utf-8'))):
+            if len(row) > 1 and row[1]:
+                record[row[0]] = decode_record_hash(row[1])
+    unhashed = {basename + '.dist-info/' + fn for fn in ('RECORD', 'RECORD.jws', 'RECORD.p7s')}
+    for name in names:
+        parts = name.split('/')
+        if name.startswith('/') or '..' in parts or ':' in parts[0] or '\\' in name:
+            raise ValueError('Wheel: invalid member path ' + name)
+        if name in unhashed:
+            continue
+        expected = record.get(name)
+        if expected is None:
+            raise ValueError('Wheel: no hash in RECORD for ' + name)
+        if expected[0] not in wheel_record_algorithms:
+            raise ValueError('Wheel: unsupported hash algorithm ' + expected[0] + ' for ' + name)
+    members = list(enumerate(names))
+    workers = max(1, min(wheel_extract_workers, os.cpu_count() or 1, len(members)))
+    staged: MutableMapping = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(lambda i: extract_wheel_members(path, members[i::workers], record, staging_dir), range(workers)):
+            staged.update(result)
+    return staged
+
+# downloads, extracts and verifies everything needed to install a package without touching the install paths,
+# this is the part that's safe to run on several packages at once
+# installs the latest installable release unless a release of p is given
+def prepare_files(p: MutableMapping, progress: Optional[DownloadProgress] = None, release: Optional[MutableMapping] = None) -> Optional[PreparedFiles]:
     bin_name = get_bin_name(p)
-    idx, install_rel = get_latest_installable_release_with_index(p)
+    if release is None:
+        idx, install_rel = get_latest_installable_release_with_index(p)
+    else:
+        idx, install_rel = p['releases'].index(release), release
     if install_rel is None:
-        return err
+        return None
     url = install_rel[bin_name]['url']
-    data: Optional[bytearray] = None
+    if bin_name != 'wheel':
+        stored = find_stored_release(install_rel[bin_name])
+        if stored is not None:
+            return PreparedFiles(install_rel, idx, None, stored, None)
     try:
-        data = fetch_url_cached(url, p['name'] + ' ' + install_rel['version'])
+        with timed('download ' + p['name'], 'download', package=p['identifier']):
+            path, digest = fetch_url_cached(url, p['name'] + ' ' + install_rel['version'], progress, get_download_hash(install_rel[bin_name]))
     except:
         print('Failed to download ' + p['name'] + ' ' + install_rel['version'] + ', skipping installation and moving on')
+        return None
+
+    result_cache = {}
+    staging_dir: Optional[str] = None
+
+    if bin_name == 'wheel':
+        try:
+            if digest != install_rel[bin_name]['hash']:
+                raise ValueError('Hash mismatch for ' + url + ' got ' + str(digest) + ' but expected ' + install_rel[bin_name]['hash'])
+            with zipfile.ZipFile(path, 'r') as zf:
+                basename = get_wheel_basename(zf)
+            # staged next to the install path so the verified files only have to be renamed into place
+            os.makedirs(get_install_path(p), exist_ok=True)
+            staging_dir = tempfile.mkdtemp(prefix='.vsrepo', dir=get_install_path(p))
+            temporary_dirs.append(staging_dir)
+            with timed('extract ' + p['name'], 'extract', package=p['identifier']):
+                result_cache = extract_wheel(path, basename, staging_dir)
+        except BaseException as e:
+            if staging_dir is not None:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+            print('Failed to decompress ' + p['name'] + ' ' + install_rel['version'] + ' with error: ' + str(e) + ', skipping installation and moving on')
+            return None
+    else:
+        try:
+            single_file: Optional[Tuple[str, str, str]] = None
+            if len(install_rel[bin_name]['files']) == 1:
+                for key in install_rel[bin_name]['files']:
+                    single_file = (key, install_rel[bin_name]['files'][key][0], install_rel[bin_name]['files'][key][1])
+            if (single_file is not None) and (single_file[1] == url.rsplit('/', 2)[-1]):
+                install_fn = single_file[0]
+                if digest != single_file[2]:
+                    raise ValueError('Hash mismatch for ' + install_fn + ' got ' + str(digest) + ' but expected ' + single_file[2])
+                result_cache[install_fn] = (None, single_file[2], os.path.getsize(path))
+            else:
+                filename_list = []
+                for install_fn in install_rel[bin_name]['files']:
+                    filename_list.append(install_rel[bin_name]['files'][install_fn][0])
+
+                from vsrepo.archive import extract_members
+
+                # staged in the cache dir when the files will be stored, otherwise next to the install path so the verified
+                # files only have to be renamed into place
+                use_store = options.cache_size > 0
+                staging_parent = cache_path if use_store else get_install_path(p)
+                os.makedirs(staging_parent, exist_ok=True)
+                staging_dir = tempfile.mkdtemp(prefix='.vsrepo', dir=staging_parent)
+                temporary_dirs.append(staging_dir)
+                with timed('extract ' + p['name'], 'extract', package=p['identifier']):
+                    staged = extract_members(path, filename_list, '7z' if url.endswith('.7z') else 'zip', staging_dir, cmd7zip_path)
+
+                for install_fn in install_rel[bin_name]['files']:
+                    fn_props = install_rel[bin_name]['files'][install_fn]
+                    staged_path, staged_hash, staged_size = staged[fn_props[0]]
+                    if staged_hash != fn_props[1]:
+                        raise ValueError('Hash mismatch for ' + install_fn + ' got ' + staged_hash + ' but expected ' + fn_props[1])
+                    if use_store and os.path.exists(staged_path):
+                        staged_path = store_file(staged_path, staged_hash)
+                    elif use_store:
+                        # the member was already stored for another install_fn
+                        staged_path = get_cache_file(staged_hash)
+                    result_cache[install_fn] = (staged_path, fn_props[1], staged_size)
+
+                if use_store:
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+                    staging_dir = None
+        except BaseException as e:
+            if staging_dir is not None:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+            print('Failed to decompress ' + p['name'] + ' ' + install_rel['version'] + ' with error: ' + str(e) + ', skipping installation and moving on')
+            return None
+
+    return PreparedFiles(install_rel, idx, path, result_cache, staging_dir)
+
+# writes the files of a prepared package to the install path, always called from the main thread and in dependency order
+def commit_files(p: MutableMapping, prepared: Optional[PreparedFiles]) -> Tuple[int, int]:
+    err = (0, 1)
+    if prepared is None:
         return err
+    dest_path = get_install_path(p)
+    bin_name = get_bin_name(p)
+    install_rel = prepared.rel
 
     files: List[Tuple[str, str, str]] = []
 
     if bin_name == 'wheel':
         try:
-            hash_result = check_hash(data, install_rel[bin_name]['hash'])
-            if not hash_result[0]:
-                raise ValueError('Hash mismatch for ' + url + ' got ' + hash_result[1] + ' but expected ' + hash_result[2])
-            with zipfile.ZipFile(io.BytesIO(data), 'r') as zf:
-                basename: Optional[str] = None
-                for fn in zf.namelist():
-                    if fn.endswith('.dist-info/WHEEL'):
-                        basename = fn[:-len('.dist-info/WHEEL')]
-                        break
-                if basename is None:
-                    raise Exception('Wheel: failed to determine package base name')
-                for fn in zf.namelist():
-                    if fn.startswith(basename + '.data'):
-                        raise Exception('Wheel: .data dir mapping not supported')
-                wheelfile = zf.read(basename + '.dist-info/WHEEL').decode().splitlines()
-                wheeldict = {}
-                for line in wheelfile:
-                    tmp = line.split(': ', 2)
-                    if len(tmp) == 2:
-                        wheeldict[tmp[0]] = tmp[1]
-                if wheeldict['Wheel-Version'] != '1.0':
-                    raise Exception('Wheel: only version 1.0 supported')
-                if wheeldict['Root-Is-Purelib'] != 'true':
-                    raise Exception('Wheel: only purelib root supported')
-                zf.extractall(path=dest_path)
-                with open(os.path.join(dest_path, basename + '.dist-info', 'INSTALLER'), mode='w') as f:
-                    f.write("vsrepo")
-                with open(os.path.join(dest_path, basename + '.dist-info', 'RECORD')) as f:
-                    contents = f.read()
-                with open(os.path.join(dest_path, basename + '.dist-info', 'RECORD'), mode='a') as f:
-                    if not contents.endswith("\n"):
-                        f.write("\n")
-                    f.write(basename + '.dist-info/INSTALLER,,\n')
+            record_name = next(fn for fn in prepared.files if fn.endswith('.dist-info/RECORD') and fn.count('/') == 1)
+            dist_info = record_name[:-len('/RECORD')]
+            # the dist-info of another installed version would be found next to the new one
+            if is_package_installed(p['identifier']):
+                uninstall_files(p)
+            for member, (source, _, _) in prepared.files.items():
+                if member == record_name:
+                    continue
+                os.makedirs(os.path.join(dest_path, os.path.dirname(member)), exist_ok=True)
+                os.replace(source, os.path.join(dest_path, member))
+            with open(os.path.join(dest_path, dist_info, 'INSTALLER'), mode='w') as f:
+                f.write("vsrepo")
+            # the RECORD gets the INSTALLER line appended as it's written
+            with open(prepared.files[record_name][0], 'r', encoding='utf-8', newline='') as f:
+                contents = f.read()
+            if not contents.endswith("\n"):
+                contents += "\n"
+            with open(os.path.join(dest_path, record_name), mode='w', encoding='utf-8', newline='') as f:
+                f.write(contents + dist_info + '/INSTALLER,,\n')
+            shutil.rmtree(prepared.staging_dir, ignore_errors=True)
         except BaseException as e:
             print('Failed to decompress ' + p['name'] + ' ' + install_rel['version'] + ' with error: ' + str(e) + ', skipping installation and moving on')
             return err
     else:
-        single_file: Optional[Tuple[str, str, str]] = None
-        if len(install_rel[bin_name]['files']) == 1:
-            for key in install_rel[bin_name]['files']:
-                single_file = (key, install_rel[bin_name]['files'][key][0], install_rel[bin_name]['files'][key][1])
-        if (single_file is not None) and (single_file[1] == url.rsplit('/', 2)[-1]):
-            install_fn = single_file[0]
-            hash_result = check_hash(data, single_file[2])
-            if not hash_result[0]:
-                raise Exception('Hash mismatch for ' + install_fn + ' got ' + hash_result[1] + ' but expected ' + hash_result[2])
-            uninstall_files(p)
+        uninstall_files(p)
+        # a staged member can be used by several install_fns, only the first one gets to move it
+        moved: MutableMapping = {}
+        for install_fn, (source, file_hash, file_size) in prepared.files.items():
             os.makedirs(os.path.join(dest_path, os.path.split(install_fn)[0]), exist_ok=True)
-            with open(os.path.join(dest_path, install_fn), 'wb') as outfile:
-                files.append((os.path.join(dest_path, install_fn), single_file[2], str(len(data))))
-                outfile.write(data)
-        else:
-            tffd, tfpath = tempfile.mkstemp(prefix='vsm')
-            with open(tffd, mode='wb') as tf:
-                tf.write(data)
-            result_cache = {}
-            filename_list = []
-            for install_fn in install_rel[bin_name]['files']:
-                filename_list.append(install_rel[bin_name]['files'][install_fn][0])
-                
-            factory = MyFactory(1024 * 1024 * 512)    
-            if url.endswith('.7z'):
-                try:
-                    with py7zr.SevenZipFile(tfpath, 'r') as archive:
-                        archive.extract(targets=filename_list, factory=factory)
-                except py7zr.exceptions.UnsupportedCompressionMethodError:
-                    for filename in filename_list:
-                        result = subprocess.run([cmd7zip_path, "e", "-so", tfpath, filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        result.check_returncode()
-                        factory.create(filename)
-                        factory.products[filename].write(result.stdout)
+            files.append((os.path.join(dest_path, install_fn), str(file_hash), str(file_size)))
+            if source is None:
+                source = prepared.path
+            if source in moved:
+                shutil.copyfile(moved[source], os.path.join(dest_path, install_fn))
+            elif prepared.staging_dir is not None:
+                os.replace(source, os.path.join(dest_path, install_fn))
+                moved[source] = os.path.join(dest_path, install_fn)
             else:
-                with zipfile.ZipFile(tfpath, 'r') as archive:
-                    for filename in filename_list:
-                        factory.create(filename)
-                        factory.products[filename].write(archive.read(filename))
-
-            for install_fn in install_rel[bin_name]['files']:
-                fn_props = install_rel[bin_name]['files'][install_fn]
-                file_data = factory.products[fn_props[0]].read()
-                hash_result = check_hash(file_data, fn_props[1])
-                if not hash_result[0]:
-                    raise Exception('Hash mismatch for ' + install_fn + ' got ' + hash_result[1] + ' but expected ' + hash_result[2])
-                result_cache[install_fn] = (file_data, fn_props[1])
-            uninstall_files(p)
-            for install_fn in install_rel[bin_name]['files']:
-                os.makedirs(os.path.join(dest_path, os.path.split(install_fn)[0]), exist_ok=True)
-                with open(os.path.join(dest_path, install_fn), 'wb') as outfile:
-                    files.append((os.path.join(dest_path, install_fn), str(result_cache[install_fn][1]), str(len(result_cache[install_fn][0]))))
-                    outfile.write(result_cache[install_fn][0])
-            os.remove(tfpath)
+                link_file(source, os.path.join(dest_path, install_fn))
+            record_installed_file(os.path.join(dest_path, install_fn), file_hash, p['identifier'], install_rel['version'])
 
-        install_package_meta(files, p, install_rel, idx)
+        install_package_meta(files, p, install_rel, prepared.index)
+        if prepared.staging_dir is not None:
+            shutil.rmtree(prepared.staging_dir, ignore_errors=True)
 
     installed_packages[p['identifier']] = install_rel['version']
     print('Successfully installed ' + p['name'] + ' ' + install_rel['version'])
     return (1, 0)
 
-def install_package(name: str) -> Tuple[int, int, int]:
-    p = get_package_from_name(name)
+def install_files(p: MutableMapping, release: Optional[MutableMapping] = None) -> Tuple[int, int]:
+    prepared = prepare_files(p, None, release)
+    with timed('write ' + p['name'], 'write', package=p['identifier']):
+        return commit_files(p, prepared)
+
+# Installs and upgrades are resolved into a plan before anything is downloaded. Every package is looked up once, its
+# dependencies are followed transitively and each package ends up in the plan at most once, after everything it
+# requires. Dependency cycles are reported and the edge closing the cycle is ignored.
+class PlanEntry(NamedTuple):
+    package: MutableMapping
+    release: MutableMapping # the release that will be installed
+    is_dep: bool
+    requires: List[str] # identifiers of the plan entries that have to be installed first
+
+class InstallPlan:
+    def __init__(self):
+        self.entries: MutableMapping = {} # identifier -> PlanEntry in install order
+        self.resolved: MutableMapping = {} # dependency name -> package or None if it doesn't exist
+        self.visited: set = set()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def find_dependency(self, name: str) -> Optional[MutableMapping]:
+        if name not in self.resolved:
+            try:
+                self.resolved[name] = get_package_from_name(name)
+            except ValueError:
+                self.resolved[name] = None
+        return self.resolved[name]
+
+# adds p and whatever it depends on that isn't installed yet, installed packages are only added again if reinstall is set,
+# returns the identifiers of packages that can't be installed
+def add_to_plan(p: MutableMapping, plan: InstallPlan, is_dep: bool, reinstall: bool, chain: List[str]) -> List[str]:
+    id = p['identifier']
+    if id in plan.entries:
+        if not is_dep and plan.entries[id].is_dep:
+            plan.entries[id] = plan.entries[id]._replace(is_dep=False)
+        return []
+    if id in chain:
+        print('Dependency cycle ' + ' -> '.join(chain[chain.index(id):] + [id]) + ' ignored')
+        return []
+    if id in plan.visited and not reinstall:
+        return []
+    plan.visited.add(id)
+
     if p.get('pypiname'):
         print_pypi_notice(p)
-        return (0, 0, 1)
-    if can_install(p):
-        inst = (0, 0, 0)
-        if not args.skip_deps:
-            if 'dependencies' in p:
-                for dep in p['dependencies']:
-                    if not isinstance(dep, str):
-                        continue
-                    res = install_package(dep)
-                    inst = (inst[0], inst[1] + res[0] + res[1], inst[2] + res[2])
-        if not is_package_installed(p['identifier']):
-            fres = install_files(p)
-            inst = (inst[0] + fres[0], inst[1], inst[2] + fres[1])
-        return inst
-    else:
-        print('No binaries available for ' + args.target + ' in package ' + p['name'] + ', skipping installation')
-        return (0, 0, 1)
-
-def upgrade_files(p: MutableMapping) -> Tuple[int, int, int]:
-    if can_install(p):
-        inst = (0, 0, 0)
-        if 'dependencies' in p:
-            for dep in p['dependencies']:
-                if not is_package_installed(dep):
-                    res = install_package(dep)
-                    inst = (inst[0], inst[1] + res[0] + res[1], inst[2] + res[2])
-        fres = install_files(p)
-        return (inst[0] + fres[0], inst[1], inst[2] + fres[1])
-    else:
-        print('No binaries available for ' + args.target + ' in package ' + p['name'] + ', skipping installation')
-        return (0, 0, 1)
+        return [id]
+    release = get_latest_installable_release(p)
+    if release is None:
+        print('No binaries available for ' + options.target + ' in package ' + p['name'] + ', skipping installation')
+        return [id]
+
+    failed: List[str] = []
+    requires: List[str] = []
+    if not options.skip_deps:
+        for dep in p.get('dependencies', []):
+            if not isinstance(dep, str):
+                continue
+            dp = plan.find_dependency(dep)
+            if dp is None:
+                print('Dependency ' + dep + ' of ' + p['name'] + ' not found')
+                failed.append(dep)
+                continue
+            failed += add_to_plan(dp, plan, True, False, chain + [id])
+            if dp['identifier'] in plan.entries:
+                requires.append(dp['identifier'])
+    if reinstall or not is_package_installed(id):
+        plan.entries[id] = PlanEntry(p, release, is_dep, requires)
+    return failed
+
+class InstallResult(NamedTuple):
+    installed: List[Tuple[str, str]] # (identifier, version) of the requested packages
+    dependencies: List[Tuple[str, str]] # (identifier, version) of the dependencies installed along with them
+    failed: List[str] # identifiers
+
+def run_install_plan(plan: InstallPlan) -> InstallResult:
+    result = InstallResult([], [], [])
+
+    def add_result(entry: PlanEntry, fres: Tuple[int, int]) -> None:
+        p = entry.package
+        if fres[1] > 0:
+            result.failed.append(p['identifier'])
+        elif entry.is_dep:
+            result.dependencies.append((p['identifier'], installed_packages[p['identifier']]))
+        else:
+            result.installed.append((p['identifier'], installed_packages[p['identifier']]))
+
+    progress: Optional[DownloadProgress] = None
+    if options.jobs > 1 and len(plan) > 1:
+        progress = DownloadProgress('Downloading {} packages'.format(len(plan)))
 
-def upgrade_package(name, force) -> Tuple[int, int, int]:
-    inst = (0, 0, 0)
+    if progress is None:
+        for entry in plan.entries.values():
+            add_result(entry, install_files(entry.package, entry.release))
+        return result
+
+    try:
+        # downloads and extraction overlap freely in the pool, a package is written to the install paths as soon as it's
+        # ready and everything it requires has been written
+        with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+            futures = {id: executor.submit(prepare_files, entry.package, progress, entry.release) for id, entry in plan.entries.items()}
+            pending = list(plan.entries.values())
+            done: set = set()
+            while len(pending) > 0:
+                ready = [entry for entry in pending if futures[entry.package['identifier']].done() and all(r in done for r in entry.requires)]
+                if len(ready) == 0:
+                    wait([futures[entry.package['identifier']] for entry in pending if not futures[entry.package['identifier']].done()], return_when=FIRST_COMPLETED)
+                    continue
+                for entry in ready:
+                    with timed('write ' + entry.package['name'], 'write', package=entry.package['identifier']):
+                        fres = commit_files(entry.package, futures[entry.package['identifier']].result())
+                    add_result(entry, fres)
+                    done.add(entry.package['identifier'])
+                    pending.remove(entry)
+    finally:
+        progress.close()
+    return result
+
+# the download size of every plan entry, 0 when it's already in the download cache and None if the server doesn't say
+def get_plan_download_sizes(plan: InstallPlan) -> MutableMapping:
+    def get_size(entry: PlanEntry) -> Optional[int]:
+        bin_rel = entry.release[get_bin_name(entry.package)]
+        url = bin_rel['url']
+        mirrored = get_mirrored_url(url)
+        if url in download_cache or (options.cache_size > 0 and os.path.isfile(get_cache_file(get_cache_key(url, get_download_hash(bin_rel))))):
+            return 0
+        if mirrored is not None:
+            return mirrored[2]
+        try:
+            with http_request(url, method='HEAD') as urlreq:
+                size = urlreq.headers['content-length']
+                return int(size) if size is not None else None
+        except (OSError, http.client.HTTPException, ValueError):
+            return None
+
+    entries = list(plan.entries.values())
+    with ThreadPoolExecutor(max_workers=max(options.jobs, 8)) as executor:
+        return {entry.package['identifier']: size for entry, size in zip(entries, executor.map(get_size, entries))}
+
+def print_install_plan(plan: InstallPlan) -> None:
+    if len(plan) == 0:
+        print('Nothing to install')
+        return
+    sizes = get_plan_download_sizes(plan)
+    plan_print_string = '{:25s} {:11s} {:11s} {:>10s}  {:s}'
+    print(plan_print_string.format('Name', 'Installed', 'Version', 'Download', 'Requires'))
+    for id, entry in plan.entries.items():
+        size = sizes[id]
+        print(plan_print_string.format(entry.package['name'] + (' (dependency)' if entry.is_dep else ''), installed_packages.get(id, ''), entry.release['version'],
+                                       format_size(size) if size is not None else 'unknown', ', '.join(entry.requires)))
+    total = sum(size for size in sizes.values() if size is not None)
+    unknown = sum(1 for size in sizes.values() if size is None)
+    print('{} {}, {} to download{}'.format(len(plan), 'package' if len(plan) == 1 else 'packages', format_size(total),
+                                           ' plus {} of unknown size'.format(unknown) if unknown > 0 else ''))
+
+# the planning functions return the identifiers of packages that can't be installed
+def install_package(name: str, plan: InstallPlan, is_dep: bool = False) -> List[str]:
+    return add_to_plan(get_package_from_name(name), plan, is_dep, False, [])
+
+def upgrade_files(p: MutableMapping, plan: InstallPlan) -> List[str]:
+    return add_to_plan(p, plan, False, True, [])
+
+def upgrade_package(name: str, force: bool, plan: InstallPlan) -> List[str]:
     p = get_package_from_name(name)
     if p.get('pypiname'):
         print_pypi_notice(p)
-        return inst
+        return []
     if not is_package_installed(p['identifier']):
         print('Package ' + p['name'] + ' not installed, can\'t upgrade')
     elif is_package_upgradable(p['identifier'], force):
-        res = upgrade_files(p)
-        return (res[0], 0, res[1])
+        return upgrade_files(p, plan)
     elif not is_package_upgradable(p['identifier'], True):
         print('Package ' + p['name'] + ' not upgraded, latest version installed')
     else:
         print('Package ' + p['name'] + ' not upgraded, unknown version must use -f to force replacement')
-    return inst
+    return []
 
-def upgrade_all_packages(force: bool) -> Tuple[int, int, int]:
-    inst = (0, 0, 0)
+def upgrade_all_packages(force: bool, plan: InstallPlan) -> List[str]:
+    failed: List[str] = []
     installed_ids: List[str] = list(installed_packages.keys())
     for id in installed_ids:
         if is_package_upgradable(id, force):
             pkg = get_package_from_id(id, True)
             if pkg is None:
-                return inst
+                return failed
             if pkg.get('pypiname'):
                 print_pypi_notice(pkg)
                 continue
-            res = upgrade_files(pkg)
-            inst = (inst[0] + res[0], inst[1] + res[1], inst[2] + res[2])
-    return inst
+            failed += upgrade_files(pkg, plan)
+    return failed
 
 def uninstall_files(p: MutableMapping) -> None:
     dest_path = get_install_path(p)
@@ -684,7 +1911,6 @@ def uninstall_files(p: MutableMapping) -> None:
                     tmp = line.split(',')
                     if len(tmp) > 0 and len(tmp[0]) > 0:
                         files.append(tmp[0])
-        print(files)
         for f in files:
             try:
                 os.remove(os.path.join(dest_path, f))
@@ -692,6 +1918,16 @@ def uninstall_files(p: MutableMapping) -> None:
                 print('File removal error: ' + str(e))
         for dist_dir in find_dist_dirs(pyname, dest_path):
             rmdir(dist_dir)
+        # package and __pycache__ dirs left empty, deepest first
+        dirs = set()
+        for f in files:
+            d = os.path.dirname(os.path.normpath(f))
+            while d not in ('', os.curdir, os.pardir) and not d.startswith(os.pardir + os.sep):
+                dirs.add(d)
+                d = os.path.dirname(d)
+        for d in sorted(dirs, key=lambda d: d.count(os.sep), reverse=True):
+            with contextlib.suppress(OSError):
+                os.rmdir(os.path.join(dest_path, d))
     else:
         installed_rel: Optional[MutableMapping] = None
         if p['identifier'] in installed_packages:
@@ -702,56 +1938,639 @@ def uninstall_files(p: MutableMapping) -> None:
         if installed_rel is not None:
             for f in installed_rel[bin_name]['files']:
                 os.remove(os.path.join(dest_path, f))
+                forget_installed_file(os.path.join(dest_path, f))
+        # compiled bytecode is only listed in the RECORD, the __pycache__ dirs it leaves empty go too
+        if site_package_dir is not None:
+            cache_dirs = set()
+            for dist_dir in find_dist_dirs(get_python_package_name(p)):
+                try:
+                    for path, _ in read_dist_record(site_package_dir, dist_dir):
+                        if path.endswith('.pyc') and os.path.isfile(path):
+                            os.remove(path)
+                            forget_installed_file(path)
+                            cache_dirs.add(os.path.dirname(path))
+                except OSError as e:
+                    print('File removal error: ' + str(e))
+            for d in cache_dirs:
+                with contextlib.suppress(OSError):
+                    os.rmdir(d)
 
         remove_package_meta(p)
 
-def uninstall_package(name: str) -> Tuple[int, int]:
+# returns the version that was removed or None if nothing was uninstalled
+def uninstall_package(name: str) -> Optional[str]:
     p = get_package_from_name(name)
     if is_package_installed(p['identifier']):
         if installed_packages[p['identifier']] == 'Unknown':
             print('Can\'t uninstall unknown version of package: ' + p['name'])
-            return (0, 0)
+            return None
         else:
             uninstall_files(p)
-            print('Uninstalled package: ' + p['name'] + ' ' + installed_packages[p['identifier']])
-            return (1, 0)
+            version = installed_packages.pop(p['identifier'])
+            print('Uninstalled package: ' + p['name'] + ' ' + version)
+            return version
     else:
         print('No files installed for ' + p['name'] + ', skipping uninstall')
-        return (0, 0)
+        return None
 
-def update_package_definition(url: str) -> None:
-    localmtimeval = 0.0
+# Verification hashes every file that belongs to a package again, the installed state is only used to know which
+# package and version vsrepo put a file there for so packages with broken files are still checked against their release
+class VerifyResult(NamedTuple):
+    files: int
+    missing: List[MutableMapping]
+    modified: List[MutableMapping]
+    orphaned: List[MutableMapping]
+    unknown: List[str]
+
+def stat_and_hash_file(path: str) -> Optional[Tuple[os.stat_result, str]]:
     try:
-        localmtimeval = os.path.getmtime(package_json_path)
+        st = os.stat(path)
+        return (st, hash_file(path))
+    except FileNotFoundError:
+        return None
+
+# hashes all paths on a thread pool and stores the fresh hashes in the installed state, returns path -> sha256 or None if missing
+def rehash_files(paths: Sequence[str]) -> MutableMapping:
+    global installed_state_dirty
+    state = load_installed_state()
+    digests: MutableMapping = {}
+    with ThreadPoolExecutor(max_workers=max(options.jobs, os.cpu_count() or 1)) as executor:
+        for path, result in zip(paths, executor.map(stat_and_hash_file, paths)):
+            old = state.pop(path, None)
+            if result is None:
+                digests[path] = None
+            else:
+                digests[path] = result[1]
+                state[path] = make_state_entry(result[0], result[1], old.get('package') if old else None, old.get('version') if old else None)
+            installed_state_dirty = True
+    return digests
+
+def get_release_files(p: MutableMapping, version: str) -> Optional[MutableMapping]:
+    bin_name = get_bin_name(p)
+    for rel in p['releases']:
+        if rel['version'] == version and bin_name in rel:
+            return rel[bin_name]['files']
+    return None
+
+# (path, sha256 or None) for every file listed in the RECORD of a dist-info dir
+def read_dist_record(dest_path: str, dist_dir: str) -> List[Tuple[str, Optional[str]]]:
+    entries: List[Tuple[str, Optional[str]]] = []
+    with open(os.path.join(dist_dir, 'RECORD'), 'r', newline='') as rec:
+        for row in csv.reader(rec):
+            if len(row) == 0 or len(row[0]) == 0:
+                continue
+            sha256 = None
+            if len(row) > 1 and row[1].startswith('sha256='):
+                sha256 = decode_record_hash(row[1])[1]
+            entries.append((os.path.abspath(os.path.join(dest_path, row[0])), sha256))
+    return entries
+
+def verify_installed_files() -> VerifyResult:
+    state = load_installed_state()
+
+    # the version every package was installed as according to the state, used when detection no longer recognizes the files
+    recorded_versions: MutableMapping = {}
+    for entry in state.values():
+        if 'package' in entry:
+            recorded_versions.setdefault(entry['package'], entry['version'])
+
+    # hash everything that could belong to a package up front, detection afterwards only looks at the refreshed state
+    paths = set()
+    wheel_records: List[Tuple[MutableMapping, str, List[Tuple[str, Optional[str]]]]] = []
+    for p in package_list or []:
+        dest_path = get_install_path(p)
+        if p['type'] == 'PyWheel':
+            for dist_dir in find_dist_dirs(get_python_package_name(p), dest_path):
+                try:
+                    entries = read_dist_record(dest_path, dist_dir)
+                except (OSError, ValueError, csv.Error):
+                    continue
+                wheel_records.append((p, os.path.basename(dist_dir)[len(get_python_package_name(p)) + 1:-10], entries))
+                paths.update(path for path, sha256 in entries if sha256 is not None)
+        else:
+            bin_name = get_bin_name(p)
+            for rel in p['releases']:
+                if bin_name in rel:
+                    for f in rel[bin_name]['files']:
+                        path = os.path.abspath(os.path.join(dest_path, f))
+                        if os.path.exists(path):
+                            paths.add(path)
+    paths.update(path for path, entry in state.items() if 'package' in entry)
+    digests = rehash_files(sorted(paths))
+    detect_installed_packages()
+
+    missing: List[MutableMapping] = []
+    modified: List[MutableMapping] = []
+    unknown: List[str] = []
+    claimed = set()
+    nfiles = 0
+
+    def check(path: str, expected: Optional[str], p: MutableMapping, version: str) -> None:
+        nonlocal nfiles
+        nfiles += 1
+        claimed.add(path)
+        # records don't carry a hash for themselves and some generated files, those only have to exist
+        if expected is None:
+            if not os.path.exists(path):
+                missing.append({'package': p['identifier'], 'version': version, 'path': path})
+            return
+        digest = digests.get(path)
+        if digest is None:
+            missing.append({'package': p['identifier'], 'version': version, 'path': path})
+        elif digest != expected:
+            modified.append({'package': p['identifier'], 'version': version, 'path': path, 'expected': expected, 'actual': digest})
+
+    for p, version, entries in wheel_records:
+        for path, sha256 in entries:
+            check(path, sha256, p, version)
+
+    for p in package_list or []:
+        if p['type'] == 'PyWheel':
+            continue
+        version = installed_packages.get(p['identifier'])
+        if version in (None, 'Unknown') and p['identifier'] in recorded_versions:
+            version = recorded_versions[p['identifier']]
+        files = get_release_files(p, version) if version is not None else None
+        if files is None:
+            if version is not None:
+                unknown.append(p['identifier'])
+                # whatever files exist are accounted for even if the release can't be told
+                dest_path = get_install_path(p)
+                bin_name = get_bin_name(p)
+                for rel in p['releases']:
+                    if bin_name in rel:
+                        claimed.update(os.path.abspath(os.path.join(dest_path, f)) for f in rel[bin_name]['files'])
+            continue
+        dest_path = get_install_path(p)
+        for f, props in files.items():
+            check(os.path.abspath(os.path.join(dest_path, f)), props[1], p, version)
+
+    # everything in the plugin directory belongs to vsrepo, elsewhere only files it remembers installing are considered
+    orphaned: List[MutableMapping] = []
+    for root, _, fnames in os.walk(plugin_path):
+        for fname in fnames:
+            path = os.path.abspath(os.path.join(root, fname))
+            if path not in claimed:
+                orphaned.append({'path': path, 'package': state.get(path, {}).get('package')})
+                claimed.add(path)
+    for path, entry in state.items():
+        if 'package' in entry and path not in claimed and digests.get(path) is not None:
+            orphaned.append({'path': path, 'package': entry['package']})
+
+    save_installed_state()
+    return VerifyResult(nfiles, missing, modified, orphaned, unknown)
+
+# A mirror holds the release downloads of a set of packages and targets for machines that can't reach the original hosts.
+# Its manifest.json maps every release url to the mirrored file with its sha256 and size. With --mirror install and
+# upgrade look urls up there first and fall back to the original url when the mirror doesn't have a file or serves a
+# broken one. The package definitions are copied along as vspackages3.zip so update can use the mirror too.
+mirror_manifest_format = 1
+mirror_manifest: Optional[MutableMapping] = None
+mirror_manifest_lock = threading.Lock()
+
+# local paths become file:// urls so http_request can open both
+def get_location_url(location: str, is_dir: bool = False) -> str:
+    if urllib.parse.urlsplit(location).scheme not in ('http', 'https', 'file'):
+        location = Path(os.path.abspath(location)).as_uri()
+    if is_dir and not location.endswith('/'):
+        location += '/'
+    return location
+
+def load_mirror_manifest() -> MutableMapping:
+    global mirror_manifest
+    assert mirror_location is not None
+    with mirror_manifest_lock:
+        if mirror_manifest is None:
+            mirror_manifest = {}
+            try:
+                with http_request(urllib.parse.urljoin(mirror_location, 'manifest.json')) as urlreq:
+                    manifest = json.loads(urlreq.read())
+                if manifest.get('file-format') != mirror_manifest_format:
+                    raise ValueError('unsupported manifest format')
+                mirror_manifest = manifest['files']
+            except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+                print('Failed to read the mirror manifest, using the original urls: ' + str(e))
+        return mirror_manifest
+
+# returns the url of the mirrored copy of url, its sha256 and size or None if it isn't mirrored
+def get_mirrored_url(url: str) -> Optional[Tuple[str, str, int]]:
+    if mirror_location is None:
+        return None
+    entry = load_mirror_manifest().get(url)
+    if entry is None:
+        return None
+    return (urllib.parse.urljoin(mirror_location, urllib.parse.quote(entry['path'])), entry['sha256'], entry['size'])
+
+class MirrorResult(NamedTuple):
+    files: int # number of release downloads in the mirror
+    downloaded: int
+    failed: List[str] # urls that couldn't be mirrored
+
+# the requested packages and everything they depend on, all packages when names is empty
+def get_mirror_packages(names: Sequence[str]) -> List[MutableMapping]:
+    if len(names) == 0:
+        return [p for p in package_list or [] if not p.get('pypiname')]
+    packages: MutableMapping = {}
+    pending = [get_package_from_name(name) for name in names]
+    while len(pending) > 0:
+        p = pending.pop(0)
+        if p['identifier'] in packages:
+            continue
+        packages[p['identifier']] = p
+        if options.skip_deps:
+            continue
+        for dep in p.get('dependencies', []):
+            if not isinstance(dep, str):
+                continue
+            try:
+                pending.append(get_package_from_name(dep))
+            except ValueError:
+                print('Dependency ' + dep + ' of ' + p['name'] + ' not found')
+    return list(packages.values())
+
+def get_mirror_targets(targets: Sequence[str]) -> List[str]:
+    if 'all' not in targets:
+        return list(targets)
+    found: MutableMapping = {}
+    for p in package_list or []:
+        if p['type'] != 'VSPlugin':
+            continue
+        for rel in p['releases']:
+            for key, value in rel.items():
+                if isinstance(value, MutableMapping):
+                    found[key] = None
+    return sorted(found)
+
+# the newest release for every api version the package supports, one of them is what
+# get_latest_installable_release picks on any machine
+def get_mirror_releases(p: MutableMapping, bin_name: str) -> List[MutableMapping]:
+    releases: List[MutableMapping] = []
+    lowest_api: Optional[int] = None
+    for rel in p['releases']:
+        if not isinstance(rel, MutableMapping) or bin_name not in rel:
+            continue
+        bin_api = int(rel[bin_name].get('api', p.get('api', 3)))
+        if bin_api >= 3 and (lowest_api is None or bin_api < lowest_api):
+            releases.append(rel)
+            lowest_api = bin_api
+    return releases
+
+def get_mirror_path(url: str) -> str:
+    basename = urllib.parse.unquote(urllib.parse.urlsplit(url).path.rsplit('/', 1)[-1])
+    basename = re.sub(r'[^A-Za-z0-9._+-]', '_', basename) or 'download'
+    return 'files/' + hashlib.sha256(url.encode('utf-8')).hexdigest()[:16] + '/' + basename
+
+# downloads url into the mirror unless it's already there, verifies it and returns its manifest entry
+def mirror_file(url: str, wanted: MutableMapping, mirror_dir: str, existing: Optional[MutableMapping], progress: DownloadProgress) -> Tuple[MutableMapping, bool]:
+    sha256: Optional[str] = wanted['sha256']
+    if existing is not None and ((sha256 is None) or (existing['sha256'] == sha256)):
+        try:
+            if os.path.getsize(os.path.join(mirror_dir, existing['path'])) == existing['size']:
+                return (dict(existing, releases=wanted['releases']), False)
+        except OSError:
+            pass
+
+    path, digest = fetch_url_cached(url, os.path.basename(url), progress, sha256)
+    if sha256 is not None:
+        if digest != sha256:
+            raise ValueError('Hash mismatch, got ' + str(digest) + ' but expected ' + sha256)
+    else:
+        # only the files in archives are listed in the definitions
+        from vsrepo.archive import extract_members
+        staging_dir = tempfile.mkdtemp(prefix='.vsrepo', dir=mirror_dir)
+        try:
+            staged = extract_members(path, list(wanted['members']), '7z' if url.endswith('.7z') else 'zip', staging_dir, cmd7zip_path)
+            for member, member_hash in wanted['members'].items():
+                if staged[member][1] != member_hash:
+                    raise ValueError('Hash mismatch for ' + member + ' got ' + staged[member][1] + ' but expected ' + member_hash)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        if digest is None:
+            digest = hash_file(path)
+
+    mirror_path = get_mirror_path(url)
+    dest = os.path.join(mirror_dir, mirror_path)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    link_file(path, dest)
+    return ({'path': mirror_path, 'sha256': digest, 'size': os.path.getsize(dest), 'releases': wanted['releases']}, True)
+
+def write_mirror_file(path: str, data: bytes, mtime: Optional[float] = None) -> None:
+    tffd, tfpath = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(path))
+    try:
+        with open(tffd, 'wb') as tf:
+            tf.write(data)
+        if mtime is not None:
+            os.utime(tfpath, times=(mtime, mtime))
+        os.replace(tfpath, path)
     except:
+        os.remove(tfpath)
+        raise
+
+# downloads every release the named packages and their dependencies could install on the given targets into mirror_dir,
+# files already in the mirror are kept and the manifest is extended
+def mirror_packages(names: Sequence[str], targets: Sequence[str], mirror_dir: str) -> MirrorResult:
+    load_package_list()
+    targets = get_mirror_targets(targets)
+
+    # url -> what has to be verified and which releases use it, several targets can share an archive
+    wanted: MutableMapping = {}
+    for p in get_mirror_packages(names):
+        for bin_name in (targets if p['type'] == 'VSPlugin' else [get_bin_name(p)]):
+            for rel in get_mirror_releases(p, bin_name):
+                bin_rel = rel[bin_name]
+                entry = wanted.setdefault(bin_rel['url'], {'sha256': get_download_hash(bin_rel), 'members': {}, 'releases': []})
+                if entry['sha256'] is None:
+                    for fn_props in bin_rel['files'].values():
+                        entry['members'][fn_props[0]] = fn_props[1]
+                entry['releases'].append([p['identifier'], rel['version'], bin_name])
+
+    os.makedirs(mirror_dir, exist_ok=True)
+    manifest_path = os.path.join(mirror_dir, 'manifest.json')
+    files: MutableMapping = {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('file-format') == mirror_manifest_format:
+            files = manifest['files']
+    except (OSError, ValueError, KeyError):
         pass
 
-    headers = {'User-Agent': 'VSRepo'}
-    if package_list is not None:
-        localmtime = email.utils.formatdate(localmtimeval + 10, usegmt=True)
-        headers['If-Modified-Since'] = localmtime
+    result = MirrorResult(0, 0, [])
+    progress = DownloadProgress('Mirroring {} files'.format(len(wanted)))
+    try:
+        with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+            futures = {executor.submit(mirror_file, url, entry, mirror_dir, files.get(url), progress): url for url, entry in wanted.items()}
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    files[url], downloaded = future.result()
+                except Exception as e:
+                    print('Failed to mirror ' + url + ': ' + str(e))
+                    result.failed.append(url)
+                    continue
+                if downloaded:
+                    result = result._replace(downloaded=result.downloaded + 1)
+    finally:
+        progress.close()
+    if options.cache_size > 0:
+        prune_download_cache(options.cache_size * 1024 * 1024)
+
+    write_mirror_file(manifest_path, json.dumps({'file-format': mirror_manifest_format, 'files': files}, indent=2).encode('utf-8'))
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.write(package_json_path, 'vspackages3.json')
+    write_mirror_file(os.path.join(mirror_dir, 'vspackages3.zip'), data.getvalue(), os.path.getmtime(package_json_path))
+    return result._replace(files=len(files))
+
+# A lockfile pins the installed packages to their versions:
+#
+#     {"file-format": 1, "target": "win64", "packages": {"com.vapoursynth.ffms2": {"version": "2.40", "target": "win64", "files": {"ffms2.dll": "<sha256>"}}}}
+#
+# Plugins and scripts list the sha256 of every file like the definitions do, wheels have the hash of the wheel instead.
+# Syncing only touches packages whose installed version differs from the locked one and refuses releases whose hashes
+# changed in the definitions since the lockfile was written.
+lockfile_format = 1
+
+class SyncResult(NamedTuple):
+    installed: List[Tuple[str, str]] # (identifier, version) of the packages installed, upgraded or downgraded to the locked version
+    uninstalled: List[Tuple[str, str]] # (identifier, version) of the packages that aren't in the lockfile
+    failed: List[str] # identifiers
+
+def get_locked_hashes(rel: MutableMapping, bin_name: str) -> MutableMapping:
+    if bin_name == 'wheel':
+        return {'hash': rel[bin_name]['hash']}
+    return {'files': {fn: fd[1] for fn, fd in rel[bin_name]['files'].items()}}
+
+# packages installed with an unknown version can't be locked and are listed in the second value
+def make_lockfile() -> Tuple[MutableMapping, List[str]]:
+    packages: MutableMapping = {}
+    unknown: List[str] = []
+    for id, version in sorted(installed_packages.items()):
+        p = get_package_from_id(id, True)
+        assert p is not None
+        bin_name = get_bin_name(p)
+        rel = next((rel for rel in p['releases'] if rel['version'] == version and bin_name in rel), None)
+        if rel is None:
+            unknown.append(id)
+            continue
+        packages[id] = {'version': version, 'target': bin_name, **get_locked_hashes(rel, bin_name)}
+    return ({'file-format': lockfile_format, 'target': options.target, 'packages': packages}, unknown)
+
+def read_lockfile(path: str) -> MutableMapping:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            lock = json.load(f)
+        if lock.get('file-format') != lockfile_format:
+            raise VSRepoError('Lockfile format is {} but only version {} is supported'.format(lock.get('file-format'), lockfile_format))
+        if not isinstance(lock['packages'], dict) or not all(isinstance(locked, dict) for locked in lock['packages'].values()):
+            raise ValueError('packages must map identifiers to objects')
+        return lock['packages']
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        raise VSRepoError('Failed to read lockfile {}: {}'.format(path, e))
+
+# returns the plan that installs every locked package that isn't installed in the locked version, the identifiers of
+# the installed packages that aren't locked and the packages that can't be synced
+def make_sync_plan(lock: MutableMapping) -> Tuple[InstallPlan, List[str], List[str]]:
+    plan = InstallPlan()
+    releases: MutableMapping = {}
+    failed: List[str] = []
+    for id, locked in lock.items():
+        p = get_package_from_id(id)
+        if p is None:
+            print('Locked package ' + id + ' not found')
+            failed.append(id)
+            continue
+        bin_name = get_bin_name(p)
+        if locked.get('target') != bin_name:
+            print('Package ' + p['name'] + ' is locked for ' + str(locked.get('target')) + ' but would be installed for ' + bin_name)
+            failed.append(id)
+            continue
+        rel = next((rel for rel in p['releases'] if rel['version'] == locked.get('version') and bin_name in rel), None)
+        if rel is None:
+            print('Locked version ' + str(locked.get('version')) + ' of ' + p['name'] + ' not found')
+            failed.append(id)
+        elif get_locked_hashes(rel, bin_name) != {key: locked.get(key) for key in ('hash', 'files') if key in locked}:
+            print('Locked version ' + rel['version'] + ' of ' + p['name'] + ' doesn\'t match the package definitions')
+            failed.append(id)
+        elif installed_packages.get(id) != rel['version']:
+            releases[id] = (p, rel)
+
+    # dependencies are written first when they're part of the sync
+    def add_entry(id: str) -> None:
+        if id in plan.entries or id in plan.visited:
+            return
+        plan.visited.add(id)
+        p, rel = releases[id]
+        requires: List[str] = []
+        for dep in p.get('dependencies', []):
+            dp = plan.find_dependency(dep) if isinstance(dep, str) else None
+            if dp is not None and dp['identifier'] in releases:
+                add_entry(dp['identifier'])
+                if dp['identifier'] in plan.entries:
+                    requires.append(dp['identifier'])
+        plan.entries[id] = PlanEntry(p, rel, False, requires)
+
+    for id in releases:
+        add_entry(id)
+    return (plan, [id for id in installed_packages if id not in lock], failed)
+
+# The server also offers the definitions as one file per package named after its sha256 plus an index listing them in
+# order, see write_package_shards in vsrupdate.py. When local definitions exist only the index and the packages that
+# changed are fetched. The ETags the server sent last time are kept next to the definitions for conditional requests.
+def get_definitions_index_url(url: str) -> str:
+    return urllib.parse.urljoin(url, 'vspackages3-index.json')
+
+def get_definitions_shard_url(url: str, sha256: str) -> str:
+    return urllib.parse.urljoin(url, 'vspackages3/' + sha256 + '.json')
+
+# must produce the same bytes as get_package_shard in vsrupdate.py
+def get_package_shard(p: MutableMapping) -> bytes:
+    return json.dumps(p, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def get_update_state_path() -> str:
+    return os.path.splitext(package_json_path)[0] + '.update.json'
+
+def load_update_state(url: str) -> MutableMapping:
+    try:
+        with open(get_update_state_path(), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('url') == url:
+            return state
+    except (OSError, ValueError):
+        pass
+    return {'url': url}
+
+def save_update_state(state: MutableMapping) -> None:
+    try:
+        with open(get_update_state_path(), 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+    except OSError as e:
+        print('Failed to save update state: ' + str(e))
+
+def get_conditional_headers(etag: Optional[str], localmtimeval: Optional[float]) -> MutableMapping:
+    headers: MutableMapping = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if localmtimeval is not None:
+        headers['If-Modified-Since'] = email.utils.formatdate(localmtimeval + 10, usegmt=True)
+    return headers
+
+def get_remote_modtime(urlreq) -> float:
+    last_modified = urlreq.headers['Last-Modified']
+    if last_modified is None:
+        return time.time()
+    return email.utils.mktime_tz(email.utils.parsedate_tz(last_modified))
+
+def write_package_definition(data: bytes, remote_modtime: float) -> None:
+    os.makedirs(os.path.dirname(package_json_path), exist_ok=True)
+    tffd, tfpath = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(package_json_path))
+    try:
+        with open(tffd, 'wb') as tf:
+            tf.write(data)
+        os.utime(tfpath, times=(remote_modtime, remote_modtime))
+        os.replace(tfpath, package_json_path)
+    except:
+        os.remove(tfpath)
+        raise
+    # the snapshot of the old definitions is rebuilt from the new ones when they're loaded
+    try:
+        os.remove(get_package_snapshot_path())
+    except FileNotFoundError:
+        pass
 
-    req_obj = urllib.request.Request(url, headers=headers)
+# returns True or False like update_package_definition or None if the server has no shards or fetching the whole zip is cheaper
+def update_package_shards(url: str, state: MutableMapping, localmtimeval: Optional[float]) -> Optional[bool]:
     try:
-        with urllib.request.urlopen(req_obj) as urlreq:
-            remote_modtime = email.utils.mktime_tz(email.utils.parsedate_tz(urlreq.info()['Last-Modified']))
+        with http_request(get_definitions_index_url(url), get_conditional_headers(state.get('index-etag'), localmtimeval)) as urlreq:
+            index = json.loads(urlreq.read())
+            etag = urlreq.headers['ETag']
+            remote_modtime = get_remote_modtime(urlreq)
+    except urllib.error.HTTPError as httperr:
+        if httperr.code == 304:
+            return False
+        return None
+    except (OSError, http.client.HTTPException, ValueError):
+        return None
+    if not isinstance(index, dict) or index.get('file-format') != 3:
+        return None
+
+    local: MutableMapping = {}
+    for p in package_list or []:
+        local.setdefault(hashlib.sha256(get_package_shard(p)).hexdigest(), p)
+    hashes: List[str] = [entry['sha256'] for entry in index['packages']]
+    state['index-etag'] = etag
+    if hashes == list(local.keys()):
+        save_update_state(state)
+        return False
+    missing = list(dict.fromkeys(h for h in hashes if h not in local))
+    if len(missing) > len(hashes) // 2:
+        return None
+
+    def fetch_shard(sha256: str) -> MutableMapping:
+        with http_request(get_definitions_shard_url(url, sha256)) as urlreq:
             data = urlreq.read()
-            try:
-                os.mkdir(os.path.dirname(package_json_path))
-            except FileExistsError:
-                pass
-            with zipfile.ZipFile(io.BytesIO(data), 'r') as zf:
-                with zf.open('vspackages3.json') as pkgfile:
-                    with open(package_json_path, 'wb') as dstfile:
-                        dstfile.write(pkgfile.read())
-                    os.utime(package_json_path, times=(remote_modtime, remote_modtime))
-    except urllib.request.HTTPError as httperr:
+        if hashlib.sha256(data).hexdigest() != sha256:
+            raise ValueError('Hash mismatch for package definition ' + sha256)
+        return json.loads(data)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(options.jobs, 8)) as executor:
+            fetched = dict(zip(missing, executor.map(fetch_shard, missing)))
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        print('Failed to fetch changed package definitions, fetching all of them instead: ' + str(e))
+        return None
+
+    packages = [local[h] if h in local else fetched[h] for h in hashes]
+    write_package_definition(json.dumps({'file-format': 3, 'packages': packages}, ensure_ascii=False, indent=2).encode('utf-8'), remote_modtime)
+    save_update_state(state)
+    print('{} of {} package definitions changed'.format(len(missing), len(hashes)))
+    return True
+
+def update_package_zip(url: str, state: MutableMapping, localmtimeval: Optional[float]) -> bool:
+    try:
+        with http_request(url, get_conditional_headers(state.get('etag') if localmtimeval is not None else None, localmtimeval)) as urlreq:
+            remote_modtime = get_remote_modtime(urlreq)
+            state['etag'] = urlreq.headers['ETag']
+            data = urlreq.read()
+    except urllib.error.HTTPError as httperr:
         if httperr.code == 304:
-            print('Local definitions already up to date: ' + email.utils.formatdate(localmtimeval, usegmt=True))
+            return False
         else:
             raise
-    else:
-        print('Local definitions updated to: ' + email.utils.formatdate(remote_modtime, usegmt=True))
+    with zipfile.ZipFile(io.BytesIO(data), 'r') as zf:
+        with zf.open('vspackages3.json') as pkgfile:
+            write_package_definition(pkgfile.read(), remote_modtime)
+    save_update_state(state)
+    return True
+
+# returns True if new definitions were downloaded
+@timed('update definitions', 'definitions')
+def update_package_definition(url: str) -> bool:
+    global package_list, package_index
+    load_package_list(False)
+    localmtimeval: Optional[float] = None
+    if package_list is not None:
+        try:
+            localmtimeval = os.path.getmtime(package_json_path)
+        except OSError:
+            pass
+
+    state = load_update_state(url)
+    updated: Optional[bool] = None
+    if localmtimeval is not None:
+        updated = update_package_shards(url, state, localmtimeval)
+    if updated is None:
+        updated = update_package_zip(url, state, localmtimeval)
+
+    if not updated:
+        print('Local definitions already up to date: ' + email.utils.formatdate(localmtimeval, usegmt=True))
+        return False
+    print('Local definitions updated to: ' + email.utils.formatdate(os.path.getmtime(package_json_path), usegmt=True))
+    package_list = None
+    package_index = None
+    # parse the new definitions right away so the next run can start from the snapshot
+    load_package_list(False)
+    return True
 
 
 def get_vapoursynth_version() -> int:
@@ -776,136 +2595,552 @@ def get_vapoursynth_api_version() -> int:
     return 3
 
 
-def update_genstubs() -> None:
+# Stubs are only regenerated for the plugin namespaces whose files changed since they were last written. stubs.json next
+# to the definitions records a hash of the installed files of every namespace vsrepo manages together with the stub file
+# and its size and mtime, the existing stubs are kept for every other namespace and nothing is done at all when no plugin
+# changed. The stubs are generated from scratch when the stub file was changed by something else, when VapourSynth was
+# updated and by the genstubs operation, which also picks up plugins vsrepo doesn't manage.
+def get_stubs_state_path() -> str:
+    return os.path.join(os.path.dirname(package_json_path), 'stubs.json')
+
+def load_stubs_state() -> Optional[MutableMapping]:
+    try:
+        with open(get_stubs_state_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_stubs_state(state: MutableMapping) -> None:
+    try:
+        with open(get_stubs_state_path(), 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+    except OSError as e:
+        print('Failed to save stubs state: ' + str(e))
+
+# namespace -> hash of the names and hashes of its installed files for every plugin package with a known version
+def get_plugin_namespace_hashes() -> MutableMapping:
+    hashes: MutableMapping = {}
+    for id, version in installed_packages.items():
+        p = get_package_from_id(id)
+        if p is None or p['type'] != 'VSPlugin' or 'namespace' not in p:
+            continue
+        files = get_release_files(p, version)
+        if files is None:
+            continue
+        hasher = hashlib.sha256()
+        for install_fn in sorted(files):
+            hasher.update((install_fn + '\0' + str(get_file_hash(os.path.join(plugin_path, install_fn))) + '\0').encode('utf-8'))
+        hashes[p['namespace']] = hasher.hexdigest()
+    return hashes
+
+def get_stubs_key() -> str:
+    import vapoursynth
+    return str(getattr(vapoursynth, '__version__', get_vapoursynth_version()))
+
+def is_stub_file_unchanged(state: MutableMapping) -> bool:
+    try:
+        st = os.stat(state['path'])
+    except OSError:
+        return False
+    return st.st_size == state['size'] and st.st_mtime_ns == state['mtime_ns']
+
+@timed('generate stubs', 'stubs')
+def update_genstubs(full: bool = False) -> None:
+    namespaces = get_plugin_namespace_hashes() if package_list is not None else None
+    state = load_stubs_state()
+    if state is not None and (state.get('key') != get_stubs_key() or not is_stub_file_unchanged(state)):
+        state = None
+    if not full and state is not None and state['plugins'] == namespaces:
+        return
+
     sys.path.append(os.path.dirname(__file__))
 
     from vsstubs import output_stubs
     from vsstubs.utils import _get_default_stubs_path
 
+    path = _get_default_stubs_path()
     print("Updating VapourSynth stubs")
-    output_stubs(None, _get_default_stubs_path())
+    if full or namespaces is None or state is None or state['path'] != str(path):
+        output_stubs(None, path)
+    else:
+        changed = {ns for ns, digest in namespaces.items() if state['plugins'].get(ns) != digest}
+        removed = {ns for ns in state['plugins'] if ns not in namespaces}
+        output_stubs(path, path, add=changed, remove=removed)
+
+    if namespaces is not None:
+        st = os.stat(path)
+        save_stubs_state({'key': get_stubs_key(), 'path': str(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'plugins': namespaces})
+
+# The installed state entries of the files of a release and the modification times of the bytecode dirs next to its
+# python files, or None if a file has no entry. Package detection has just refreshed the entries so nothing but the
+# bytecode dirs has to be statted.
+def get_distinfo_signature(pkg: MutableMapping, rel: MutableMapping, dest_path: str) -> Optional[List]:
+    state = load_installed_state()
+    signature: List = []
+    cache_dirs: MutableMapping = {}
+    for fn in rel[get_bin_name(pkg)]["files"]:
+        path = os.path.abspath(os.path.join(dest_path, fn))
+        entry = state.get(path)
+        if entry is None:
+            return None
+        signature.append([fn, entry['size'], entry['mtime'], entry['inode'], entry['hash']])
+        if pkg['type'] == 'PyScript' and fn.endswith('.py'):
+            cache_dirs[os.path.join(os.path.dirname(path), '__pycache__')] = None
+    for cache_dir in sorted(cache_dirs):
+        try:
+            signature.append([cache_dir, os.stat(cache_dir).st_mtime_ns])
+        except OSError:
+            signature.append([cache_dir, None])
+    return signature
+
+# Only dist-info dirs that are missing or don't match the installed version and files are written again, unless full is
+# set as it is for the gendistinfo operation. Packages whose dist-info dir exists and whose signature is the same as when
+# it was last checked are skipped without reading anything.
+@timed('rebuild dist-info', 'dist-info')
+def rebuild_distinfo(full: bool = False, quiet: bool = False) -> None:
+    global installed_state_dirty
+    if site_package_dir is None:
+        return
+    dist_dirs = [targetname for targetname in os.listdir(site_package_dir) if targetname.endswith(".dist-info")] if os.path.isdir(site_package_dir) else []
+    state = load_distinfo_state()
+    for pkg_id in [pkg_id for pkg_id in state if pkg_id not in installed_packages]:
+        del state[pkg_id]
+        installed_state_dirty = True
+    rebuilt = 0
 
-def rebuild_distinfo() -> None:
-    print("Rebuilding dist-info dirs for other python package installers")
     for pkg_id, pkg_ver in installed_packages.items():
         pkg = get_package_from_id(pkg_id)
         if pkg is None:
             continue
         if pkg['type'] == 'PyWheel':
             continue
+        name = get_python_package_name(pkg)
+        existing = [targetname for targetname in dist_dirs if targetname.startswith(f"{name}-")]
 
         for idx, rel in enumerate(pkg["releases"]):
             if rel["version"] == pkg_ver:
                 break
         else:
-            remove_package_meta(pkg)
+            if full or len(existing) > 0:
+                remove_package_meta(pkg)
+            if state.pop(pkg_id, None) is not None:
+                installed_state_dirty = True
             continue
 
         dest_path = get_install_path(pkg)
+        signature = get_distinfo_signature(pkg, rel, dest_path)
+        dist_name = f"{name}-{make_pyversion(rel['version'], idx)}.dist-info"
+        if not full and signature is not None and existing == [dist_name] and state.get(pkg_id) == {'dir': dist_name, 'files': signature}:
+            continue
+
         bin_name = get_bin_name(pkg)
         files = [
             (os.path.join(dest_path, fn), fd[1], str(os.stat(os.path.join(dest_path, fn)).st_size))
             for fn, fd in rel[bin_name]["files"].items()
         ]
+        if pkg['type'] == 'PyScript':
+            files += get_bytecode_files([os.path.join(dest_path, fn) for fn in rel[bin_name]["files"] if fn.endswith('.py')])
+
+        dist_dir, contents = make_package_meta(files, pkg, rel, idx)
+        if full or existing != [dist_name] or not is_package_meta_current(dist_dir, contents):
+            if rebuilt == 0 and not quiet:
+                print("Rebuilding dist-info dirs for other python package installers")
+            install_package_meta(files, pkg, rel, idx)
+            rebuilt += 1
+        if signature is not None:
+            state[pkg_id] = {'dir': dist_name, 'files': signature}
+            installed_state_dirty = True
+        elif state.pop(pkg_id, None) is not None:
+            installed_state_dirty = True
+
+
+# With --compile the python files of the scripts and wheels installed in a run are compiled to bytecode in one batch for
+# optimization level 0 and the level vsrepo itself runs with, in a process pool when there are enough of them. The
+# bytecode is listed in the RECORD of the package so uninstalling removes it, rebuild_distinfo adds whatever bytecode
+# exists for a script to its RECORD.
+bytecode_pool_threshold = 16
+
+def get_bytecode_optimization_levels() -> List[int]:
+    return sorted({0, sys.flags.optimize})
+
+def compile_bytecode(path: str, optimization: int) -> Optional[str]:
+    import py_compile
+    cfile = imputil.cache_from_source(path, optimization=optimization if optimization > 0 else '')
+    try:
+        py_compile.compile(path, cfile=cfile, doraise=True, optimize=optimization)
+    except (py_compile.PyCompileError, OSError):
+        return None
+    return cfile
 
-        install_package_meta(files, pkg, rel, idx)
+# (path, sha256, size) of the existing bytecode of the given python files
+def get_bytecode_files(paths: Sequence[str]) -> List[Tuple[str, str, str]]:
+    files: List[Tuple[str, str, str]] = []
+    for path in paths:
+        for level in ('', 1, 2):
+            cfile = imputil.cache_from_source(path, optimization=level)
+            sha256 = get_file_hash(cfile)
+            if sha256 is not None:
+                files.append((cfile, sha256, str(os.path.getsize(cfile))))
+    return files
+
+def append_to_wheel_record(dest_path: str, dist_dir: str, files: List[Tuple[str, str, str]]) -> None:
+    record_path = os.path.join(dist_dir, 'RECORD')
+    recorded = {path for path, _ in read_dist_record(dest_path, dist_dir)}
+    with open(record_path, 'r', encoding='utf-8', newline='') as f:
+        contents = f.read()
+    if len(contents) > 0 and not contents.endswith('\n'):
+        contents += '\n'
+    record = io.StringIO()
+    w = csv.writer(record, lineterminator='\n')
+    for path, sha256hex, length in files:
+        if os.path.abspath(path) not in recorded:
+            w.writerow([os.path.relpath(path, dest_path), 'sha256=' + base64.urlsafe_b64encode(binascii.unhexlify(sha256hex)).rstrip(b'=').decode('ascii'), length])
+    with open(record_path, 'w', encoding='utf-8', newline='') as f:
+        f.write(contents + record.getvalue())
+
+# packages are (identifier, version) pairs like in InstallResult
+@timed('compile bytecode', 'compile')
+def compile_packages(packages: Sequence[Tuple[str, str]]) -> None:
+    sources: MutableMapping = {}
+    for id, version in packages:
+        p = get_package_from_id(id)
+        if p is None:
+            continue
+        if p['type'] == 'PyScript':
+            sources[id] = [os.path.join(py_script_path, fn) for fn in get_release_files(p, version) or {} if fn.endswith('.py')]
+        elif p['type'] == 'PyWheel':
+            sources[id] = [path for dist_dir in find_dist_dirs(get_python_package_name(p), py_script_path)
+                           for path, _ in read_dist_record(py_script_path, dist_dir) if path.endswith('.py')]
+    levels = get_bytecode_optimization_levels()
+    tasks = [(path, level) for paths in sources.values() for path in paths for level in levels]
+    if len(tasks) == 0:
+        return
 
+    print('Compiling {} python {}'.format(len(tasks) // len(levels), 'file' if len(tasks) == len(levels) else 'files'))
+    workers = min(os.cpu_count() or 1, len(tasks))
+    if len(tasks) < bytecode_pool_threshold or workers == 1:
+        compiled = [compile_bytecode(path, level) for path, level in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            compiled = list(executor.map(compile_bytecode, [task[0] for task in tasks], [task[1] for task in tasks], chunksize=max(1, len(tasks) // (workers * 4))))
+    failed = sum(1 for cfile in compiled if cfile is None)
+    if failed > 0:
+        print('Failed to compile {} python {}'.format(failed, 'file' if failed == 1 else 'files'))
+
+    for id, paths in sources.items():
+        p = get_package_from_id(id)
+        assert p is not None
+        if p['type'] == 'PyWheel':
+            for dist_dir in find_dist_dirs(get_python_package_name(p), py_script_path):
+                append_to_wheel_record(py_script_path, dist_dir, get_bytecode_files(paths))
+    # the RECORDs of scripts pick up the new bytecode
+    rebuild_distinfo(quiet=True)
+
+class Paths(NamedTuple):
+    definitions: str
+    binaries: str
+    scripts: str
+    dist_infos: Optional[str]
+
+def get_paths() -> Paths:
+    ensure_init()
+    return Paths(package_json_path, plugin_path, py_script_path, site_package_dir)
 
 def print_paths():
+    paths = get_paths()
     print('Paths:')
-    print('Definitions: ' + package_json_path)
-    print('Binaries: ' + plugin_path)
-    print('Scripts: ' + py_script_path)
+    print('Definitions: ' + paths.definitions)
+    print('Binaries: ' + paths.binaries)
+    print('Scripts: ' + paths.scripts)
 
-    if site_package_dir is not None:
-        print("Dist-Infos: " + site_package_dir)
+    if paths.dist_infos is not None:
+        print("Dist-Infos: " + paths.dist_infos)
     else:
         print("Dist-Infos: <Will not be installed>")
 
-if args.operation != 'update' and package_list is None:
-    print('Failed to open vspackages3.json. Run update command.')
-    sys.exit(1)
-
-for name in args.package:
-    try:
-        assert isinstance(name, str)
-        get_package_from_name(name)
-    except Exception as e:
-        print(e)
-        sys.exit(1)
+# resolves what installing the named packages would do without changing anything, returns the plan and the packages that can't be installed,
+# detect can be turned off by callers that keep installed_packages up to date themselves like the server
+def plan_install(names: Sequence[str], detect: bool = True) -> Tuple[InstallPlan, List[str]]:
+    load_package_list()
+    if detect:
+        detect_installed_packages()
+
+    plan = InstallPlan()
+    failed: List[str] = []
+    for name in names:
+        failed += install_package(name, plan)
+    return (plan, failed)
+
+# same as plan_install but for upgrades, all installed packages are upgraded when names is None
+def plan_upgrade(names: Optional[Sequence[str]], force: bool = False, detect: bool = True) -> Tuple[InstallPlan, List[str]]:
+    load_package_list()
+    if detect:
+        detect_installed_packages()
+
+    plan = InstallPlan()
+    failed: List[str] = []
+    if names is None:
+        failed = upgrade_all_packages(force, plan)
+    else:
+        for name in names:
+            failed += upgrade_package(name, force, plan)
+    return (plan, failed)
 
-if args.operation == 'install':
-    detect_installed_packages()
+def execute_plan(plan: InstallPlan, failed: List[str]) -> InstallResult:
     rebuild_distinfo()
+    result = run_install_plan(plan)
+    if options.compile_bytecode:
+        compile_packages(result.installed + result.dependencies)
+    if options.cache_size > 0:
+        prune_download_cache(options.cache_size * 1024 * 1024)
 
-    inst = (0, 0, 0)
-    for name in args.package:
-        res = install_package(name)
-        inst = (inst[0] + res[0], inst[1] + res[1], inst[2] + res[2])
-
     update_genstubs()
+    save_installed_state()
+    return InstallResult(result.installed, result.dependencies, failed + result.failed)
+
+def install_packages(names: Sequence[str], detect: bool = True) -> InstallResult:
+    return execute_plan(*plan_install(names, detect))
+
+# upgrades all installed packages when names is None
+def upgrade_packages(names: Optional[Sequence[str]], force: bool = False, detect: bool = True) -> InstallResult:
+    return execute_plan(*plan_upgrade(names, force, detect))
+
+# returns (identifier, version) for every package that was removed
+def uninstall_packages(names: Sequence[str], detect: bool = True) -> List[Tuple[str, str]]:
+    load_package_list()
+    if detect:
+        detect_installed_packages()
+    uninstalled: List[Tuple[str, str]] = []
+    for name in names:
+        with timed('uninstall ' + name, 'write'):
+            version = uninstall_package(name)
+        if version is not None:
+            uninstalled.append((get_package_from_name(name)['identifier'], version))
+    update_genstubs()
+    save_installed_state()
+    return uninstalled
 
-    if (inst[0] == 0) and (inst[1] == 0):
+# returns the identifiers of the installed packages that couldn't be written to the lockfile because their version is unknown
+def freeze_packages(path: str) -> List[str]:
+    load_package_list()
+    detect_installed_packages()
+    lock, unknown = make_lockfile()
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(lock, f, indent=2)
+        f.write('\n')
+    return unknown
+
+def plan_sync(path: str) -> Tuple[InstallPlan, List[str], List[str]]:
+    lock = read_lockfile(path)
+    load_package_list()
+    detect_installed_packages()
+    return make_sync_plan(lock)
+
+# installs, upgrades, downgrades and uninstalls whatever differs from the lockfile with a single detection, dist-info
+# rebuild and stub generation
+def sync_packages(path: str) -> SyncResult:
+    plan, remove, failed = plan_sync(path)
+    uninstalled: List[Tuple[str, str]] = []
+    for id in remove:
+        with timed('uninstall ' + id, 'write'):
+            version = uninstall_package(id)
+        if version is not None:
+            uninstalled.append((id, version))
+        else:
+            failed.append(id)
+    result = execute_plan(plan, failed)
+    return SyncResult(result.installed, uninstalled, result.failed)
+
+def verify_packages() -> VerifyResult:
+    load_package_list()
+    return verify_installed_files()
+
+def print_mirror_result(result: MirrorResult) -> None:
+    print('{} {} in the mirror, {} downloaded'.format(result.files, 'file' if result.files == 1 else 'files', result.downloaded))
+    if len(result.failed) > 0:
+        print('{} {} failed'.format(len(result.failed), 'file' if len(result.failed) == 1 else 'files'))
+
+def print_verify_result(result: VerifyResult) -> None:
+    for entry in result.missing:
+        print('Missing: ' + entry['path'] + ' (' + entry['package'] + ' ' + entry['version'] + ')')
+    for entry in result.modified:
+        print('Modified: ' + entry['path'] + ' (' + entry['package'] + ' ' + entry['version'] + ')')
+    for entry in result.orphaned:
+        print('Orphaned: ' + entry['path'] + (' (' + entry['package'] + ')' if entry['package'] is not None else ''))
+    for identifier in result.unknown:
+        print('Unknown version: ' + identifier)
+    print('{} files checked, {} missing, {} modified, {} orphaned, {} unknown'.format(result.files, len(result.missing), len(result.modified), len(result.orphaned), len(result.unknown)))
+
+def print_sync_plan(plan: InstallPlan, remove: List[str]) -> None:
+    print_install_plan(plan)
+    for id in remove:
+        print('Uninstall ' + get_package_from_id(id, True)['name'] + ' ' + installed_packages[id])
+
+def print_sync_result(result: SyncResult) -> None:
+    ninstalled = len(result.installed)
+    nuninstalled = len(result.uninstalled)
+    nfailed = len(result.failed)
+    if ninstalled == 0 and nuninstalled == 0:
         print('Nothing done')
-    elif (inst[0] > 0) and (inst[1] == 0):
-        print('{} {} installed'.format(inst[0], 'package' if inst[0] == 1 else 'packages'))
-    elif (inst[0] == 0) and (inst[1] > 0):
-        print('{} missing {} installed'.format(inst[1], 'dependency' if inst[1] == 1 else 'dependencies'))
     else:
-        print('{} {} and {} additional {} installed'.format(inst[0], 'package' if inst[0] == 1 else 'packages', inst[1], 'dependency' if inst[1] == 1 else 'dependencies'))
-    if (inst[2] > 0):
-        print('{} {} failed'.format(inst[2], 'package' if inst[0] == 1 else 'packages'))
-elif args.operation in ('upgrade', 'upgrade-all'):
-    detect_installed_packages()
-    rebuild_distinfo()
-
-    inst = (0, 0, 0)
-    if args.operation == 'upgrade-all':
-        inst = upgrade_all_packages(args.force)
+        print('{} {} installed and {} uninstalled'.format(ninstalled, 'package' if ninstalled == 1 else 'packages', nuninstalled))
+    if nfailed > 0:
+        print('{} {} failed'.format(nfailed, 'package' if nfailed == 1 else 'packages'))
+
+def print_install_summary(result: InstallResult, upgrade: bool) -> None:
+    npkgs = len(result.installed)
+    ndeps = len(result.dependencies)
+    nfailed = len(result.failed)
+    if (npkgs == 0) and (ndeps == 0):
+        print('Nothing done')
+    elif (npkgs > 0) and (ndeps == 0):
+        print('{} {} {}'.format(npkgs, 'package' if npkgs == 1 else 'packages', 'upgraded' if upgrade else 'installed'))
+    elif (npkgs == 0) and (ndeps > 0):
+        print('{} missing {} installed'.format(ndeps, 'dependency' if ndeps == 1 else 'dependencies'))
+    elif upgrade:
+        print('{} {} upgraded and {} additional {} installed'.format(npkgs, 'package' if npkgs == 1 else 'packages', ndeps, 'dependency' if ndeps == 1 else 'dependencies'))
     else:
-        for name in args.package:
-            res = upgrade_package(name, args.force)
-            inst = (inst[0] + res[0], inst[1] + res[1], inst[2] + res[2])
+        print('{} {} and {} additional {} installed'.format(npkgs, 'package' if npkgs == 1 else 'packages', ndeps, 'dependency' if ndeps == 1 else 'dependencies'))
+    if nfailed > 0:
+        print('{} {} failed'.format(nfailed, 'package' if nfailed == 1 else 'packages'))
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='A simple VapourSynth package manager')
+    parser.add_argument('operation', choices=['install', 'update', 'upgrade', 'upgrade-all', 'uninstall', 'installed', 'available', 'paths', "genstubs", "gendistinfo", 'cache', 'verify', 'mirror', 'serve', 'freeze', 'sync'])
+    parser.add_argument('package', nargs='*', help='identifier, namespace or module to install, upgrade, uninstall or mirror, stats, prune or clear for the cache operation or the lockfile to freeze or sync')
+    parser.add_argument('-f', action='store_true', dest='force', help='force upgrade for packages where the current version is unknown')
+    parser.add_argument('-d', action='store_true', dest='skip_deps', help='skip installing dependencies')
+    parser.add_argument('-t', default=detect_target(), dest='target', help='binaries to install, defaults to python\'s architecture')
+    parser.add_argument('-b', dest='binary_path', help='custom binary install path')
+    parser.add_argument('-s', dest='script_path', help='custom script install path')
+    parser.add_argument('-j', '--jobs', type=int, default=1, dest='jobs', help='number of packages to download and extract in parallel')
+    parser.add_argument('--cache-size', type=int, default=4096, dest='cache_size', help='maximum size of the download cache in MiB, 0 disables it')
+    parser.add_argument('--url', dest='url', help='url of the package definitions, defaults to ' + definitions_url)
+    parser.add_argument('--link', choices=link_modes, default='auto', dest='link_mode', help='how installed files are created from the download cache, auto tries reflinks, then hardlinks, then copies')
+    parser.add_argument('--mirror', dest='mirror', help='directory or url of a mirror to download releases and definitions from first, or the directory the mirror operation writes to')
+    parser.add_argument('--targets', dest='targets', help='comma separated targets the mirror operation downloads binaries for, all for every target, defaults to -t')
+    parser.add_argument('--timeout', type=float, default=60.0, dest='timeout', help='seconds to wait for a server to respond')
+    parser.add_argument('--retries', type=int, default=3, dest='retries', help='number of times a failed request is retried')
+    parser.add_argument('--compile', action='store_true', dest='compile_bytecode', help='compile the python files of installed scripts and wheels to bytecode')
+    parser.add_argument('--socket', dest='socket', help='unix socket the serve operation listens on, defaults to vsrepo.sock next to the package definitions')
+    parser.add_argument('--plan', '--dry-run', action='store_true', dest='plan', help='only show what install, upgrade, upgrade-all and sync would do')
+    parser.add_argument('--json', action='store_true', dest='json', help='print the result of verify as json')
+    parser.add_argument('--timings', action='store_true', dest='timings', help='print how long each phase and package took')
+    parser.add_argument('--trace', dest='trace', help='write the timings of every download, extraction, hash and write to a chrome trace json file')
+    args = parser.parse_intermixed_args(argv)
+
+    if (args.operation in ['install', 'upgrade', 'uninstall']) and ((args.package is None) or len(args.package) == 0):
+        print('Package argument required for install, upgrade and uninstall operations')
+        return 1
 
-    update_genstubs()
+    if args.operation == 'cache' and (len(args.package) > 1 or (len(args.package) == 1 and args.package[0] not in ('stats', 'prune', 'clear'))):
+        print('The cache operation takes one of stats, prune or clear')
+        return 1
 
-    if (inst[0] == 0) and (inst[1] == 0):
-        print('Nothing done')
-    elif (inst[0] > 0) and (inst[1] == 0):
-        print('{} {} upgraded'.format(inst[0], 'package' if inst[0] == 1 else 'packages'))
-    elif (inst[0] == 0) and (inst[1] > 0):
-        print('{} missing {} installed'.format(inst[1], 'dependency' if inst[1] == 1 else 'dependencies'))
-    else:
-        print('{} {} upgraded and {} additional {} installed'.format(inst[0], 'package' if inst[0] == 1 else 'packages', inst[1], 'dependency' if inst[1] == 1 else 'dependencies'))
-    if (inst[2] > 0):
-        print('{} {} failed'.format(inst[2], 'package' if inst[0] == 1 else 'packages'))
-elif args.operation == 'uninstall':
-    detect_installed_packages()
-    uninst = (0, 0)
-    for name in args.package:
-        uninst_res = uninstall_package(name)
-        uninst = (uninst[0] + uninst_res[0], uninst[1] + uninst_res[1])
-    if uninst[0] == 0:
-        print('No packages uninstalled')
-    else:
-        print('{} {} uninstalled'.format(uninst[0], 'package' if uninst[0] == 1 else 'packages'))
-    update_genstubs()
-elif args.operation == 'installed':
-    detect_installed_packages()
-    list_installed_packages()
-elif args.operation == 'available':
-    detect_installed_packages()
-    list_available_packages()
-elif args.operation == 'update':
-    update_package_definition('https://www.vapoursynth.com/vsrepo/vspackages3.zip')
-elif args.operation == 'paths':
-    print_paths()
-elif args.operation == "genstubs":
-    update_genstubs()
-elif args.operation == "gendistinfo":
-    detect_installed_packages()
-    rebuild_distinfo()
+    if args.operation in ('freeze', 'sync') and len(args.package) != 1:
+        print('The freeze and sync operations take the path of a lockfile')
+        return 1
 
+    if args.operation == 'mirror' and args.mirror is None:
+        print('The mirror operation requires --mirror with the directory to write to')
+        return 1
 
-def noop():
-    pass
+    if args.timings or args.trace is not None:
+        enable_timings()
+
+    try:
+        init(target=args.target, binary_path=args.binary_path, script_path=args.script_path, skip_deps=args.skip_deps, jobs=args.jobs, cache_size=args.cache_size,
+             timeout=args.timeout, retries=args.retries, url=args.url, link_mode=args.link_mode, mirror=args.mirror if args.operation != 'mirror' else None,
+             compile_bytecode=args.compile_bytecode)
+
+        if args.operation == 'cache':
+            manage_download_cache(args.package[0] if len(args.package) > 0 else 'stats')
+            return 0
+
+        if args.operation not in ('update', 'paths', 'genstubs', 'serve'):
+            load_package_list()
+
+        for name in args.package if args.operation not in ('freeze', 'sync') else []:
+            try:
+                assert isinstance(name, str)
+                get_package_from_name(name)
+            except Exception as e:
+                print(e)
+                return 1
+
+        if args.operation == 'install' and args.plan:
+            print_install_plan(plan_install(args.package)[0])
+        elif args.operation == 'install':
+            print_install_summary(install_packages(args.package), False)
+        elif args.operation in ('upgrade', 'upgrade-all') and args.plan:
+            print_install_plan(plan_upgrade(args.package if args.operation == 'upgrade' else None, args.force)[0])
+        elif args.operation in ('upgrade', 'upgrade-all'):
+            print_install_summary(upgrade_packages(args.package if args.operation == 'upgrade' else None, args.force), True)
+        elif args.operation == 'uninstall':
+            uninstalled = uninstall_packages(args.package)
+            if len(uninstalled) == 0:
+                print('No packages uninstalled')
+            else:
+                print('{} {} uninstalled'.format(len(uninstalled), 'package' if len(uninstalled) == 1 else 'packages'))
+        elif args.operation == 'installed':
+            detect_installed_packages()
+            list_installed_packages()
+        elif args.operation == 'available':
+            detect_installed_packages()
+            list_available_packages()
+        elif args.operation == 'update':
+            update_package_definition(definitions_url)
+        elif args.operation == 'paths':
+            print_paths()
+        elif args.operation == "genstubs":
+            load_package_list(False)
+            if package_list is not None:
+                detect_installed_packages()
+            update_genstubs(True)
+        elif args.operation == 'verify':
+            result = verify_packages()
+            if args.json:
+                json.dump(result._asdict(), sys.stdout, indent=2)
+                print()
+            else:
+                print_verify_result(result)
+            if result.missing or result.modified or result.orphaned or result.unknown:
+                return 1
+        elif args.operation == 'mirror':
+            result = mirror_packages(args.package, args.targets.split(',') if args.targets else [options.target], args.mirror)
+            print_mirror_result(result)
+            if result.failed:
+                return 1
+        elif args.operation == 'freeze':
+            unknown = freeze_packages(args.package[0])
+            for id in unknown:
+                print('Unknown version of ' + id + ' not locked')
+            if unknown:
+                return 1
+        elif args.operation == 'sync' and args.plan:
+            plan, remove, _ = plan_sync(args.package[0])
+            print_sync_plan(plan, remove)
+        elif args.operation == 'sync':
+            result = sync_packages(args.package[0])
+            print_sync_result(result)
+            if result.failed:
+                return 1
+        elif args.operation == 'serve':
+            from vsrepo.serve import serve
+            serve(args.socket)
+        elif args.operation == "gendistinfo":
+            detect_installed_packages()
+            rebuild_distinfo(True)
+            save_installed_state()
+    except VSRepoError as e:
+        print(e)
+        return 1
+    finally:
+        if args.timings:
+            print_timings()
+        if args.trace is not None:
+            write_trace(args.trace)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+##    MIT License
+##
+##    Copyright (c) 2018-2026 Fredrik Mellbin
+##
+##    Permission is hereby granted, free of charge, to any person obtaining a copy
+##    of this software and associated documentation files (the "Software"), to deal
+##    in the Software without restriction, including without limitation the rights
+##    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+##    copies of the Software, and to permit persons to whom the Software is
+##    furnished to do so, subject to the following conditions:
+##
+##    The above copyright notice and this permission notice shall be included in all
+##    copies or substantial portions of the Software.
+##
+##    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+##    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+##    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+##    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+##    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+##    SOFTWARE.
+
+# The tests run against temporary definitions, cache and install dirs and a local HTTP server, VapourSynth has to be
+# installed since vsrepo.init() asks it for the default paths.
+
+import base64
+import csv
+import hashlib
+import http.server
+import io
+import os
+import os.path
+import re
+import threading
+import zipfile
+from typing import Callable, Dict, Iterator, List, MutableMapping, Optional, Tuple
+
+import pytest
+
+from vsrepo import vsrepo
+
+# Serves the files put in it from memory with ETags, conditional requests and single byte ranges the way a static file
+# server or CDN does. Every request is logged and fail can reject requests to simulate broken connections.
+class StaticServer:
+    def __init__(self):
+        self.files: Dict[str, bytes] = {}
+        self.etags: Dict[str, str] = {}
+        self.requests: List[Tuple[str, str, MutableMapping]] = []
+        # servers that don't support ranges ignore the Range header
+        self.ranges = True
+        # called with the method, the file name and the requested range, returning True answers with a 500
+        self.fail: Optional[Callable[[str, str, Optional[Tuple[int, int]]], bool]] = None
+        self.lock = threading.Lock()
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), make_handler(self))
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    def put(self, name: str, data: bytes) -> str:
+        with self.lock:
+            self.files[name] = data
+            self.etags[name] = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+        return self.url(name)
+
+    def url(self, name: str) -> str:
+        return 'http://127.0.0.1:{}/{}'.format(self.httpd.server_address[1], name)
+
+    # (method, name, range) of the logged requests, with the range as (start, end) or None
+    def log(self) -> List[Tuple[str, str, Optional[Tuple[int, int]]]]:
+        with self.lock:
+            return [(method, name, parse_range(headers.get('range'))) for method, name, headers in self.requests]
+
+    def clear_log(self) -> None:
+        with self.lock:
+            self.requests.clear()
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def parse_range(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    match = re.fullmatch(r'bytes=(\d+)-(\d+)', value or '')
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def make_handler(server: StaticServer) -> type:
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+        def respond(self, send_body: bool) -> None:
+            name = self.path.lstrip('/')
+            with server.lock:
+                server.requests.append((self.command, name, {key.lower(): value for key, value in self.headers.items()}))
+                data = server.files.get(name)
+                etag = server.etags.get(name)
+            byte_range = parse_range(self.headers.get('Range')) if server.ranges else None
+            if data is None or (server.fail is not None and server.fail(self.command, name, byte_range)):
+                self.send_response(404 if data is None else 500)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.headers.get('If-None-Match') is not None and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            # a range is only honored while If-Range still matches, otherwise the whole new file is sent
+            if byte_range is not None and self.headers.get('If-Range', etag) != etag:
+                byte_range = None
+            if byte_range is not None and byte_range[0] >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = data
+            if byte_range is not None:
+                end = min(byte_range[1], len(data) - 1)
+                body = data[byte_range[0]:end + 1]
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(byte_range[0], end, len(data)))
+            else:
+                self.send_response(200)
+            if server.ranges:
+                self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            self.respond(True)
+
+        def do_HEAD(self) -> None:
+            self.respond(False)
+
+        # proxy tunnels are only logged and refused
+        def do_CONNECT(self) -> None:
+            self.respond(False)
+
+    return Handler
+
+@pytest.fixture
+def server() -> Iterator[StaticServer]:
+    s = StaticServer()
+    yield s
+    s.close()
+
+# initializes vsrepo with everything it writes in tmp_path, requests aren't retried so injected failures surface at once.
+# The scripts dir doubles as site-packages so nothing is written to the VapourSynth install.
+def init_repo(tmp_path, monkeypatch, **kwargs) -> None:
+    kwargs.setdefault('definitions_path', str(tmp_path / 'vspackages3.json'))
+    vsrepo.init(target='win64', binary_path=str(tmp_path / 'plugins'), script_path=str(tmp_path / 'scripts'), retries=0, timeout=10.0, **kwargs)
+    os.makedirs(tmp_path / 'scripts', exist_ok=True)
+    monkeypatch.setattr(vsrepo, 'site_package_dir', str(tmp_path / 'scripts'))
+
+# the stubs live in the VapourSynth install too and are left alone
+@pytest.fixture
+def repo(tmp_path, monkeypatch) -> Iterator:
+    init_repo(tmp_path, monkeypatch)
+    monkeypatch.setattr(vsrepo, 'update_genstubs', lambda full=False: None)
+    vsrepo.download_cache.clear()
+    vsrepo.redirect_cache.clear()
+    yield vsrepo
+    vsrepo.http_pool.close()
+    vsrepo.remove_temporary_files()
+    vsrepo.temporary_files.clear()
+    vsrepo.temporary_dirs.clear()
+    vsrepo.download_cache.clear()
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def make_zip(files: MutableMapping) -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as zf:
+        for name, contents in files.items():
+            zf.writestr(name, contents)
+    return data.getvalue()
+
+# a purelib wheel with a RECORD listing the sha256 of every file, record replaces or adds RECORD rows
+def make_wheel(name: str, version: str, files: MutableMapping, record: Optional[MutableMapping] = None) -> bytes:
+    dist_info = f'{name}-{version}.dist-info'
+    files = dict(files)
+    files[dist_info + '/WHEEL'] = b'Wheel-Version: 1.0\nRoot-Is-Purelib: true\n'
+    files[dist_info + '/METADATA'] = f'Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n'.encode()
+    rows: MutableMapping = {fn: 'sha256=' + base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b'=').decode() for fn, data in files.items()}
+    rows.update(record or {})
+    contents = io.StringIO()
+    w = csv.writer(contents)
+    for fn, digest in rows.items():
+        w.writerow([fn, digest, ''])
+    w.writerow([dist_info + '/RECORD', '', ''])
+    files[dist_info + '/RECORD'] = contents.getvalue().encode()
+    return make_zip(files)
+
+# makes packages the definitions vsrepo works with
+def set_packages(packages: List[MutableMapping]) -> None:
+    vsrepo.package_list = packages
+    vsrepo.package_index = vsrepo.PackageIndex(packages)
+
+def plugin_release(server, name: str, version: str, files: MutableMapping) -> MutableMapping:
+    url = server.put(f'{name}-{version}.zip', make_zip(files))
+    return {'version': version, 'win64': {'url': url, 'files': {fn: [fn, sha256(data)] for fn, data in files.items()}}}
+
+def wheel_release(server, name: str, version: str, files: MutableMapping) -> MutableMapping:
+    data = make_wheel(name, version, files)
+    url = server.put(f'{name}-{version}-py3-none-any.whl', data)
+    return {'version': version, 'wheel': {'url': url, 'hash': sha256(data)}}
+
+# releases are listed newest first like in the definitions
+def make_package(name: str, type: str, releases: List[MutableMapping], dependencies: Optional[List[str]] = None) -> MutableMapping:
+    p: MutableMapping = {'name': name, 'type': type, 'identifier': 'com.test.' + name, 'releases': releases}
+    if type == 'VSPlugin':
+        p['namespace'] = name
+    else:
+        p['modulename'] = name
+    if type == 'PyWheel':
+        p['wheelname'] = name
+    if dependencies is not None:
+        p['dependencies'] = dependencies
+    return p
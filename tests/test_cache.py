@@ -0,0 +1,50 @@
+import hashlib
+import os
+
+from vsrepo import vsrepo
+
+def store(tmp_path, data: bytes, mtime: float) -> str:
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = str(tmp_path / sha256)
+    with open(path, 'wb') as f:
+        f.write(data)
+    stored = vsrepo.store_file(path, sha256)
+    os.utime(stored, (mtime, mtime))
+    return sha256
+
+def test_reused_entry_survives_pruning(repo, tmp_path):
+    a = store(tmp_path, b'a' * 1000, 1000.0)
+    b = store(tmp_path, b'b' * 1000, 2000.0)
+    c = store(tmp_path, b'c' * 1000, 3000.0)
+    vsrepo.cache_access.clear()
+    assert vsrepo.find_stored_file(a) == vsrepo.get_cache_file(a)
+    assert vsrepo.prune_download_cache(2000) == (1, 1000)
+    assert os.path.isfile(vsrepo.get_cache_file(a))
+    assert not os.path.exists(vsrepo.get_cache_file(b))
+    assert os.path.isfile(vsrepo.get_cache_file(c))
+    assert os.stat(vsrepo.get_cache_file(a)).st_mtime == 1000.0
+
+def test_accesses_are_kept_across_runs(repo, tmp_path):
+    a = store(tmp_path, b'a' * 1000, 1000.0)
+    b = store(tmp_path, b'b' * 1000, 2000.0)
+    vsrepo.cache_access.clear()
+    vsrepo.find_stored_file(a)
+    vsrepo.save_cache_access()
+    vsrepo.cache_access = None
+    assert vsrepo.prune_download_cache(1000) == (1, 1000)
+    assert os.path.isfile(vsrepo.get_cache_file(a))
+    assert not os.path.exists(vsrepo.get_cache_file(b))
+    vsrepo.cache_access = None
+    assert set(vsrepo.load_cache_access()) == {a}
+
+def test_pending_downloads_survive_pruning(repo, tmp_path):
+    a = store(tmp_path, b'a' * 1000, 1000.0)
+    part = vsrepo.get_cache_file(vsrepo.get_cache_key('http://example.com/big.zip', None)) + '.part'
+    others = [part, part + '.json', os.path.join(os.path.dirname(part), '.tmpabc'), os.path.join(vsrepo.cache_path, '.vsrepoabc', 'member.dll')]
+    for path in others:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 5000)
+    assert [entry[2] for entry in vsrepo.get_download_cache_entries()] == [vsrepo.get_cache_file(a)]
+    assert vsrepo.prune_download_cache(0) == (1, 1000)
+    assert all(os.path.isfile(path) for path in others)
@@ -0,0 +1,35 @@
+import importlib.util
+import os
+
+import pytest
+
+from conftest import make_package, set_packages, sha256, wheel_release
+from vsrepo import vsrepo
+
+script = b'x = 1\n'
+
+@pytest.fixture
+def packages(repo, server, monkeypatch):
+    monkeypatch.setattr(vsrepo.options, 'compile_bytecode', True)
+    set_packages([make_package('s', 'PyScript', [{'version': '1', 'script': {'url': server.put('s.py', script), 'files': {'s.py': ['s.py', sha256(script)]}}}]),
+                  make_package('w', 'PyWheel', [wheel_release(server, 'w', '1.0', {'w/__init__.py': b'v = 1\n', 'w/sub/m.py': b'm = 1\n'})])])
+    return vsrepo.py_script_path
+
+def read_record(scripts: str, dist_info: str) -> list:
+    with open(os.path.join(scripts, dist_info, 'RECORD'), 'r', encoding='utf-8') as f:
+        return [line.split(',')[0] for line in f.read().splitlines()]
+
+def get_bytecode(scripts: str, fn: str) -> str:
+    return os.path.relpath(importlib.util.cache_from_source(os.path.join(scripts, fn)), scripts).replace(os.sep, '/')
+
+def test_bytecode_is_recorded_and_uninstalled(packages):
+    scripts = packages
+    result = vsrepo.install_packages(['s', 'w'])
+    assert result.failed == []
+    pycs = [get_bytecode(scripts, fn) for fn in ('s.py', 'w/__init__.py', 'w/sub/m.py')]
+    assert all(os.path.isfile(os.path.join(scripts, pyc)) for pyc in pycs)
+    assert pycs[0] in read_record(scripts, 's-1.dist-info')
+    assert pycs[1] in read_record(scripts, 'w-1.0.dist-info') and pycs[2] in read_record(scripts, 'w-1.0.dist-info')
+
+    assert sorted(vsrepo.uninstall_packages(['s', 'w'])) == [('com.test.s', '1'), ('com.test.w', '1.0')]
+    assert os.listdir(scripts) == []
@@ -0,0 +1,39 @@
+import json
+import os
+
+from vsrepo import vsrepo
+
+def make_definitions(name: str) -> bytes:
+    return json.dumps({'file-format': 3, 'packages': [
+        {'name': name, 'identifier': 'com.test.a', 'namespace': 'a', 'type': 'VSPlugin', 'releases': []}
+    ]}).encode('utf-8')
+
+def load_name() -> str:
+    vsrepo.package_list = None
+    vsrepo.package_index = None
+    vsrepo.load_package_list()
+    return vsrepo.get_package_from_id('com.test.a')['name']
+
+def test_snapshot_is_used_for_unchanged_definitions(repo):
+    vsrepo.write_package_definition(make_definitions('changed one'), 1700000000.0)
+    assert load_name() == 'changed one'
+    assert os.path.isfile(vsrepo.get_package_snapshot_path())
+    assert not isinstance(vsrepo.package_list, vsrepo.LazyPackageList)
+    assert load_name() == 'changed one'
+    assert isinstance(vsrepo.package_list, vsrepo.LazyPackageList)
+
+def test_update_with_same_size_and_mtime_replaces_snapshot(repo):
+    vsrepo.write_package_definition(make_definitions('changed one'), 1700000000.0)
+    assert load_name() == 'changed one'
+    # an update that keeps the size and the server's Last-Modified
+    vsrepo.write_package_definition(make_definitions('changed two'), 1700000000.0)
+    assert load_name() == 'changed two'
+    assert load_name() == 'changed two'
+
+def test_edit_keeping_size_and_mtime_isnt_served_from_snapshot(repo):
+    vsrepo.write_package_definition(make_definitions('changed one'), 1700000000.0)
+    assert load_name() == 'changed one'
+    with open(vsrepo.package_json_path, 'r+b') as f:
+        f.write(make_definitions('changed two'))
+    os.utime(vsrepo.package_json_path, (1700000000.0, 1700000000.0))
+    assert load_name() == 'changed two'
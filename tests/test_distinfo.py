@@ -0,0 +1,54 @@
+import hashlib
+import os
+import py_compile
+
+import pytest
+
+from conftest import set_packages
+from vsrepo import vsrepo
+
+script = b'x = 1\n'
+
+@pytest.fixture
+def scripts(repo, tmp_path):
+    path = tmp_path / 'scripts'
+    (path / 'foo.py').write_bytes(script)
+    set_packages([{'name': 'Foo', 'type': 'PyScript', 'identifier': 'com.test.foo', 'modulename': 'foo',
+                   'releases': [{'version': 'r1', 'script': {'files': {'foo.py': ['foo.py', hashlib.sha256(script).hexdigest()]}}}]}])
+    vsrepo.detect_installed_packages()
+    return path
+
+@pytest.fixture
+def checked(monkeypatch):
+    checked = []
+    is_package_meta_current = vsrepo.is_package_meta_current
+    monkeypatch.setattr(vsrepo, 'is_package_meta_current', lambda dist_dir, contents: checked.append(os.path.basename(dist_dir)) or is_package_meta_current(dist_dir, contents))
+    return checked
+
+def read_record(scripts) -> str:
+    return (scripts / 'Foo-1.dist-info' / 'RECORD').read_text()
+
+def test_unchanged_package_is_skipped(scripts, checked):
+    assert vsrepo.installed_packages == {'com.test.foo': 'r1'}
+    vsrepo.rebuild_distinfo()
+    assert os.path.isfile(scripts / 'Foo-1.dist-info' / 'RECORD')
+    vsrepo.save_installed_state()
+    vsrepo.installed_state = None
+    checked.clear()
+    vsrepo.detect_installed_packages()
+    vsrepo.rebuild_distinfo()
+    assert checked == []
+
+def test_missing_dist_info_is_rebuilt(scripts):
+    vsrepo.rebuild_distinfo()
+    vsrepo.rmdir(str(scripts / 'Foo-1.dist-info'))
+    vsrepo.rebuild_distinfo()
+    assert 'foo.py' in read_record(scripts)
+
+def test_new_bytecode_is_recorded(scripts, checked):
+    vsrepo.rebuild_distinfo()
+    py_compile.compile(str(scripts / 'foo.py'))
+    checked.clear()
+    vsrepo.rebuild_distinfo()
+    assert checked == ['Foo-1.dist-info']
+    assert '__pycache__' in read_record(scripts)
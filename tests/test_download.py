@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from vsrepo import vsrepo
+
+chunk_size = 16 * 1024
+
+@pytest.fixture
+def ranges(repo, monkeypatch):
+    monkeypatch.setattr(vsrepo, 'range_download_threshold', 4 * chunk_size)
+    monkeypatch.setattr(vsrepo, 'range_download_chunk_size', chunk_size)
+    return repo
+
+def make_data(size: int, seed: int = 0) -> bytes:
+    return bytes((i * 31 + seed) % 251 for i in range(size))
+
+def get_chunks(size: int):
+    return [(start, min(size, start + chunk_size) - 1) for start in range(0, size, chunk_size)]
+
+def range_requests(server, name: str):
+    return sorted(r for method, n, r in server.log() if method == 'GET' and n == name and r is not None)
+
+def read(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_small_download_is_fetched_whole(ranges, server):
+    data = make_data(chunk_size)
+    url = server.put('small.zip', data)
+    path, digest = vsrepo.fetch_url_cached(url, sha256=hashlib.sha256(data).hexdigest())
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert read(path) == data
+    assert server.log() == [('GET', 'small.zip', None)]
+
+def test_server_without_ranges_is_asked_once(ranges, server):
+    data = make_data(8 * chunk_size)
+    url = server.put('big.zip', data)
+    server.ranges = False
+    path, digest = vsrepo.fetch_url_cached(url)
+    assert read(path) == data
+    assert [method for method, _, _ in server.log()] == ['GET']
+
+def test_large_download_is_fetched_in_ranges(ranges, server):
+    data = make_data(7 * chunk_size + 100)
+    url = server.put('big.zip', data)
+    path, digest = vsrepo.fetch_url_cached(url, sha256=hashlib.sha256(data).hexdigest())
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert path == vsrepo.get_cache_file(digest)
+    assert read(path) == data
+    assert range_requests(server, 'big.zip') == get_chunks(len(data))
+    # the plain request that showed the size is dropped before its body is read
+    assert server.log().count(('GET', 'big.zip', None)) == 1
+    assert not os.path.exists(path + '.part') and not os.path.exists(path + '.part.json')
+
+def test_failed_chunk_is_resumed(ranges, server):
+    data = make_data(7 * chunk_size + 100)
+    sha256 = hashlib.sha256(data).hexdigest()
+    url = server.put('big.zip', data)
+    part_path = vsrepo.get_cache_file(sha256) + '.part'
+    server.fail = lambda method, name, r: r == (3 * chunk_size, 4 * chunk_size - 1)
+    with pytest.raises(vsrepo.urllib.error.HTTPError):
+        vsrepo.fetch_url_cached(url, sha256=sha256)
+    with open(part_path + '.json', 'r', encoding='utf-8') as f:
+        done = set(json.load(f)['done'])
+    assert 3 not in done and len(done) > 0
+
+    server.fail = None
+    server.clear_log()
+    vsrepo.download_cache.clear()
+    path, digest = vsrepo.fetch_url_cached(url, sha256=sha256)
+    assert digest == sha256 and read(path) == data
+    assert range_requests(server, 'big.zip') == [chunk for i, chunk in enumerate(get_chunks(len(data))) if i not in done]
+    assert not os.path.exists(part_path) and not os.path.exists(part_path + '.json')
+
+def test_changed_file_restarts_download(ranges, server):
+    old = make_data(7 * chunk_size + 100)
+    new = make_data(7 * chunk_size + 100, 1)
+    url = server.put('big.zip', old)
+    # the file is replaced on the server while its chunks are being fetched
+    def replace_file(method, name, r):
+        if r is not None and r[0] == 3 * chunk_size:
+            server.put('big.zip', new)
+            return True
+        return False
+    server.fail = replace_file
+    with pytest.raises(OSError):
+        vsrepo.fetch_url_cached(url)
+    part_path = vsrepo.get_cache_file(vsrepo.get_cache_key(url, None)) + '.part'
+    assert os.path.exists(part_path + '.json')
+    # chunks still running when the file changed were refused because their If-Range no longer matched
+    assert any(method == 'GET' and r is not None and r[0] != 3 * chunk_size for method, _, r in server.log())
+
+    server.fail = None
+    server.clear_log()
+    vsrepo.download_cache.clear()
+    path, digest = vsrepo.fetch_url_cached(url)
+    assert digest == hashlib.sha256(new).hexdigest() and read(path) == new
+    assert range_requests(server, 'big.zip') == get_chunks(len(new))
+
+def test_hash_mismatch_is_rejected(ranges, server):
+    data = make_data(7 * chunk_size + 100)
+    expected = hashlib.sha256(b'something else').hexdigest()
+    url = server.put('big.zip', data)
+    path, digest = vsrepo.fetch_url_cached(url, sha256=expected)
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert path != vsrepo.get_cache_file(expected)
+    assert not os.path.exists(vsrepo.get_cache_file(expected))
+    assert not os.path.exists(path + '.json')
+    # the partial download isn't kept for a later attempt
+    vsrepo.remove_temporary_files()
+    assert not os.path.exists(path)
+    assert vsrepo.read_download_cache(url, expected) is None
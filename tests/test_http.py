@@ -0,0 +1,37 @@
+import base64
+
+import pytest
+
+from vsrepo import vsrepo
+
+@pytest.fixture
+def proxy(repo, server, monkeypatch):
+    for name in ('http_proxy', 'https_proxy', 'no_proxy', 'HTTP_PROXY', 'HTTPS_PROXY', 'NO_PROXY', 'all_proxy', 'ALL_PROXY'):
+        monkeypatch.delenv(name, raising=False)
+    address = 'us%40er:p%3Ass@127.0.0.1:{}'.format(server.httpd.server_address[1])
+    monkeypatch.setenv('http_proxy', 'http://' + address)
+    monkeypatch.setenv('https_proxy', 'http://' + address)
+    return server
+
+expected_auth = 'Basic ' + base64.b64encode(b'us@er:p:ss').decode('ascii')
+
+def test_http_through_proxy_sends_credentials(proxy):
+    proxy.put('http://example.invalid/file.zip', b'data')
+    with vsrepo.http_request('http://example.invalid/file.zip') as urlreq:
+        assert urlreq.read() == b'data'
+    method, name, headers = proxy.requests[0]
+    assert (method, name) == ('GET', 'http://example.invalid/file.zip')
+    assert headers['proxy-authorization'] == expected_auth
+
+def test_https_through_proxy_sends_credentials_with_connect(proxy):
+    with pytest.raises(OSError):
+        vsrepo.http_request('https://example.invalid/file.zip')
+    method, name, headers = proxy.requests[0]
+    assert (method, name) == ('CONNECT', 'example.invalid:443')
+    assert headers['proxy-authorization'] == expected_auth
+
+def test_proxy_without_credentials(repo, monkeypatch):
+    monkeypatch.setenv('http_proxy', 'http://proxy.invalid:3128')
+    monkeypatch.delenv('no_proxy', raising=False)
+    monkeypatch.delenv('NO_PROXY', raising=False)
+    assert vsrepo.get_http_proxy('http', 'example.invalid') == ('proxy.invalid', 3128, None)
@@ -0,0 +1,90 @@
+import os
+import time
+
+import pytest
+
+from conftest import make_package, make_zip, plugin_release, set_packages, sha256
+from vsrepo import vsrepo
+
+# a plugin whose archive holds the given files, the definitions list the hashes of expected or of files otherwise
+def make_plugin(server, name: str, files: dict, expected: dict = None, version: str = '1', dependencies: list = None, data: bytes = None) -> dict:
+    url = server.put(f'{name}-{version}.zip', data if data is not None else make_zip(files))
+    p = {'name': name, 'type': 'VSPlugin', 'identifier': 'com.test.' + name, 'namespace': name,
+         'releases': [{'version': version, 'win64': {'url': url, 'files': {fn: [fn, sha256(contents)] for fn, contents in (expected or files).items()}}}]}
+    if dependencies is not None:
+        p['dependencies'] = dependencies
+    return p
+
+@pytest.fixture
+def jobs(repo, monkeypatch):
+    monkeypatch.setattr(vsrepo.options, 'jobs', 2)
+    return repo
+
+@pytest.mark.parametrize('corruption', ['member', 'archive'])
+def test_corrupted_archive_fails_only_its_package(jobs, server, corruption):
+    good = make_plugin(server, 'good', {'good.dll': b'good', 'good2.dll': b'good2'})
+    if corruption == 'member':
+        bad = make_plugin(server, 'bad', {'bad.dll': b'evil', 'bad2.dll': b'bad2'}, {'bad.dll': b'bad', 'bad2.dll': b'bad2'})
+    else:
+        data = make_zip({'bad.dll': b'bad', 'bad2.dll': b'bad2'})
+        bad = make_plugin(server, 'bad', {'bad.dll': b'bad', 'bad2.dll': b'bad2'}, data=data[:len(data) // 2])
+    set_packages([bad, good])
+    result = vsrepo.install_packages(['bad', 'good'])
+    assert result.failed == ['com.test.bad']
+    assert result.installed == [('com.test.good', '1')]
+    assert sorted(os.listdir(vsrepo.plugin_path)) == ['good.dll', 'good2.dll']
+
+def plugin(server, name: str, dependencies: list = None, versions: tuple = ('1',)) -> dict:
+    return make_package(name, 'VSPlugin', [plugin_release(server, name, version, {name + '.dll': (name + version).encode()}) for version in versions], dependencies)
+
+def planned(plan) -> list:
+    return [(id[len('com.test.'):], [r[len('com.test.'):] for r in entry.requires], entry.is_dep) for id, entry in plan.entries.items()]
+
+def test_packages_are_planned_once_after_their_requirements(repo, server):
+    set_packages([plugin(server, 'app', ['com.test.lib', 'com.test.util']), plugin(server, 'lib', ['com.test.util']), plugin(server, 'util')])
+    plan, failed = vsrepo.plan_install(['app', 'lib', 'util'])
+    assert planned(plan) == [('util', [], False), ('lib', ['util'], False), ('app', ['lib', 'util'], False)]
+    assert failed == []
+    plan, failed = vsrepo.plan_install(['app'])
+    assert planned(plan) == [('util', [], True), ('lib', ['util'], True), ('app', ['lib', 'util'], False)]
+
+def test_dependency_cycle_is_broken(repo, server, capsys):
+    set_packages([plugin(server, 'x', ['com.test.y']), plugin(server, 'y', ['com.test.x'])])
+    plan, failed = vsrepo.plan_install(['x'])
+    assert 'Dependency cycle com.test.x -> com.test.y -> com.test.x ignored' in capsys.readouterr().out
+    assert planned(plan) == [('y', [], True), ('x', ['y'], False)]
+    assert failed == []
+
+def test_missing_dependency_fails(repo, server):
+    set_packages([plugin(server, 'app', ['com.test.nonexistent', 'com.test.lib']), plugin(server, 'lib')])
+    plan, failed = vsrepo.plan_install(['app'])
+    assert failed == ['com.test.nonexistent']
+    assert planned(plan) == [('lib', [], True), ('app', ['lib'], False)]
+    result = vsrepo.execute_plan(plan, failed)
+    assert result == vsrepo.InstallResult([('com.test.app', '1')], [('com.test.lib', '1')], ['com.test.nonexistent'])
+
+@pytest.mark.parametrize('skip_deps', [False, True])
+def test_upgrade_honours_skip_deps(repo, server, monkeypatch, skip_deps):
+    set_packages([plugin(server, 'app')])
+    vsrepo.install_packages(['app'])
+    # the new version has a dependency the old one didn't
+    set_packages([plugin(server, 'app', ['com.test.lib'], ('2', '1')), plugin(server, 'lib')])
+    monkeypatch.setattr(vsrepo.options, 'skip_deps', skip_deps)
+    plan, failed = vsrepo.plan_upgrade(['app'])
+    assert planned(plan) == ([('app', [], False)] if skip_deps else [('lib', [], True), ('app', ['lib'], False)])
+    plan, failed = vsrepo.plan_upgrade(None)
+    assert planned(plan) == ([('app', [], False)] if skip_deps else [('lib', [], True), ('app', ['lib'], False)])
+
+def test_parallel_install_commits_requirements_first(jobs, server, monkeypatch):
+    set_packages([plugin(server, 'app', ['com.test.lib']), plugin(server, 'lib')])
+    # the dependency is the last one to finish downloading
+    server.fail = lambda method, name, r: name.startswith('lib') and time.sleep(0.5)
+    committed = []
+    commit_files = vsrepo.commit_files
+    def record_commit(p, prepared):
+        committed.append((p['name'], sorted(os.listdir(vsrepo.plugin_path)) if os.path.isdir(vsrepo.plugin_path) else []))
+        return commit_files(p, prepared)
+    monkeypatch.setattr(vsrepo, 'commit_files', record_commit)
+    result = vsrepo.install_packages(['app'])
+    assert committed == [('lib', []), ('app', ['lib.dll'])]
+    assert result == vsrepo.InstallResult([('com.test.app', '1')], [('com.test.lib', '1')], [])
@@ -0,0 +1,89 @@
+import json
+import os
+
+import pytest
+
+from conftest import make_package, plugin_release, set_packages, wheel_release
+from vsrepo import vsrepo
+
+@pytest.fixture
+def packages(repo, server):
+    packages = [make_package('a', 'VSPlugin', [plugin_release(server, 'a', '2', {'a.dll': b'a2'}), plugin_release(server, 'a', '1', {'a.dll': b'a1'})]),
+                make_package('b', 'VSPlugin', [plugin_release(server, 'b', '1', {'b.dll': b'b1', 'b2.dll': b'b2'})]),
+                make_package('w', 'PyWheel', [wheel_release(server, 'w', '2.0', {'w/__init__.py': b'v = 2\n'}),
+                                              wheel_release(server, 'w', '1.0', {'w/__init__.py': b'v = 1\n'})])]
+    set_packages(packages)
+    return {p['name']: p for p in packages}
+
+def freeze(tmp_path) -> dict:
+    vsrepo.freeze_packages(str(tmp_path / 'lock.json'))
+    with open(tmp_path / 'lock.json', 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_lock(tmp_path, lock: dict) -> str:
+    with open(tmp_path / 'lock.json', 'w', encoding='utf-8') as f:
+        json.dump(lock, f)
+    return str(tmp_path / 'lock.json')
+
+# the lock entry of another release of p
+def lock_release(p: dict, version: str) -> dict:
+    bin_name = vsrepo.get_bin_name(p)
+    rel = next(rel for rel in p['releases'] if rel['version'] == version)
+    return {'version': version, 'target': bin_name, **vsrepo.get_locked_hashes(rel, bin_name)}
+
+def test_freeze_lists_installed_versions(packages, tmp_path):
+    vsrepo.install_packages(['a', 'w'])
+    lock = freeze(tmp_path)
+    assert lock['file-format'] == vsrepo.lockfile_format
+    assert lock['packages'] == {'com.test.a': lock_release(packages['a'], '2'), 'com.test.w': lock_release(packages['w'], '2.0')}
+
+def test_sync_only_touches_differing_versions(packages, server, tmp_path):
+    vsrepo.install_packages(['a', 'b'])
+    lock = freeze(tmp_path)
+    lock['packages']['com.test.a'] = lock_release(packages['a'], '1')
+    path = write_lock(tmp_path, lock)
+    plan, remove, failed = vsrepo.plan_sync(path)
+    assert list(plan.entries) == ['com.test.a'] and remove == [] and failed == []
+
+    server.clear_log()
+    result = vsrepo.sync_packages(path)
+    assert result == vsrepo.SyncResult([('com.test.a', '1')], [], [])
+    assert [name for _, name, _ in server.log()] == ['a-1.zip']
+    vsrepo.detect_installed_packages()
+    assert vsrepo.installed_packages == {'com.test.a': '1', 'com.test.b': '1'}
+    assert vsrepo.plan_sync(path)[0].entries == {}
+
+def test_sync_downgrades_wheel(packages, tmp_path):
+    vsrepo.install_packages(['w'])
+    path = write_lock(tmp_path, {'file-format': 1, 'target': 'win64', 'packages': {'com.test.w': lock_release(packages['w'], '1.0')}})
+    result = vsrepo.sync_packages(path)
+    assert result.installed == [('com.test.w', '1.0')] and result.failed == []
+    assert sorted(fn for fn in os.listdir(vsrepo.py_script_path) if fn.endswith('.dist-info')) == ['w-1.0.dist-info']
+    with open(os.path.join(vsrepo.py_script_path, 'w', '__init__.py'), 'rb') as f:
+        assert f.read() == b'v = 1\n'
+    vsrepo.detect_installed_packages()
+    assert vsrepo.installed_packages == {'com.test.w': '1.0'}
+
+def test_sync_uninstalls_unlocked_packages(packages, tmp_path):
+    vsrepo.install_packages(['a', 'b'])
+    lock = freeze(tmp_path)
+    del lock['packages']['com.test.b']
+    path = write_lock(tmp_path, lock)
+    result = vsrepo.sync_packages(path)
+    assert result == vsrepo.SyncResult([], [('com.test.b', '1')], [])
+    assert os.listdir(vsrepo.plugin_path) == ['a.dll']
+
+def test_sync_refuses_changed_release(packages, server, tmp_path):
+    vsrepo.install_packages(['a'])
+    lock = freeze(tmp_path)
+    lock['packages']['com.test.a'] = lock_release(packages['a'], '1')
+    path = write_lock(tmp_path, lock)
+    # release 1 was rebuilt after the lockfile was written
+    packages['a']['releases'][1] = plugin_release(server, 'a', '1', {'a.dll': b'tampered'})
+    set_packages(list(packages.values()))
+    server.clear_log()
+    result = vsrepo.sync_packages(path)
+    assert result == vsrepo.SyncResult([], [], ['com.test.a'])
+    assert server.log() == []
+    vsrepo.detect_installed_packages()
+    assert vsrepo.installed_packages == {'com.test.a': '2'}
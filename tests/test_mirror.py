@@ -0,0 +1,84 @@
+import json
+import os
+import zipfile
+
+import pytest
+
+from conftest import init_repo, make_package, plugin_release, sha256
+from vsrepo import vsrepo
+
+script = b'x = 1\n'
+
+@pytest.fixture
+def packages(repo, server):
+    packages = [make_package('a', 'VSPlugin', [plugin_release(server, 'a', '1', {'a.dll': b'a1', 'a2.dll': b'a2'})]),
+                make_package('b', 'VSPlugin', [plugin_release(server, 'b', '1', {'b.dll': b'b1', 'b2.dll': b'b2'})]),
+                make_package('s', 'PyScript', [{'version': '1', 'script': {'url': server.put('s.py', script), 'files': {'s.py': ['s.py', sha256(script)]}}}])]
+    with open(vsrepo.package_json_path, 'w', encoding='utf-8') as f:
+        json.dump({'file-format': 3, 'packages': packages}, f)
+    return {p['name']: p for p in packages}
+
+@pytest.fixture
+def mirror(packages, tmp_path):
+    mirror_dir = str(tmp_path / 'mirror')
+    assert vsrepo.mirror_packages([], ['win64'], mirror_dir) == vsrepo.MirrorResult(3, 3, [])
+    return mirror_dir
+
+def get_url(p: dict) -> str:
+    return p['releases'][0][vsrepo.get_bin_name(p)]['url']
+
+def read_manifest(mirror_dir: str) -> dict:
+    with open(os.path.join(mirror_dir, 'manifest.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def test_manifest_lists_every_release(packages, server, mirror):
+    manifest = read_manifest(mirror)
+    assert manifest['file-format'] == vsrepo.mirror_manifest_format
+    expected = {}
+    for p in packages.values():
+        url = get_url(p)
+        data = server.files[url.rsplit('/', 1)[-1]]
+        expected[url] = {'path': vsrepo.get_mirror_path(url), 'sha256': sha256(data), 'size': len(data), 'releases': [[p['identifier'], '1', vsrepo.get_bin_name(p)]]}
+        with open(os.path.join(mirror, expected[url]['path']), 'rb') as f:
+            assert f.read() == data
+    assert manifest['files'] == expected
+    with zipfile.ZipFile(os.path.join(mirror, 'vspackages3.zip')) as zf, open(vsrepo.package_json_path, 'rb') as f:
+        assert zf.read('vspackages3.json') == f.read()
+
+def test_second_run_only_fetches_missing_and_changed_files(packages, server, mirror, monkeypatch):
+    files = read_manifest(mirror)['files']
+    os.remove(os.path.join(mirror, files[get_url(packages['a'])]['path']))
+    with open(os.path.join(mirror, files[get_url(packages['s'])]['path']), 'ab') as f:
+        f.write(b'appended\n')
+    # without the download cache every file the mirror wants goes through the server
+    monkeypatch.setattr(vsrepo.options, 'cache_size', 0)
+    vsrepo.download_cache.clear()
+    server.clear_log()
+    assert vsrepo.mirror_packages([], ['win64'], mirror) == vsrepo.MirrorResult(3, 2, [])
+    assert sorted(name for _, name, _ in server.log()) == ['a-1.zip', 's.py']
+    assert read_manifest(mirror)['files'] == files
+
+@pytest.mark.parametrize('breakage', ['missing', 'corrupted', 'unlisted'])
+def test_install_falls_back_to_the_original_url(packages, server, mirror, tmp_path, monkeypatch, breakage):
+    manifest = read_manifest(mirror)
+    path = os.path.join(mirror, manifest['files'][get_url(packages['a'])]['path'])
+    if breakage == 'missing':
+        os.remove(path)
+    elif breakage == 'corrupted':
+        # same size, different data
+        with open(path, 'r+b') as f:
+            data = f.read()
+            f.seek(0)
+            f.write(bytes(255 - c for c in data))
+    else:
+        del manifest['files'][get_url(packages['a'])]
+        with open(os.path.join(mirror, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+    init_repo(tmp_path, monkeypatch, mirror=mirror, cache_size=0)
+    vsrepo.download_cache.clear()
+    server.clear_log()
+    result = vsrepo.install_packages(['a', 'b'])
+    assert result.installed == [('com.test.a', '1'), ('com.test.b', '1')] and result.failed == []
+    # b comes from the mirror, a from the server
+    assert [name for _, name, _ in server.log()] == ['a-1.zip']
+    assert sorted(os.listdir(vsrepo.plugin_path)) == ['a.dll', 'a2.dll', 'b.dll', 'b2.dll']
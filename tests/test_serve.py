@@ -0,0 +1,78 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import pytest
+
+from conftest import make_package, plugin_release
+from vsrepo import serve, vsrepo
+
+# the daemon serving definitions with two plugins from a socket in a short tmp dir, unix socket paths are limited to
+# about a hundred characters
+@pytest.fixture
+def daemon(repo, server, monkeypatch):
+    packages = [make_package('a', 'VSPlugin', [plugin_release(server, 'a', '1', {'a.dll': b'a1'})]),
+                make_package('b', 'VSPlugin', [plugin_release(server, 'b', '1', {'b.dll': b'b1'})])]
+    with open(vsrepo.package_json_path, 'w', encoding='utf-8') as f:
+        json.dump({'file-format': 3, 'packages': packages}, f)
+    for name in ('definitions_signature', 'install_signature', 'state_signature'):
+        monkeypatch.setattr(serve, name, None)
+    detections = []
+    detect_installed_packages = vsrepo.detect_installed_packages
+    monkeypatch.setattr(vsrepo, 'detect_installed_packages', lambda: detections.append(1) or detect_installed_packages())
+
+    socket_dir = tempfile.mkdtemp(prefix='vsr')
+    path = os.path.join(socket_dir, 's.sock')
+    s = serve.Server(path, serve.RequestHandler)
+    thread = threading.Thread(target=s.serve_forever, args=(0.05,))
+    thread.start()
+    yield (path, detections)
+    s.shutdown()
+    s.server_close()
+    thread.join()
+    shutil.rmtree(socket_dir, ignore_errors=True)
+
+def test_invalid_requests_are_answered_with_errors(daemon):
+    path, _ = daemon
+    for request, error in [({'op': 'frobnicate'}, 'Unknown operation frobnicate'),
+                           ({'op': 'install', 'packages': 'a'}, 'packages must be a list of names'),
+                           ({'op': 'install'}, 'The install request requires packages'),
+                           ({'op': 'uninstall', 'packages': []}, 'The uninstall request requires packages'),
+                           ({'op': 'install', 'packages': ['nonexistent']}, 'Package nonexistent not found'),
+                           ([], 'Requests must be json objects')]:
+        assert serve.send_request(request, path) == {'error': error}
+
+def test_installed_and_available(daemon):
+    path, _ = daemon
+    assert serve.send_request({'op': 'installed'}, path) == {'result': {}}
+    available = serve.send_request({'op': 'available'}, path)['result']
+    assert [(p['identifier'], p['installed'], p['latest']) for p in available] == [('com.test.a', None, '1'), ('com.test.b', None, '1')]
+
+def test_install_keeps_the_detected_state(daemon):
+    path, detections = daemon
+    serve.send_request({'op': 'installed'}, path)
+    assert len(detections) == 1
+    result = serve.send_request({'op': 'install', 'packages': ['a']}, path)['result']
+    assert result['installed'] == [['com.test.a', '1']] and result['failed'] == []
+    assert serve.install_signature == serve.get_install_signature()
+    assert serve.state_signature == serve.get_stat_signature(vsrepo.installed_state_path)
+    assert serve.send_request({'op': 'installed'}, path) == {'result': {'com.test.a': '1'}}
+    assert len(detections) == 1
+
+def test_external_changes_are_detected(daemon):
+    path, detections = daemon
+    serve.send_request({'op': 'install', 'packages': ['a', 'b']}, path)
+    count = len(detections)
+    # another vsrepo removes a plugin
+    os.remove(os.path.join(vsrepo.plugin_path, 'b.dll'))
+    assert serve.send_request({'op': 'installed'}, path) == {'result': {'com.test.a': '1'}}
+    assert len(detections) == count + 1
+    # and writes the install state
+    with open(vsrepo.installed_state_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': 1, 'files': {}}, f)
+    serve.send_request({'op': 'installed'}, path)
+    assert len(detections) == count + 2
+    serve.send_request({'op': 'installed'}, path)
+    assert len(detections) == count + 2
@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+from vsrepo import vsrepo
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+package_count = 12
+
+# a copy of some of the real package definitions, without dependencies so they can be compiled on their own, that
+# vsrupdate.py compiles like it does for the real server
+@pytest.fixture
+def source(tmp_path):
+    local = tmp_path / 'srv' / 'local'
+    local.mkdir(parents=True)
+    copied = 0
+    for name in sorted(f for f in os.listdir(os.path.join(repo_dir, 'local')) if f.endswith('.json') and not f.endswith('.new.json')):
+        with open(os.path.join(repo_dir, 'local', name), 'r', encoding='utf-8') as f:
+            if 'dependencies' in json.load(f):
+                continue
+        shutil.copyfile(os.path.join(repo_dir, 'local', name), local / name)
+        copied += 1
+        if copied == package_count:
+            break
+    return tmp_path / 'srv'
+
+def compile_definitions(source) -> None:
+    subprocess.run([sys.executable, os.path.join(repo_dir, 'vsrupdate.py'), 'compile'], cwd=source, check=True, stdout=subprocess.DEVNULL)
+
+def publish(server, source) -> None:
+    compile_definitions(source)
+    with server.lock:
+        server.files.clear()
+        server.etags.clear()
+    server.put('vspackages3.zip', (source / 'vspackages3.zip').read_bytes())
+    server.put('vspackages3-index.json', (source / 'vspackages3-index.json').read_bytes())
+    for f in os.scandir(source / 'vspackages3'):
+        with open(f.path, 'rb') as sf:
+            server.put('vspackages3/' + f.name, sf.read())
+    server.clear_log()
+
+def change_packages(source, count: int) -> None:
+    for name in sorted(os.listdir(source / 'local'))[:count]:
+        path = source / 'local' / name
+        pfile = json.loads(path.read_text(encoding='utf-8'))
+        pfile['description'] = pfile.get('description', '') + ' (changed ä)'
+        path.write_text(json.dumps(pfile, ensure_ascii=False, indent='\t'), encoding='utf-8')
+
+def zip_definitions(source) -> bytes:
+    with zipfile.ZipFile(source / 'vspackages3.zip') as zf:
+        return zf.read('vspackages3.json')
+
+def local_definitions() -> bytes:
+    with open(vsrepo.package_json_path, 'rb') as f:
+        return f.read()
+
+def requested(server):
+    return [name for method, name, _ in server.log() if method == 'GET']
+
+def shards_of(source):
+    with open(source / 'vspackages3-index.json', 'r', encoding='utf-8') as f:
+        return [entry['sha256'] for entry in json.load(f)['packages']]
+
+@pytest.fixture
+def updated(repo, server, source):
+    publish(server, source)
+    assert vsrepo.update_package_definition(server.url('vspackages3.zip'))
+    assert requested(server) == ['vspackages3.zip']
+    assert local_definitions() == zip_definitions(source)
+    server.clear_log()
+    return server
+
+def test_unchanged_index_is_not_modified(updated, source):
+    assert vsrepo.update_package_definition(updated.url('vspackages3.zip')) is False
+    assert vsrepo.update_package_definition(updated.url('vspackages3.zip')) is False
+    # the first check fetches the index and keeps its ETag, the second only gets a 304 for it
+    log = updated.requests
+    assert [name for _, name, _ in log] == ['vspackages3-index.json', 'vspackages3-index.json']
+    assert 'if-none-match' not in log[0][2]
+    assert log[1][2]['if-none-match'] == updated.etags['vspackages3-index.json']
+
+def test_only_changed_shards_are_fetched(updated, source):
+    old = set(shards_of(source))
+    change_packages(source, 2)
+    publish(updated, source)
+    assert vsrepo.update_package_definition(updated.url('vspackages3.zip'))
+    changed = sorted(h for h in shards_of(source) if h not in old)
+    assert len(changed) == 2
+    assert requested(updated)[0] == 'vspackages3-index.json'
+    assert sorted(requested(updated)[1:]) == ['vspackages3/' + h + '.json' for h in changed]
+    # the definitions rebuilt from the shards are exactly the ones in the zip
+    assert local_definitions() == zip_definitions(source)
+
+def test_shard_hash_mismatch_falls_back_to_zip(updated, source):
+    old = set(shards_of(source))
+    change_packages(source, 2)
+    publish(updated, source)
+    broken = next(h for h in shards_of(source) if h not in old)
+    updated.put('vspackages3/' + broken + '.json', b'{"name": "broken"}')
+    updated.clear_log()
+    assert vsrepo.update_package_definition(updated.url('vspackages3.zip'))
+    assert requested(updated)[-1] == 'vspackages3.zip'
+    assert local_definitions() == zip_definitions(source)
+
+def test_mostly_changed_definitions_fetch_zip(updated, source):
+    change_packages(source, package_count // 2 + 1)
+    publish(updated, source)
+    assert vsrepo.update_package_definition(updated.url('vspackages3.zip'))
+    assert requested(updated) == ['vspackages3-index.json', 'vspackages3.zip']
+    assert local_definitions() == zip_definitions(source)
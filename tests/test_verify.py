@@ -0,0 +1,66 @@
+import json
+import os
+
+import pytest
+
+from conftest import init_repo, make_package, plugin_release, sha256
+from vsrepo import vsrepo
+
+files = {'a.dll': b'a1', 'sub/a2.dll': b'a2'}
+
+# a plugin installed with the definitions where the command line finds them, in the config dir under HOME
+@pytest.fixture
+def installed(repo, server, tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    init_repo(tmp_path, monkeypatch, definitions_path=None)
+    os.makedirs(os.path.dirname(vsrepo.package_json_path))
+    with open(vsrepo.package_json_path, 'w', encoding='utf-8') as f:
+        json.dump({'file-format': 3, 'packages': [make_package('a', 'VSPlugin', [plugin_release(server, 'a', '1', files)])]}, f)
+    vsrepo.install_packages(['a'])
+    vsrepo.save_installed_state()
+    return ['verify', '-t', 'win64', '-b', vsrepo.plugin_path, '-s', vsrepo.py_script_path]
+
+def plugin_file(name: str) -> str:
+    return os.path.abspath(os.path.join(vsrepo.plugin_path, name))
+
+def test_intact_install_passes(installed, capsys):
+    result = vsrepo.verify_packages()
+    assert result == vsrepo.VerifyResult(2, [], [], [], [])
+    assert vsrepo.main(installed) == 0
+    assert capsys.readouterr().out.endswith('2 files checked, 0 missing, 0 modified, 0 orphaned, 0 unknown\n')
+
+def test_missing_file_is_reported(installed):
+    os.remove(plugin_file('sub/a2.dll'))
+    result = vsrepo.verify_packages()
+    assert result.missing == [{'package': 'com.test.a', 'version': '1', 'path': plugin_file('sub/a2.dll')}]
+    assert result.modified == [] and result.orphaned == []
+
+def test_modified_file_is_reported(installed):
+    with open(plugin_file('a.dll'), 'wb') as f:
+        f.write(b'patched')
+    result = vsrepo.verify_packages()
+    assert result.modified == [{'package': 'com.test.a', 'version': '1', 'path': plugin_file('a.dll'), 'expected': sha256(b'a1'), 'actual': sha256(b'patched')}]
+    assert result.missing == [] and result.orphaned == []
+
+def test_orphaned_file_is_reported(installed):
+    with open(plugin_file('other.dll'), 'wb') as f:
+        f.write(b'other')
+    result = vsrepo.verify_packages()
+    assert result.orphaned == [{'path': plugin_file('other.dll'), 'package': None}]
+    assert result.missing == [] and result.modified == []
+
+def test_json_output_and_exit_code(installed, capsys):
+    os.remove(plugin_file('sub/a2.dll'))
+    with open(plugin_file('a.dll'), 'wb') as f:
+        f.write(b'patched')
+    with open(plugin_file('other.dll'), 'wb') as f:
+        f.write(b'other')
+    capsys.readouterr()
+    assert vsrepo.main(installed + ['--json']) == 1
+    assert json.loads(capsys.readouterr().out) == {
+        'files': 2,
+        'missing': [{'package': 'com.test.a', 'version': '1', 'path': plugin_file('sub/a2.dll')}],
+        'modified': [{'package': 'com.test.a', 'version': '1', 'path': plugin_file('a.dll'), 'expected': sha256(b'a1'), 'actual': sha256(b'patched')}],
+        'orphaned': [{'path': plugin_file('other.dll'), 'package': None}],
+        'unknown': [],
+    }
@@ -0,0 +1,51 @@
+import base64
+import hashlib
+import io
+import os
+import zipfile
+
+import pytest
+
+from conftest import make_wheel, set_packages, sha256
+from vsrepo import vsrepo
+
+module = b'x = 1\n'
+
+def prepare(server, data: bytes):
+    url = server.put('foo-1.0-py3-none-any.whl', data)
+    p = {'name': 'Foo', 'type': 'PyWheel', 'identifier': 'com.test.foo', 'modulename': 'foo', 'wheelname': 'foo',
+         'releases': [{'version': '1.0', 'wheel': {'url': url, 'hash': sha256(data)}}]}
+    set_packages([p])
+    return vsrepo.prepare_files(p, None, p['releases'][0])
+
+def installed_files(repo) -> list:
+    scripts = repo.py_script_path
+    return [os.path.join(dirpath, fn) for dirpath, _, fns in os.walk(scripts) for fn in fns] if os.path.isdir(scripts) else []
+
+def test_valid_wheel_is_prepared(repo, server):
+    prepared = prepare(server, make_wheel('foo', '1.0', {'foo/__init__.py': module}))
+    assert prepared is not None
+    assert set(prepared.files) == {'foo/__init__.py', 'foo-1.0.dist-info/WHEEL', 'foo-1.0.dist-info/METADATA', 'foo-1.0.dist-info/RECORD'}
+
+@pytest.mark.parametrize('record', [
+    {'foo/__init__.py': 'sha256=' + 'A' * 43}, # hash mismatch
+    {'foo/__init__.py': ''}, # listed without a hash
+    {'foo/__init__.py': 'md5=' + base64.urlsafe_b64encode(hashlib.md5(module).digest()).rstrip(b'=').decode()}, # weaker than sha256
+])
+def test_bad_record_is_rejected(repo, server, record):
+    assert prepare(server, make_wheel('foo', '1.0', {'foo/__init__.py': module}, record)) is None
+    assert installed_files(repo) == []
+
+def test_unlisted_member_is_rejected(repo, server):
+    # a member added after the RECORD was written
+    data = io.BytesIO(make_wheel('foo', '1.0', {'foo/__init__.py': module}))
+    with zipfile.ZipFile(data, 'a') as zf:
+        zf.writestr('foo/evil.py', b'import os\n')
+    assert prepare(server, data.getvalue()) is None
+    assert installed_files(repo) == []
+
+@pytest.mark.parametrize('name', ['../evil.py', 'foo/../../evil.py', '/tmp/evil.py', 'C:/evil.py', 'foo\\evil.py'])
+def test_member_path_is_rejected(repo, server, name):
+    assert prepare(server, make_wheel('foo', '1.0', {'foo/__init__.py': module, name: module})) is None
+    assert installed_files(repo) == []
+    assert not os.path.exists(os.path.join(os.path.dirname(repo.py_script_path), 'evil.py'))
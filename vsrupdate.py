@@ -494,6 +494,31 @@ def compile_packages() -> None:
     with zipfile.ZipFile('vspackages3.zip', mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
         zf.writestr('vspackages3.json', data)
 
+    write_package_shards(combined)
+
+# The same packages split into one file per package named after its sha256 in the vspackages3 dir, plus an index listing
+# them in order. Clients that already have definitions fetch the index and only the packages that changed.
+def get_package_shard(pfile: MutableMapping) -> bytes:
+    return json.dumps(pfile, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def write_package_shards(combined: List) -> None:
+    os.makedirs('vspackages3', exist_ok=True)
+    index = []
+    for pfile in combined:
+        shard = get_package_shard(pfile)
+        shard_hash = hashlib.sha256(shard).hexdigest()
+        index.append({ 'identifier': pfile['identifier'], 'sha256': shard_hash })
+        with open(os.path.join('vspackages3', shard_hash + '.json'), 'wb') as sf:
+            sf.write(shard)
+
+    current = set(entry['sha256'] + '.json' for entry in index)
+    for f in os.scandir('vspackages3'):
+        if f.is_file() and f.name not in current:
+            os.remove(f.path)
+
+    with open('vspackages3-index.json', 'w', encoding='utf-8') as idx:
+        json.dump(obj={ 'file-format': 3, 'packages': index }, fp=idx, ensure_ascii=False, indent=2)
+
 
 def getBinaryArch(bin: bytes) -> Optional[int]:
     if b"PE\x00\x00d\x86" in bin:     # hex: 50 45 00 00 64 86 | PE..d†
@@ -698,6 +723,19 @@ elif args.operation == 'upload':
             except:
                 print('Failed to delete vspackages3.zip')
             ftp.storbinary('STOR vspackages3.zip', bpl)
+            # shards are named after their hash so only new ones have to be uploaded, the index goes last so clients never see
+            # an index referring to shards that aren't there yet
+            try:
+                ftp.mkd('vspackages3')
+            except ftplib.error_perm:
+                pass
+            existing = set(os.path.basename(name) for name in ftp.nlst('vspackages3'))
+            for f in os.scandir('vspackages3'):
+                if f.name not in existing:
+                    with open(f.path, 'rb') as sf:
+                        ftp.storbinary('STOR vspackages3/' + f.name, sf)
+            with open('vspackages3-index.json', 'rb') as idx:
+                ftp.storbinary('STOR vspackages3-index.json', idx)
     print('Upload done')
 
 def noop():